@@ -1,5 +1,16 @@
 import chainlit as cl
-import requests
+import httpx
+import json
+
+# Endpoint in streaming (Server-Sent Events) del server FastAPI
+API_URL = "http://127.0.0.1:8000/process_query/stream"
+
+# Descrizione delle fasi mostrata nello step di elaborazione
+STAGE_LABELS = {
+    "tool": "Tool selezionato",
+    "filters": "Filtri generati",
+    "dishes": "Piatti trovati",
+}
 
 @cl.password_auth_callback
 def auth_callback(username: str, password: str):
@@ -38,42 +49,52 @@ async def set_starters():
             )
         ]
 
-@cl.step(type="tool")
-async def loading_tool(message_content):
+async def stream_answer(message_content):
     """
-    Questo tool simula un'elaborazione in corso con un effetto di caricamento
-    e invia una richiesta a un'API FastAPI.
+    Invia la domanda all'API FastAPI e restituisce gli eventi SSE man mano che arrivano,
+    come coppie (evento, dati).
     """
-    
-    try:
-        # Prepara i dati per la richiesta 
-        data = {
-            "query": message_content  # Usa il contenuto del messaggio dell'utente
-        }
-        
-        # Invia la richiesta HTTP al server FastAPI
-        url = "http://127.0.0.1:8000/process_query"
-        response = requests.post(url, json=data)
-        # print(response.json())
-        # Verifica se la risposta è valida
-        if response.status_code == 200:
-            risposta = response.json().get("result", "Non c'è risposta.")
-        else:
-            risposta = f"Errore nella richiesta: {response.status_code}"
-            
-        return risposta
-        
-    except Exception as e:
-        return f"Si è verificato un errore durante l'elaborazione: {str(e)}"
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with client.stream("POST", API_URL, json={"query": message_content}) as response:
+            if response.status_code != 200:
+                yield "error", {"detail": f"Errore nella richiesta: {response.status_code}"}
+                return
+
+            event = "message"
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[len("data:"):].strip())
+                elif not line:
+                    event = "message"
 
 @cl.on_message
 async def main(message: cl.Message):
     """
     Questa funzione è chiamata quando un utente invia un messaggio.
+    Le fasi dell'elaborazione compaiono subito nello step, la risposta arriva token per token.
     """
-    
-    # Chiama il tool di caricamento passando il contenuto del messaggio
-    tool_result = await loading_tool(message.content)
-    
-    # Invia il risultato finale ottenuto dall'API
-    await cl.Message(content=tool_result).send()
\ No newline at end of file
+    step = cl.Step(name="loading_tool", type="tool")
+    step.output = ""
+    await step.send()
+
+    msg = cl.Message(content="")
+
+    try:
+        async for event, data in stream_answer(message.content):
+            if event == "token":
+                await msg.stream_token(data["text"])
+            elif event in STAGE_LABELS:
+                value = next(iter(data.values()), "")
+                step.output += f"{STAGE_LABELS[event]}: {value}\n"
+                await step.update()
+            elif event == "error":
+                await msg.stream_token(data.get("detail", "Errore durante l'elaborazione."))
+            elif event == "done" and not msg.content:
+                msg.content = data.get("result") or "Non c'è risposta."
+    except Exception as e:
+        msg.content = f"Si è verificato un errore durante l'elaborazione: {str(e)}"
+
+    await step.update()
+    await msg.send()
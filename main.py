@@ -1,25 +1,121 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, Response, FileResponse
+from starlette.background import BackgroundTask
+import asyncio
+import json
 import os
-import yaml
 import pandas as pd
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
+from src.app_context import AppContext
+from src.catalog import build_catalog
+from src.batch_executor import BatchExecutor
+from src.jobs import JobConflict
+from src.results_writer import ResultsWriter
+from src.scheduler import PriorityScheduler, QueueFull
+from src.singleflight import normalize_query
 from src.data_processing import DataProcessor
 from src.embedding import EmbeddingHandler
-from src.qdrant_client import QdrantHandler
-from src.agent import VegaMindAgent
-from src.tools.tool_generate_filters import ToolGenerateFilters
-from src.tools.tool_generate_filters_sirius import ToolGenerateFiltersSirius
-import numpy as np
+from src import deadline, metrics, tracing
 import time
+import numpy as np
 import logging
 
+# Configura il logger (il dettaglio per richiesta è gestito dal tracing, vedi src/tracing.py)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Costruisce il contesto applicativo una sola volta all'avvio e lo rilascia allo spegnimento.
+    Il warm-up gira in background: fino al suo completamento la readiness probe resta False.
+    """
+    context = await asyncio.to_thread(AppContext().build)
+    context.profiler.install(asyncio.get_running_loop())
+    app.state.context = context
+    warmup_task = asyncio.create_task(asyncio.to_thread(context.warmup))
+    try:
+        yield
+    finally:
+        warmup_task.cancel()
+        await context.aclose()
+
 # Inizializzazione dell'app FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-# Configura il logger
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """
+    Apre la traccia della richiesta e ne registra le metriche per endpoint (per gli stream: fino all'invio degli header).
+    Gli header `X-Trace-Id` e `X-Trace-Level` (debug, info, off) permettono di seguire una singola richiesta
+    e di sceglierne il livello di dettaglio indipendentemente dal campionamento. `X-Trace-Level` viene usato solo
+    con il token admin (`X-Profile-Token` uguale a `profiling.token`) o con `tracing.level_header` attivo.
+    """
+    in_flight = metrics.HTTP_IN_FLIGHT.labels()
+    in_flight.inc()
+    start = time.perf_counter()
+    status = 500
+    context = getattr(request.app.state, "context", None)
+    trace_scope = tracing.start_trace(
+        request.url.path,
+        trace_id=request.headers.get("x-trace-id"),
+        level=request.headers.get("x-trace-level"),
+        trusted=context is not None and context.profiler.is_admin(request.headers.get("x-profile-token"))
+    )
+    try:
+        with trace_scope as trace, tracing.span("http", method=request.method, path=request.url.path) as span:
+            profile = start_profile(request)
+            try:
+                response = await call_next(request)
+            finally:
+                profile_info = await finish_profile(request, profile)
+            status = response.status_code
+            span.set(status=status)
+        response.headers["X-Trace-Id"] = trace.trace_id
+        if profile_info is not None:
+            response.headers["X-Profile-Id"] = profile_info["name"]
+        return response
+    finally:
+        in_flight.dec()
+        # Il template della route (es. /jobs/{job_id}) evita un'etichetta per ogni id
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.HTTP_DURATION.labels(path=path).observe(time.perf_counter() - start)
+        metrics.HTTP_REQUESTS.labels(path=path, status=status).inc()
+
+def start_profile(request: Request):
+    """Avvia la profilazione della richiesta se richiesta dall'header X-Profile o estratta dal campionamento."""
+    context = getattr(request.app.state, "context", None)
+    if context is None:
+        return None
+    trigger = context.profiler.trigger_for(request.url.path, request.headers)
+    if trigger is None:
+        return None
+    return context.profiler.start_request(trigger, request.url.path)
+
+async def finish_profile(request: Request, profile):
+    """Ferma la profilazione e salva il profilo; un errore di scrittura non fa fallire la richiesta."""
+    if profile is None:
+        return None
+    try:
+        return await request.app.state.context.profiler.finish_request(*profile)
+    except Exception as e:
+        logger.warning("Salvataggio del profilo non riuscito: %s", e)
+        return None
+
+def get_context(request: Request) -> AppContext:
+    """Restituisce il contesto applicativo condiviso costruito nel lifespan."""
+    context = getattr(request.app.state, "context", None)
+    if context is None:
+        raise HTTPException(status_code=503, detail="Servizio non ancora inizializzato.")
+    return context
+
+def sse_format(data, event=None):
+    """Serializza un evento nel formato Server-Sent Events."""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # Modello Pydantic per la richiesta della query
 class QueryRequest(BaseModel):
@@ -29,24 +125,73 @@ class QueryRequest(BaseModel):
 class QueryResponse(BaseModel):
     result: str
 
-# Funzione per elaborare una singola query
-def process_single_query(query: str) -> str:
+# Modello Pydantic per la richiesta di più query
+class QueriesRequest(BaseModel):
+    queries: List[str]
+    chat: bool = False
+
+# Modello Pydantic per la risposta a più query
+class QueriesResponse(BaseModel):
+    results: List[dict]
+
+def make_packs(items, pack_size):
+    """Divide gli elementi in gruppi da inviare al LLM con un solo prompt."""
+    pack_size = max(1, int(pack_size))
+    return [items[i:i + pack_size] for i in range(0, len(items), pack_size)]
+
+def too_busy(error: QueueFull) -> HTTPException:
+    """Risposta 429 quando la coda delle richieste interattive è piena."""
+    return HTTPException(
+        status_code=429,
+        detail="Servizio occupato, riprovare più tardi.",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+async def admit(context: AppContext):
+    """Attende uno slot interattivo dello scheduler; con la coda piena risponde 429 con Retry-After."""
     try:
-        # Inizializza i gestori
-        qdrant_handler = QdrantHandler()
+        return await context.scheduler.acquire(PriorityScheduler.INTERACTIVE)
+    except QueueFull as e:
+        raise too_busy(e)
 
-        # Inizializza i tool che VegaMindAgent può usare
-        tool_1 = ToolGenerateFilters()
-        tool_2 = ToolGenerateFiltersSirius()
+async def run_admitted_query(context: AppContext, query: str, chat: bool):
+    """Elabora la query dopo aver ottenuto uno slot interattivo dello scheduler."""
+    with await admit(context):
+        return await context.agent.aprocess_query(0, query, chat)
 
-        # Inizializza l'agent
-        agent = VegaMindAgent(
-            tools={"generate_filters": tool_1, "generate_filters_sirius": tool_2},
-            qdrant_handler=qdrant_handler
-        )
+def request_budget(context: AppContext):
+    """Budget in secondi di una richiesta interattiva."""
+    return context.config.get("deadlines", {}).get("request")
 
-        # Elabora la query e ottieni il risultato
-        result = agent.process_query(0, query, True)
+async def cancel_on_disconnect(http_request: Request, coro, poll_interval: float = 0.5):
+    """
+    Esegue `coro` cancellandolo se il client si disconnette prima della risposta.
+    La scadenza della richiesta viene convertita in un 504.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                deadline.CANCELLED.labels(reason="disconnect").inc()
+                raise HTTPException(status_code=499, detail="Richiesta annullata dal client.")
+    except deadline.DeadlineExceeded as e:
+        deadline.CANCELLED.labels(reason="deadline").inc()
+        raise HTTPException(status_code=504, detail=str(e))
+    finally:
+        if not task.done():
+            task.cancel()
+
+# Funzione per elaborare una singola query
+async def process_single_query(context: AppContext, query: str) -> str:
+    try:
+        # Elabora la query con l'agent condiviso senza bloccare l'event loop. Le richieste identiche
+        # già in corso (chiave: query normalizzata e modalità chat) condividono la stessa esecuzione e lo stesso slot
+        result = await context.inflight_queries.do(
+            (normalize_query(query), True), run_admitted_query, context, query, True
+        )
 
         # Restituisci solo la parte 'result' del dizionario
         return result['result']
@@ -54,112 +199,342 @@ def process_single_query(query: str) -> str:
         logger.error(f"Errore durante l'elaborazione: {e}")
         raise
 
+# Liveness probe: il processo risponde
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+# Readiness probe: False finché il warm-up non è terminato
+@app.get("/ready")
+async def ready(request: Request):
+    context = getattr(request.app.state, "context", None)
+    is_ready = context is not None and context.ready
+    content = {"ready": is_ready}
+    if context is not None and context.warmup_error:
+        content["error"] = context.warmup_error
+    return JSONResponse(status_code=200 if is_ready else 503, content=content)
+
+# Metriche in formato Prometheus (latenze per fase, contatori, richieste in corso)
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+def get_profiler(request: Request, context: AppContext = Depends(get_context)):
+    """Profiler per gli endpoint /admin: 404 se il profiling è disattivato, 403 senza il token configurato."""
+    profiler = context.profiler
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profiling disattivato.")
+    if not profiler.check_token(request.headers.get("x-profile-token")):
+        raise HTTPException(status_code=403, detail="Token di profiling non valido.")
+    return profiler
+
+# Profilo dell'intero processo (tutti i thread e i task) per `seconds` secondi
+@app.post("/admin/profile")
+async def profile_process(seconds: float = 10, profiler=Depends(get_profiler)):
+    info = await profiler.profile_process(max(0.1, seconds))
+    if info is None:
+        raise HTTPException(status_code=409, detail="Una sessione di profiling è già in corso.")
+    return info
+
+# Profili salvati, dal più recente
+@app.get("/admin/profiles")
+async def list_profiles(profiler=Depends(get_profiler)):
+    return profiler.list_profiles()
+
+# Download di un profilo (formato collapsed: flamegraph.pl, speedscope)
+@app.get("/admin/profiles/{name}")
+async def get_profile(name: str, profiler=Depends(get_profiler)):
+    path = profiler.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profilo non trovato.")
+    return FileResponse(path, media_type="text/plain", filename=name)
+
 # Endpoint per elaborare una singola query
 @app.post("/process_query/", response_model=QueryResponse)
-async def process_query(request: QueryRequest):
+async def process_query(request: QueryRequest, http_request: Request, context: AppContext = Depends(get_context)):
     """
     Endpoint per elaborare una singola query.
     """
     try:
-        result = process_single_query(request.query)
+        # Il budget viene ereditato da tutte le fasi; una disconnessione del client cancella il lavoro
+        with deadline.budget(request_budget(context)):
+            result = await cancel_on_disconnect(http_request, process_single_query(context, request.query))
         return QueryResponse(result=result)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore durante l'elaborazione della query: {str(e)}")
 
-# Endpoint per configurare il database (set up DB)
-@app.post("/setup_db/")
-async def setup_database():
+def run_setup_db(job, context: AppContext):
     """
-    Endpoint per configurare il database Qdrant.
+    Job di configurazione del database Qdrant (eseguito nel thread pool dei job).
     """
+    # Elaborazione dei dati e configurazione del database
+    print("Elaborazione dei documenti...")
+    job.update(phase="parsing")
+    data_processor = DataProcessor(config=context.config, llm=context.llm)
+
+    def on_progress(files_done, files_total, dishes_done):
+        job.update(done=files_done, total=files_total, files_done=files_done, files_total=files_total, dishes_done=dishes_done)
+
+    all_chunks, metadata = data_processor.process_all_documents(
+        progress_callback=on_progress,
+        cancel_check=job.raise_if_cancelled
+    )
+
+    print("Generazione degli embeddings...")
+    job.raise_if_cancelled()
+    job.update(phase="embedding")
+    embedding_handler = EmbeddingHandler()
+    embeddings = embedding_handler.generate_embeddings(all_chunks)
+
+    # Verifica la struttura dell'embedding
+    if isinstance(embeddings[0], np.ndarray):
+        embedding_dim = embeddings[0].shape[0]
+    elif isinstance(embeddings[0], list):
+        embedding_dim = len(embeddings[0])
+    else:
+        raise ValueError("L'embedding non ha la struttura prevista")
+
+    print("Configurazione del database Qdrant...")
+    job.raise_if_cancelled()
+    job.update(phase="uploading")
+    qdrant_handler = context.qdrant_handler
+    qdrant_handler.setup_collection(embedding_dim)
+
+    print("Caricamento dei documenti in Qdrant...")
+    payload = [{"text": chunk, **meta} for chunk, meta in zip(all_chunks, metadata)]
+    qdrant_handler.upload_documents(embeddings, payload)
+
+    # Nuova versione del catalogo: i worker la adottano al prossimo controllo del puntatore CURRENT
+    print("Pubblicazione del catalogo...")
+    job.update(phase="catalog")
+    catalog_version = context.catalog.publish(build_catalog(context.config, metadata))
+    # Filtri e risposte in cache sono stati prodotti sui dati precedenti: le chiavi includono la versione
+    # del catalogo, quindi gli altri worker le abbandonano da soli; qui si libera subito lo spazio su disco
+    context.cache.invalidate()
+    context.semantic_cache.invalidate()
+    # Su un deployment nuovo il warm-up iniziale ha trovato la collezione vuota
     try:
-        # Elaborazione dei dati e configurazione del database
-        print("Elaborazione dei documenti...")
-        data_processor = DataProcessor()
-        all_chunks, metadata = data_processor.process_all_documents()
-
-        print("Generazione degli embeddings...")
-        embedding_handler = EmbeddingHandler()
-        embeddings = embedding_handler.generate_embeddings(all_chunks)
-
-        # Verifica la struttura dell'embedding
-        if isinstance(embeddings[0], np.ndarray):
-            embedding_dim = embeddings[0].shape[0]
-        elif isinstance(embeddings[0], list):
-            embedding_dim = len(embeddings[0])
-        else:
-            raise ValueError("L'embedding non ha la struttura prevista")
-
-        print("Configurazione del database Qdrant...")
-        qdrant_handler = QdrantHandler()
-        qdrant_handler.setup_collection(embedding_dim)
-
-        print("Caricamento dei documenti in Qdrant...")
-        payload = [{"text": chunk, **meta} for chunk, meta in zip(all_chunks, metadata)]
-        qdrant_handler.upload_documents(embeddings, payload)
-
-        print("Database configurato con successo!")
-        return {"message": "Database configurato con successo!"}
+        context.qdrant_handler.warmup()
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante la configurazione del database: {str(e)}")
+        print(f"[ATTENZIONE] Warm-up di Qdrant dopo il setup non riuscito: {e}")
 
-# Se vuoi elaborare una query da file CSV, puoi aggiungere un altro endpoint
-@app.post("/process_csv/")
-async def process_csv():
+    print("Database configurato con successo!")
+    job.update(phase="done")
+    return {"message": "Database configurato con successo!", "documents": len(payload), "catalog_version": catalog_version}
+
+async def run_process_csv(job, context: AppContext, resume: bool = True):
     """
-    Endpoint per elaborare domande da un file CSV.
+    Job di elaborazione delle domande del file CSV (eseguito come task sull'event loop).
+    Con `resume` le righe presenti nel checkpoint vengono saltate; altrimenti si riparte da zero.
     """
+    config = context.config
+    agent = context.agent
+
+    # Carica il file CSV con le domande
+    questions_df = pd.read_csv(config["paths"]["questions"])
+
+    # Rimuove spazi da tutti i nomi delle colonne
+    questions_df.columns = questions_df.columns.str.strip()
+
+    # Aggiungi una colonna 'row_id' se non esiste
+    if 'row_id' not in questions_df.columns:
+        questions_df['row_id'] = questions_df.index + 1
+
+    batch_config = config.get("batch", {})
+    writer = ResultsWriter(
+        config["paths"]["output"],
+        checkpoint_path=config["paths"].get("output_checkpoint"),
+        flush_every=batch_config.get("flush_every", 10)
+    )
+    if not resume:
+        writer.reset()
+
+    rows = questions_df.sort_values("row_id")[["row_id", "domanda"]].to_dict("records")
+    # Le righe già completate in un'esecuzione precedente non vengono rielaborate
+    pending_rows = [row for row in rows if not writer.is_completed(row["row_id"])]
+    rows_done = len(rows) - len(pending_rows)
+    job.update(done=rows_done, total=len(rows), skipped=rows_done)
+
+    # Più domande per prompt: routing e filtri costano una chiamata per gruppo invece che per domanda
+    packs = make_packs([(row["row_id"], row["domanda"]) for row in pending_rows], batch_config.get("pack_size", 10))
+
+    async def process_pack(pack):
+        # Uno slot batch per gruppo: tra un gruppo e l'altro le richieste interattive passano avanti
+        with await context.scheduler.acquire(PriorityScheduler.BATCH, bounded=False), \
+                deadline.budget(config.get("deadlines", {}).get("batch_pack")):
+            # Una traccia per gruppo di domande: il campionamento si applica anche ai job batch
+            with tracing.start_trace("process_csv"), tracing.span("process_pack", row_ids=[row_id for row_id, _ in pack]):
+                return await agent.aprocess_queries(pack)
+
+    def write_results(pack, results):
+        nonlocal rows_done
+        rows_done += len(pack)
+        job.update(done=rows_done)
+        for index, (row_id, _) in enumerate(pack):
+            writer.add(row_id, results[index] if results is not None else None)
+
+    # I gruppi vengono elaborati in parallelo; il ritmo è dettato dai rate limiter dei provider
+    executor = BatchExecutor(batch_config.get("max_concurrency", 4))
     try:
-        # Carica la configurazione
-        with open("config/config.yaml", 'r') as f:
-            config = yaml.safe_load(f)
+        await executor.run(packs, process_pack, on_result=write_results)
+    finally:
+        # Anche in caso di cancellazione i risultati già ottenuti restano su disco
+        writer.close()
 
-        # Inizializza i gestori
-        qdrant_handler = QdrantHandler() 
+    return {
+        "message": "Elaborazione completata! Risultati salvati.",
+        "rows": len(rows),
+        "completed": len(writer.completed)
+    }
 
-        # Inizializza i tool che VegaMindAgent può usare
-        tool_1 = ToolGenerateFilters()
-        tool_2 = ToolGenerateFiltersSirius()
+def job_accepted(job):
+    """Risposta 202 con l'id del job e gli URL per seguirne l'avanzamento."""
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    })
 
-        # Inizializza l'agent
-        agent = VegaMindAgent(
-            tools={"generate_filters": tool_1, "generate_filters_sirius": tool_2},
-            qdrant_handler=qdrant_handler
-        )
+def job_conflict(error: JobConflict):
+    """Risposta 409 con il job dello stesso tipo ancora in corso, da seguire al posto di uno nuovo."""
+    job = error.job
+    return JSONResponse(status_code=409, content={
+        "detail": f"Un job {job.kind} è già in corso.",
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events"
+    })
+
+# Endpoint per elaborare più query con un numero ridotto di chiamate al LLM
+@app.post("/process_queries/", response_model=QueriesResponse)
+async def process_queries(request: QueriesRequest, http_request: Request, context: AppContext = Depends(get_context)):
+    """
+    Endpoint per elaborare una lista di query: routing e generazione dei filtri
+    vengono fatti con un solo prompt per gruppo di `batch.pack_size` domande.
+    """
+    try:
+        context.scheduler.check_admission()
+    except QueueFull as e:
+        raise too_busy(e)
 
-        # Carica il file CSV con le domande
-        questions_df = pd.read_csv(config["paths"]["questions"])
+    try:
+        batch_config = context.config.get("batch", {})
+        items = [(row_id, query) for row_id, query in enumerate(request.queries, start=1)]
+        packs = make_packs(items, batch_config.get("pack_size", 10))
 
-        # Rimuove spazi da tutti i nomi delle colonne
-        questions_df.columns = questions_df.columns.str.strip()
+        async def process_pack(pack):
+            # Ammessa la richiesta, i suoi gruppi attendono lo slot senza essere rifiutati a metà
+            with await context.scheduler.acquire(PriorityScheduler.INTERACTIVE, bounded=False):
+                return await context.agent.aprocess_queries(pack, chat=request.chat)
 
-        # Aggiungi una colonna 'row_id' se non esiste
-        if 'row_id' not in questions_df.columns:
-            questions_df['row_id'] = questions_df.index + 1
+        executor = BatchExecutor(batch_config.get("max_concurrency", 4))
+        with deadline.budget(request_budget(context)):
+            pack_results = await cancel_on_disconnect(http_request, executor.run(packs, process_pack))
 
-        # Elabora le domande
         results = []
+        for pack, pack_result in zip(packs, pack_results):
+            if pack_result is None:
+                pack_result = [{"success": False, "result": "Errore durante l'elaborazione."}] * len(pack)
+            results.extend(pack_result)
+        return QueriesResponse(results=results)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore durante l'elaborazione delle query: {str(e)}")
 
-        output_path = config["paths"]["output"]
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+# Endpoint per elaborare una singola query in streaming (Server-Sent Events)
+@app.post("/process_query/stream")
+async def process_query_stream(request: QueryRequest, context: AppContext = Depends(get_context)):
+    """
+    Endpoint di chat in streaming: invia subito gli eventi delle fasi (tool, filtri, piatti)
+    e poi i token della risposta, senza il ragionamento <think>.
+    """
+    # Lo slot viene ottenuto prima di iniziare lo stream, così un 429 arriva come risposta HTTP
+    slot = await admit(context)
 
-        # Controlliamo se il file esiste già
-        file_exists = os.path.isfile(output_path)
+    async def events():
+        try:
+            # Il budget vale per l'intero stream; se il client si disconnette il generatore viene chiuso
+            # e il lavoro in corso cancellato
+            with deadline.budget(request_budget(context)):
+                async for event, data in context.agent.astream_query(request.query):
+                    yield sse_format(data, event=event)
+        except deadline.DeadlineExceeded as e:
+            deadline.CANCELLED.labels(reason="deadline").inc()
+            yield sse_format({"detail": str(e)}, event="error")
+        except Exception as e:
+            logger.error(f"Errore durante l'elaborazione in streaming: {e}")
+            yield sse_format({"detail": f"Errore durante l'elaborazione della query: {str(e)}"}, event="error")
+        finally:
+            slot.release()
 
-        for index, row in questions_df.iterrows():
-            query = row["domanda"]
-            row_id = row["row_id"]
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Rilascio idempotente anche se il client si disconnette prima dell'inizio dello stream
+        background=BackgroundTask(slot.release)
+    )
 
-            result = agent.process_query(row_id, query)
-            results.append(result)
+# Endpoint per configurare il database (set up DB)
+@app.post("/setup_db/")
+async def setup_database(context: AppContext = Depends(get_context)):
+    """
+    Avvia in background la configurazione del database Qdrant e restituisce l'id del job.
+    Un solo job alla volta: con un setup_db in corso risponde 409 con il suo id.
+    """
+    try:
+        job = context.jobs.submit("setup_db", run_setup_db, context, exclusive=True)
+    except JobConflict as e:
+        return job_conflict(e)
+    return job_accepted(job)
 
-            result_df = pd.DataFrame([result])  # Creiamo un DataFrame con una sola riga
-            result_df.to_csv(output_path, mode="a", header=not file_exists, index=False)
-            file_exists = True
+# Se vuoi elaborare una query da file CSV, puoi aggiungere un altro endpoint
+@app.post("/process_csv/")
+async def process_csv(resume: bool = True, context: AppContext = Depends(get_context)):
+    """
+    Avvia in background l'elaborazione delle domande del file CSV e restituisce l'id del job.
+    Di default riprende dal checkpoint; con `?resume=false` rielabora tutte le domande.
+    Un solo job alla volta (output e checkpoint sono condivisi): con un process_csv in corso risponde 409 con il suo id.
+    """
+    try:
+        job = context.jobs.submit("process_csv", run_process_csv, context, resume, exclusive=True)
+    except JobConflict as e:
+        return job_conflict(e)
+    return job_accepted(job)
 
-            # Attendi 5 secondi prima di elaborare la prossima domanda
-            time.sleep(5)
+# Elenco dei job
+@app.get("/jobs/")
+async def list_jobs(context: AppContext = Depends(get_context)):
+    return context.jobs.list()
 
-        return {"message": "Elaborazione completata! Risultati salvati."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante l'elaborazione del CSV: {str(e)}")
+# Stato e avanzamento di un job
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, context: AppContext = Depends(get_context)):
+    job = context.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trovato.")
+    return job.to_dict()
+
+# Stream dell'avanzamento di un job (Server-Sent Events)
+@app.get("/jobs/{job_id}/events")
+async def stream_job(job_id: str, context: AppContext = Depends(get_context)):
+    if context.jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job non trovato.")
+
+    async def events():
+        async for snapshot in context.jobs.stream(job_id):
+            yield sse_format(snapshot, event="progress")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# Cancellazione di un job
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, context: AppContext = Depends(get_context)):
+    if not context.jobs.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Job non trovato.")
+    return context.jobs.get(job_id).to_dict()
@@ -1,46 +1,100 @@
-import groq
+import asyncio
 import json
-import pandas as pd
+import threading
+import time
 from typing import List, Dict, Any
+from src.answers import ANSWERS, AnswerRenderer, dish_summary
+from src.catalog import CatalogStore
 from src.config_loader import ConfigLoader
+from src import deadline, tracing
+from src.metrics import EMPTY_RESULTS, JSON_PARSE_FALLBACKS, REGISTRY, timed, track_stage
+from src.llm_gateway import Answer, LLMGateway, TokenUsage, clean_response, extract_json, strip_think, track_usage
+from src.response_cache import ResponseCache, fingerprint
+from src.semantic_cache import SemanticCache
+from src.router import ToolRouter
+from src.planner import QueryPlanner
+from src.singleflight import SingleFlight, normalize_query
+from src.streaming import ThinkFilter
 import requests
 import logging
 from qdrant_client.http import models
-import time
+
+SPECULATION_RESULTS = REGISTRY.counter(
+    "vegamind_speculation_results_total",
+    "Esecuzioni speculative dei tool per esito (hit: il tool scelto era già in esecuzione, miss, none: nessun tool).",
+    ["result"])
+SPECULATION_SAVED = REGISTRY.counter(
+    "vegamind_speculation_saved_seconds_total", "Latenza risparmiata avviando i filtri insieme al routing.")
+SPECULATION_WASTED_TOKENS = REGISTRY.counter(
+    "vegamind_speculation_wasted_tokens_total", "Token spesi per filtri speculativi di tool non scelti, per tool.", ["tool"])
 
 class VegaMindAgent:
-    def __init__(self, tools, qdrant_handler, config_path="config/config.yaml"):
+    def __init__(self, tools, qdrant_handler, config_path="config/config.yaml", config=None, llm=None, catalog=None, cache=None, semantic_cache=None, router=None):
 
         # load tools
         self.tools = tools
-        
-        # Configura il logging
-        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
         self.logger = logging.getLogger(__name__)
         
-        print("\n[INIT] Caricamento della configurazione...\n")
-        self.config_loader = ConfigLoader(config_path)
-        self.config = self.config_loader.get_config()
-        print("[OK] Configurazione caricata correttamente!\n")
+        if config is None:
+            config = ConfigLoader(config_path).get_config()
+            self.logger.info("Configurazione caricata da %s", config_path)
+        self.config = config
 
         self.qdrant_handler = qdrant_handler
 
-        print("[INIT] Inizializzazione del client Groq...\n")
-        self.client = groq.Client(api_key=self.config["groq"]["api_key"])
-        self.model = self.config["groq"]["model"]
-        print("[OK] Client Groq inizializzato con il modello:", self.model, "\n")
-
-        print("[INIT] Caricamento delle informazioni sui piatti e distanze...\n")
-        with open(self.config["paths"]["dish_mapping"], 'r') as f:
-            self.dish_mapping = json.load(f)
-
-        self.distances_df = pd.read_csv(self.config["paths"]["distances"], index_col=0)
-        print("[OK] Mappatura piatti e distanze planetarie caricate!\n")
-        
-    def decide_tool(self, user_query):
-        """Usa il modello DeepSeek per determinare quale tool chiamare."""
-
-        prompt = f"""
+        # Gateway LLM (pool di connessioni e rate limiter condivisi con i tool quando costruito dall'AppContext)
+        self._owns_llm = llm is None
+        self.llm = llm or LLMGateway(self.config)
+
+        # Domande identiche in corso condividono la stessa chiamata di routing
+        self.inflight_decide_tool = SingleFlight("decide_tool")
+
+        # Codici dei piatti e distanze planetarie dal catalogo mappato in memoria (condiviso tra i worker)
+        if catalog is None:
+            catalog = CatalogStore.from_config(self.config)
+            catalog.ensure(self.config)
+        self.catalog = catalog
+
+        # Cache delle risposte deterministiche (condivisa con i tool quando costruita dall'AppContext)
+        self.cache = cache or ResponseCache.from_config(self.config)
+        # Filtri riutilizzati tra domande parafrasate (attiva solo se costruita con un modello di embedding)
+        self.semantic_cache = semantic_cache or SemanticCache()
+        # Router locale (regole + classificatore): il LLM sceglie il tool solo quando il router non è sicuro
+        self.router = router or ToolRouter()
+        self._audits = set()
+        # Planner opzionale: tool e filtri con una sola chiamata quando il router locale non basta
+        self.planner = QueryPlanner.from_config(self.config, self)
+        # Esecuzione speculativa opzionale: i filtri del tool probabile partono insieme al routing
+        speculation_config = self.config.get("speculation", {})
+        self.speculation = speculation_config.get("enabled", False)
+        self.speculation_tools = speculation_config.get("tools", "likely")
+        # Risposte in chat: LLM, template dai riassunti dei piatti o scelta automatica
+        self.answers = AnswerRenderer.from_config(self.config)
+        # Event loop delle chiamate sincrone (process_query)
+        self._loop = None
+        self._sync_lock = threading.Lock()
+
+    def warmup(self):
+        """Prepara le risorse usate in ogni richiesta prima di servire traffico."""
+        self.qdrant_handler.warmup()
+
+        # La prima costruzione di un filtro inizializza i validatori dei modelli Qdrant
+        self.build_qdrant_filter({"AND": {"ingredients": ["warmup"]}})
+
+        # Mappa il catalogo attivo e ne porta in memoria le pagine usate dalle lookup
+        catalog = self.catalog.current()
+        if len(catalog.planets) > 0:
+            self.get_planets_within_distance(catalog.planets.name(0), 0)
+
+        # Carica il modello di embedding della cache semantica
+        self.semantic_cache.warmup()
+
+    ROUTING_SYSTEM_PROMPT = "Sei un assistente AI specializzato in cucina galattica. Il tuo compito è analizzare la domanda dell'utente e determinare quale tool utilizzare per interrogare correttamente il database."
+
+    def build_routing_rules(self):
+        """Regole di scelta del tool, condivise dal prompt singolo e da quello a più domande."""
+        return """
         ### CONTESTO:
         - Il database contiene informazioni su piatti galattici, ingredienti, tecniche di cottura, pianeti, licenze e altro.
         - Il Manuale di Sirius Cosmo è un importante riferimento che contiene tecniche speciali.
@@ -61,6 +115,13 @@ class VegaMindAgent:
         - "Quali piatti usano tecniche di Sirius Cosmo?" → generate_filters_sirius
         - "Quali piatti sono preparati su Asgard?" → generate_filters
         - Se non richiesta non fa riferimento a generate_filters o generate_filters_sirius allora rispondi → none
+        """
+
+    def build_decide_tool_messages(self, user_query):
+        """Costruisce i messaggi per la scelta del tool."""
+
+        prompt = f"""
+        {self.build_routing_rules()}
 
         **Esempi di output:**
         ```json
@@ -85,43 +146,243 @@ class VegaMindAgent:
         --- RISPOSTA (solo JSON) ---
         """
 
-        # Chiamata al LLM per decidere il tool da usare
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "Sei un assistente AI specializzato in cucina galattica. Il tuo compito è analizzare la domanda dell'utente e determinare quale tool utilizzare per interrogare correttamente il database."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0
+        return [
+            {"role": "system", "content": self.ROUTING_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+
+    def semantic_template(self):
+        """Impronta di routing e filtri: cambiando un prompt, il modello o il catalogo la cache semantica si svuota."""
+        tools = {
+            name: tool.cache_template() for name, tool in sorted(self.tools.items()) if hasattr(tool, "cache_template")
+        }
+        return fingerprint(
+            self.build_decide_tool_messages("{query}"), self.llm.model_name("groq"), self.llm.model_name("gemini"),
+            tools, self.planner.cache_template() if self.planner.enabled else None, self.catalog.current().version
         )
 
-        response_content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
-        
-        # Remove <think>...</think>
-        if "<think>" in response_content and "</think>" in response_content:
-            response_content = response_content.split("</think>")[-1].strip()
+    def reuse_filters(self, probe):
+        """Tool e filtri di una domanda simile già elaborata, o None."""
+        if probe is None or probe.hit is None:
+            return None
+        tracing.info(
+            "Filtri riutilizzati da una domanda simile", similar_query=probe.similar_query, similarity=round(probe.similarity, 4)
+        )
+        return probe.hit
+
+    def routing_cache_key(self, user_query, model=None):
+        """
+        Chiave di cache del routing: i prompt singolo e a più domande fanno parte dell'impronta,
+        insieme alla versione del catalogo (una nuova ingestion invalida la cache in tutti i worker).
+        `model` è il modello che ha risposto (con il failover può non essere quello di Groq).
+        """
+        template = fingerprint(
+            self.build_decide_tool_messages("{query}"), self.build_decide_tools_batch_messages(["{query}"]),
+            self.catalog.current().version
+        )
+        return self.cache.key("decide_tool", template, model or self.llm.model_name("groq"), normalize_query(user_query))
+
+    def parse_tool_response(self, content):
+        """Estrae il nome del tool dalla risposta del modello: (tool, True se la risposta era valida e non serve il ripiego)."""
+        tracing.debug("Risposta di routing ricevuta", response=lambda: clean_response(content))
+
+        try:
+            tool_selected = extract_json(content)
+        except json.JSONDecodeError as e:
+            self.logger.warning("Errore nel parsing del JSON: %s", e)
+            tool_selected = None
 
         # Verifica se la risposta è vuota o non è un JSON valido
-        if not response_content or not response_content.startswith("{"):
-            print("Errore: La risposta del modello non è un JSON valido.")
-            print("Risposta:", json.loads(response_content))
+        if not isinstance(tool_selected, dict) or "tool" not in tool_selected:
+            self.logger.warning("Risposta di routing non valida, uso generate_filters: %r", clean_response(content)[:200])
             # Assegna un valore di default
             tool_selected = {"tool": "generate_filters"}
+            JSON_PARSE_FALLBACKS.inc(stage="decide_tool")
+            valid = False
         else:
+            valid = tool_selected["tool"] in self.VALID_TOOLS
+
+        tracing.info("Tool selezionato: %s", tool_selected["tool"])
+        return tool_selected["tool"], valid
+
+    def local_route(self, user_query):
+        """Decisione del router locale (None se disattivato); le decisioni del classificatore possono essere ricontrollate."""
+        route = self.router.route(user_query)
+        if route is not None and route.tool is not None:
+            tracing.info("Tool selezionato dal router locale: %s", route.tool, source=route.source, confidence=round(route.confidence, 4))
+        return route
+
+    def audit_route(self, user_query, route):
+        """Ricontrolla in background una decisione del classificatore con il LLM, senza rallentare la richiesta."""
+        async def audit():
             try:
-                tool_selected = json.loads(response_content)
-                print(f"\nRisposta ricevuta: {json.loads(response_content)}\n")
-            except json.JSONDecodeError as e:
-                print("Errore nel parsing del JSON:", e)
-                print(f"\nRisposta ricevuta: {response_content}\n")
-                # Assegna un valore di default
-                tool_selected = {"tool": "generate_filters"}
+                tool = await self._adecide_tool(user_query)
+                self.router.compare(route, tool, "audit")
+            except Exception as e:
+                self.logger.warning("Verifica del router locale non riuscita: %s", e)
+
+        task = asyncio.create_task(audit())
+        self._audits.add(task)
+        task.add_done_callback(self._audits.discard)
+
+    @timed("decide_tool")
+    @deadline.with_deadline("decide_tool")
+    async def adecide_tool(self, user_query, route=None):
+        """
+        Versione asincrona di decide_tool. Le chiamate concorrenti per la stessa domanda vengono unite.
+        `route` è la decisione del router locale, se già calcolata.
+        """
+        if route is None:
+            route = self.local_route(user_query)
+        if route is not None and route.tool is not None:
+            if self.router.should_audit(route):
+                self.audit_route(user_query, route)
+            return route.tool
+
+        tool = await self.cache.aget(self.routing_cache_key(user_query))
+        if tool is None:
+            tool = await self.inflight_decide_tool.do(normalize_query(user_query), self._adecide_tool, user_query)
+
+        self.router.compare(route, tool, "escalation")
+        return tool
+
+    async def _adecide_tool(self, user_query):
+        answer = Answer()
+        content = await self.llm.achat(
+            "groq", self.build_decide_tool_messages(user_query), temperature=0.0, stage="decide_tool", answer=answer
+        )
+
+        tool, valid = self.parse_tool_response(content)
+        if valid:
+            await self.cache.aset(self.routing_cache_key(user_query, answer.model), tool)
+            self.router.record(user_query, tool)
+        return tool
+
+    VALID_TOOLS = ("generate_filters", "generate_filters_sirius", "none")
+
+    def build_decide_tools_batch_messages(self, queries):
+        """Costruisce i messaggi per scegliere il tool di più domande con una sola chiamata."""
+
+        numbered_queries = "\n".join(f"{index}. {query}" for index, query in enumerate(queries, start=1))
 
-        print(f"[Agent Principale] → Tool selezionato: {tool_selected['tool']}\n")
-        return tool_selected["tool"]
+        prompt = f"""
+        {self.build_routing_rules()}
+
+        ### FORMATO DI RISPOSTA:
+        - Riceverai più domande numerate. Scegli il tool per ciascuna domanda in modo indipendente.
+        - Rispondi con un unico oggetto JSON che ha come chiavi i numeri delle domande e come valori il tool scelto.
+
+        **Esempio di output per 3 domande:**
+        ```json
+        {{
+            "1": "generate_filters",
+            "2": "generate_filters_sirius",
+            "3": "none"
+        }}
+        ```
+
+        --- DOMANDE UTENTE ---
+        {numbered_queries}
 
-    def retrieve_relevant_context(self, filters, k=None):
-        """Recupera i nomi dei piatti rilevanti dalla knowledge base utilizzando solo i filtri."""
+        --- RISPOSTA (solo JSON) ---
+        """
+
+        return [
+            {"role": "system", "content": self.ROUTING_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+
+    def parse_tools_batch_response(self, content, count):
+        """
+        Estrae i tool scelti da una risposta a più domande.
+        Restituisce un dizionario {indice: tool} con i soli elementi validi (indici a partire da 0).
+        """
+        try:
+            parsed = extract_json(content)
+        except json.JSONDecodeError as e:
+            self.logger.warning("Risposta di routing a più domande non valida: %s", e)
+            return {}
+
+        if not isinstance(parsed, dict):
+            return {}
+
+        tools = {}
+        for index in range(count):
+            value = parsed.get(str(index + 1))
+            # Accetta sia "generate_filters" sia {"tool": "generate_filters"}
+            if isinstance(value, dict):
+                value = value.get("tool")
+            if value in self.VALID_TOOLS:
+                tools[index] = value
+        return tools
+
+    @timed("decide_tool_batch")
+    @deadline.with_deadline("decide_tool")
+    async def adecide_tools_batch(self, queries):
+        """
+        Sceglie il tool di più domande con una sola chiamata al LLM.
+        Le domande già in cache non entrano nel prompt; quelle con risposta mancante o non valida,
+        o tutte se la chiamata fallisce, vengono ricalcolate singolarmente.
+        Per le domande il cui routing fallisce anche singolarmente la lista contiene l'eccezione.
+        """
+        if len(queries) == 1:
+            return list(await asyncio.gather(self.adecide_tool(queries[0]), return_exceptions=True))
+
+        keys = [self.routing_cache_key(query) for query in queries]
+        tools = {}
+        routes = {}
+        for index, key in enumerate(keys):
+            route = self.local_route(queries[index])
+            if route is not None and route.tool is not None:
+                tools[index] = route.tool
+                if self.router.should_audit(route):
+                    self.audit_route(queries[index], route)
+                continue
+            routes[index] = route
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                tools[index] = cached
+
+        pending = [index for index in range(len(queries)) if index not in tools]
+        if len(pending) > 1:
+            answer = Answer()
+            try:
+                content = await self.llm.achat(
+                    "groq", self.build_decide_tools_batch_messages([queries[index] for index in pending]), temperature=0.0,
+                    stage="decide_tool", answer=answer
+                )
+            except Exception as e:
+                # Il gruppo non va perso: le domande vengono instradate una per una
+                self.logger.warning("Routing a più domande fallito, fallback singolo: %s", e)
+            else:
+                for position, tool in self.parse_tools_batch_response(content, len(pending)).items():
+                    tools[pending[position]] = tool
+                    await self.cache.aset(self.routing_cache_key(queries[pending[position]], answer.model), tool)
+                    self.router.record(queries[pending[position]], tool)
+        elif pending:
+            index = pending[0]
+            try:
+                tools[index] = await self.inflight_decide_tool.do(normalize_query(queries[index]), self._adecide_tool, queries[index])
+            except Exception as e:
+                tools[index] = e
+
+        missing = [index for index in range(len(queries)) if index not in tools]
+        if missing:
+            tracing.info("Routing a più domande incompleto, fallback singolo per %d domande", len(missing))
+            JSON_PARSE_FALLBACKS.inc(len(missing), stage="decide_tool_batch")
+            fallback = await asyncio.gather(
+                *(self.adecide_tool(queries[index]) for index in missing), return_exceptions=True
+            )
+            tools.update(zip(missing, fallback))
+
+        for index, route in routes.items():
+            if index not in missing and not isinstance(tools[index], Exception):
+                self.router.compare(route, tools[index], "escalation")
+
+        return [tools[index] for index in range(len(queries))]
+
+    def prepare_search(self, filters, k=None):
+        """Costruisce il filtro Qdrant e il numero di risultati da recuperare."""
 
         if k is None:
             k = self.config["agent"]["top_k_results"]
@@ -130,26 +391,26 @@ class VegaMindAgent:
         qdrant_filter = None
         if filters:
             qdrant_filter = self.build_qdrant_filter(filters)
-            print(f"[STEP] Filtro Qdrant costruito: {qdrant_filter}\n")
+            tracing.debug("Filtro Qdrant costruito", qdrant_filter=lambda: str(qdrant_filter))
 
-        print(f"[STEP] Ricerca nei documenti più rilevanti in Qdrant (Top {k} risultati)...\n")
-        
-        try:
-            # Esegui una ricerca basata solo sui filtri
-            search_result = self.qdrant_handler.search_with_filters(qdrant_filter, k)
-            print(f"[OK] {len(search_result)} documenti trovati!\n")
-        except Exception as e:
-            print(f"[ERRORE] Errore durante la ricerca con filtri: {e}")
-            return "", ""  # Restituisci due stringhe vuote in caso di errore
+        tracing.debug("Ricerca in Qdrant (top %d risultati)", k)
+        return qdrant_filter, k
+
+    def extract_context(self, search_result):
+        """
+        Estrae nomi dei piatti, ingredienti e tecniche dai risultati della ricerca,
+        con il riassunto di ogni piatto (calcolato al volo per i punti caricati senza `summary`).
+        """
 
-       # Estrai i nomi dei piatti, ingredienti e tecniche dai risultati
         dish_names = set()  # Usiamo un set per evitare duplicati
         ingredients = set()  # Set per evitare duplicati negli ingredienti
         techniques = set()  # Set per evitare duplicati nelle tecniche
+        summaries = {}  # Riassunti nell'ordine dei risultati
 
         for result in search_result:
             if "dish" in result.payload:
                 dish_names.add(result.payload["dish"])
+                summaries.setdefault(result.payload["dish"].strip(), result.payload.get("summary") or dish_summary(result.payload))
             if "ingredients" in result.payload:
                 ingredients.update(result.payload["ingredients"])  # Aggiungi gli ingredienti al set
             if "techniques" in result.payload:
@@ -160,17 +421,32 @@ class VegaMindAgent:
         ingredients_str = ", ".join(ingredients)  # Unisci gli ingredienti in una stringa separata da virgole
         techniques_str = ", ".join(techniques)  # Unisci le tecniche in una stringa separata da virgole
 
-        print(f"[STEP] Nomi dei piatti estratti: {dish_names_str}\n")
-        print(f"[STEP] Ingredienti estratti: {ingredients_str}\n")
-        print(f"[STEP] Tecniche estratte: {techniques_str}\n")
+        tracing.debug("Contesto estratto", dishes=dish_names_str, ingredients=ingredients_str, techniques=techniques_str)
 
         # Normalizza i nomi dei piatti
         dishes = [dish.strip() for dish in dish_names_str.split(',') if dish.strip()]
 
-        return dishes, ingredients_str, techniques_str
+        return dishes, ingredients_str, techniques_str, summaries
+
+    async def aretrieve_relevant_context(self, filters, k=None):
+        """Recupera i nomi dei piatti rilevanti dalla knowledge base (AsyncQdrantClient) utilizzando solo i filtri."""
+
+        qdrant_filter, k = self.prepare_search(filters, k)
+
+        try:
+            search_result = await self.qdrant_handler.asearch_with_filters(qdrant_filter, k)
+            tracing.info("%d documenti trovati", len(search_result))
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception as e:
+            self.logger.error("Errore durante la ricerca con filtri: %s", e)
+            return [], "", "", {}
+
+        return self.extract_context(search_result)
 
 
     
+    @timed("build_qdrant_filter")
     def build_qdrant_filter(self, filters):
         """Costruisce un filtro Qdrant basato sui filtri generati dal modello LLM, gestendo sia AND che OR."""
         
@@ -179,12 +455,12 @@ class VegaMindAgent:
             try:
                 filters = json.loads(filters)  # Converte la stringa JSON in un dizionario
             except json.JSONDecodeError as e:
-                print("Errore nel parsing del JSON:", e)
+                self.logger.warning("Errore nel parsing del JSON: %s", e)
                 return None
 
         # Verifica che filters sia un dizionario
         if not isinstance(filters, dict):
-            print("Errore: filters non è un dizionario.")
+            self.logger.warning("I filtri non sono un dizionario: %r", filters)
             return None
 
         def normalize_value(value):
@@ -195,14 +471,15 @@ class VegaMindAgent:
                 return [v.lower() if isinstance(v, str) else v for v in value]
             return value
 
-        # Estrai min_should_count dal dizionario filters, se presente
-        min_should_count = 1  # Valore predefinito
-        if "min_should_count" in filters:
-            min_should_count = filters.pop("min_should_count")  # Rimuoviamo questa chiave per non confonderla con i filtri
+        # Estrai min_should_count dal dizionario filters, se presente (senza modificarlo: può essere condiviso
+        # tra richieste coalescenti o con le cache)
+        min_should_count = filters.get("min_should_count", 1)
 
         # Normalizza solo i valori di 'ingredients' e 'techniques'
         normalized_filters = {}
         for operator, conditions in filters.items():
+            if operator == "min_should_count":
+                continue  # Non è un operatore
             normalized_conditions = {}
             for key, values in conditions.items():
                 if key in ["ingredients", "techniques"]: # Applica la normalizzazione solo a questi campi
@@ -405,78 +682,190 @@ class VegaMindAgent:
     
     def get_planets_within_distance(self, planet, max_distance):
         """Restituisce i pianeti entro una certa distanza da un pianeta specifico."""
-        if planet not in self.distances_df.columns:
-            print(f"[ERRORE] Pianeta '{planet}' non trovato nel file delle distanze.")
+        catalog = self.catalog.current()
+        if catalog.planets.id(planet) is None:
+            self.logger.warning("Pianeta '%s' non trovato nel file delle distanze", planet)
             return []
-        
-        # Seleziona i pianeti entro la distanza data
-        planets_within_range = self.distances_df.loc[self.distances_df[planet] <= max_distance].index.tolist()
 
-        # Restituisci i nomi dei pianeti
-        return planets_within_range
+        # Seleziona i pianeti entro la distanza data
+        return catalog.planets_within(planet, max_distance)
 
+    @timed("get_dish_ids")
     def get_dish_ids(self, dish_names):
         """Converte i nomi dei piatti in ID."""
-        print("\n[STEP] Conversione dei nomi dei piatti in ID...\n")
-        dish_ids = [str(self.dish_mapping[name]) for name in dish_names if name in self.dish_mapping]
-        print("[OK] ID piatti trovati:", dish_ids, "\n")
+        catalog = self.catalog.current()
+        codes = (catalog.dish_code(name) for name in dish_names)
+        dish_ids = [str(code) for code in codes if code is not None]
+        tracing.debug("ID piatti trovati", dish_ids=dish_ids)
         return dish_ids
 
     def process_query(self, row_id, query, chat=False):
-        """Elabora una query e restituisce il risultato finale."""
-        
-        time.sleep(10)
-        
-        print(f"\n[PROCESS] Inizio elaborazione della query: {query}\n")
-        
-        # Chiediamo al LLM quale tool usare
-        selected_tool = self.decide_tool(query)
-        print("selected_tool", selected_tool)
+        """
+        Versione sincrona di aprocess_query (script e notebook), con lo stesso percorso: la query viene elaborata
+        sull'event loop dedicato dell'agent, perché client asincroni e rate limiter restano legati al loop che li usa.
+        """
+        return asyncio.run_coroutine_threadsafe(self.aprocess_query(row_id, query, chat), self._sync_loop()).result()
+
+    def _sync_loop(self):
+        """Event loop (in un thread in background) delle chiamate sincrone, creato al primo uso."""
+        with self._sync_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="agent-sync-loop", daemon=True).start()
+            return self._loop
+
+    async def aprocess_query(self, row_id, query, chat=False):
+        """Elabora una query e restituisce il risultato finale; LLM e Qdrant non bloccano l'event loop."""
+
+        tracing.info("Inizio elaborazione della query", query=query)
+
+        selected_tool, filters = await self.aresolve_filters(query)
+
+        return await self.afinalize_query(row_id, query, selected_tool, filters, chat)
+
+    async def aplan_query(self, query):
+        """
+        Tool scelto e, se il planner li ha già generati, i filtri (None = da generare con il tool).
+        Il planner entra in gioco solo quando il router locale non decide da solo.
+        """
+        route = self.local_route(query)
+        if route is not None and route.tool is not None:
+            return await self.adecide_tool(query, route), None
+        if not self.planner.enabled:
+            if self.speculation:
+                return await self.aspeculate(query, route)
+            return await self.adecide_tool(query, route), None
+
+        plan = await self.planner.aplan(query)
+        if plan.tool is None:
+            # Piano non valido: routing e filtri con il percorso in due passi
+            return await self.adecide_tool(query, route), None
+
+        self.router.record(query, plan.tool)
+        self.router.compare(route, plan.tool, "escalation")
+        return plan.tool, plan.filters
+
+    async def aspeculate(self, query, route):
+        """
+        Routing e generazione dei filtri in parallelo: i tool probabili (l'ipotesi del router locale,
+        altrimenti generate_filters; con `tools: all` tutti i tool) partono insieme alla scelta del LLM.
+        Il tool scelto tiene i suoi filtri, gli altri vengono cancellati e i loro token contati come spreco.
+        """
+        tool = await self.cache.aget(self.routing_cache_key(query))
+        if tool is not None:
+            # Routing già noto: non serve speculare
+            self.router.compare(route, tool, "escalation")
+            return tool, None
+
+        if self.speculation_tools == "all":
+            guesses = list(self.tools)
+        else:
+            guess = route.guess if route is not None and route.guess in self.tools else "generate_filters"
+            guesses = [guess] if guess in self.tools else []
+
+        async def speculate(tool_name, usage):
+            track_usage(usage)
+            started = time.monotonic()
+            filters = await self.tools[tool_name].aexecute(query)
+            return filters, time.monotonic() - started
+
+        usage = {tool_name: TokenUsage() for tool_name in guesses}
+        tasks = {tool_name: asyncio.create_task(speculate(tool_name, usage[tool_name])) for tool_name in guesses}
+        started = time.monotonic()
+        try:
+            tool = await self.adecide_tool(query, route)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+                # Evita il warning "exception was never retrieved" per i task già falliti
+                task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            raise
+        routing_time = time.monotonic() - started
+
+        losers = [tool_name for tool_name in tasks if tool_name != tool]
+        for tool_name in losers:
+            tasks[tool_name].cancel()
+        await asyncio.gather(*(tasks[tool_name] for tool_name in losers), return_exceptions=True)
+        for tool_name in losers:
+            if usage[tool_name].tokens:
+                SPECULATION_WASTED_TOKENS.inc(usage[tool_name].tokens, tool=tool_name)
+
+        if tool not in tasks:
+            SPECULATION_RESULTS.inc(result="none" if not tool or tool == "none" else "miss")
+            return tool, None
+
+        filters, filters_time = await tasks[tool]
+        # In sequenza: routing + filtri; in parallelo: il più lento dei due
+        saved = min(routing_time, filters_time)
+        SPECULATION_RESULTS.inc(result="hit")
+        SPECULATION_SAVED.inc(saved)
+        tracing.info("Filtri speculativi usati", tool=tool, saved_ms=round(saved * 1000))
+        return tool, filters
+
+    async def aresolve_filters(self, query):
+        """Tool e filtri della query: da una domanda simile già elaborata, dal planner oppure con routing e tool."""
+        probe = await self.semantic_cache.aprobe(query, self.semantic_template())
+        reused = self.reuse_filters(probe)
+        if reused:
+            return reused
+
+        # Chiediamo al LLM quale tool usare (e, in modalità planner, anche i filtri)
+        selected_tool, filters = await self.aplan_query(query)
+
+        # Se il tool è stato selezionato, esegui il tool
+        if selected_tool and selected_tool != 'none':
+            if filters is None:
+                filters = await self.tools[selected_tool].aexecute(query)
+            tracing.debug("Filtri generati", filters=filters)
+            self.semantic_cache.add(probe, query, selected_tool, filters)
+
+        return selected_tool, filters
+
+    async def afinalize_query(self, row_id, query, selected_tool, filters, chat=False):
+        """Completa l'elaborazione di una query dati il tool scelto e i filtri generati."""
 
         # Verifica se il tool selezionato è None
         if not selected_tool or selected_tool == 'none':
-            logging.debug(f"Selected tool is None. Proceeding with empty parameters.")
+            tracing.debug("Nessun tool selezionato")
             
             # Se il tool selezionato è None, gestisci il caso senza filtro
             if chat:
-                response = self.get_dish_response(query, dishes="", ingredients_str="", techniques_str="")
-                logging.debug(f"Response from get_dish_response: {response}")
+                response = self.template_answer(query, "", {}) or await self.aget_dish_response(
+                    query, dishes="", ingredients_str="", techniques_str=""
+                )
+                tracing.debug("Risposta generata", response=response)
                 return {
                     "success": True,
                     "result": response
                 }
             
-            logging.debug(f"No filters found for the request.")
+            EMPTY_RESULTS.inc(reason="no_tool")
             return {
                 "success": False,
                 "result": "Nessun filtro trovato per la tua richiesta."
             }
 
-        # Se il tool è stato selezionato, esegui il tool
-        logging.debug(f"Selected tool: {selected_tool}")
-        filters = self.tools[selected_tool].execute(query)
-        logging.debug(f"Filtri generati: {filters}")
-
         # Se i filtri sono vuoti, restituisci un messaggio di errore
         if not filters:
-            logging.debug(f"No filters generated, returning error.")
+            EMPTY_RESULTS.inc(reason="no_filters")
             return {
                 "success": False,
                 "result": "Nessun filtro generato per la tua richiesta."
             }
 
         # Recupero contesto basato sui filtri
-        dish_names, ingredients_str, techniques_str = self.retrieve_relevant_context(filters)
-        logging.debug(f"Dish names: {dish_names}, Ingredients: {ingredients_str}, Techniques: {techniques_str}")
+        dish_names, ingredients_str, techniques_str, summaries = await self.aretrieve_relevant_context(filters)
 
         # Logica per la chat
         if chat:
             if dish_names:
-                response = self.get_dish_response(query, dish_names, ingredients_str, techniques_str)
-                logging.debug(f"Response with dishes found: {response}")
+                response = self.template_answer(query, dish_names, summaries) or await self.aget_dish_response(
+                    query, dish_names, ingredients_str, techniques_str
+                )
+                tracing.debug("Risposta generata", response=response)
             else:
                 response = "Mi dispiace, non ho trovato piatti correlati alla tua richiesta."
-                logging.debug(f"No dishes found, response: {response}")
+                EMPTY_RESULTS.inc(reason="no_dishes")
             
             return {
                 "success": True,
@@ -485,24 +874,116 @@ class VegaMindAgent:
 
         # Se non è chat, trattiamo la conversione in ID
         dish_ids = self.get_dish_ids(dish_names)
-        logging.debug(f"Dish IDs: {dish_ids}")
 
         if not dish_ids:
-            logging.debug(f"No dish IDs found, returning error.")
+            EMPTY_RESULTS.inc(reason="no_dish_ids")
             return {
                 "success": False,
                 "result": "Nessun piatto trovato."
             }
 
-        logging.debug(f"[PROCESS] Elaborazione completata! Risultato finale: {dish_ids}")
+        tracing.info("Elaborazione completata", dish_ids=dish_ids)
 
         return {
             "row_id": row_id,
             "result": ",".join(dish_ids)
         }
         
-    def get_dish_response(self, query, dishes, ingredients_str, techniques_str):
-        """Genera una risposta confermando la richiesta dell'utente sui piatti cercati, includendo descrizioni, ingredienti e tecniche."""
+    async def aprocess_queries(self, items, chat=False):
+        """
+        Elabora più query riducendo le chiamate al LLM: routing e generazione dei filtri
+        vengono fatti con un solo prompt per gruppo di domande, con fallback singolo per
+        gli elementi la cui risposta non è valida. Un errore di routing o di generazione dei filtri
+        produce il risultato di errore solo per la domanda interessata.
+
+        :param items: Lista di coppie (row_id, query).
+        :return: Lista di risultati nello stesso ordine di `items`.
+        """
+        queries = [query for _, query in items]
+        selected_tools = [None] * len(items)
+        filters = [None] * len(items)
+
+        # Le domande simili a domande già elaborate riutilizzano tool e filtri e non entrano nei prompt
+        probes = await self.semantic_cache.aprobe_many(queries, self.semantic_template())
+        pending = []
+        for index, probe in enumerate(probes):
+            reused = self.reuse_filters(probe)
+            if reused:
+                selected_tools[index], filters[index] = reused
+            else:
+                pending.append(index)
+
+        # Errori per domanda: un routing o una generazione di filtri fallita non fa perdere il resto del gruppo
+        errors = {}
+        if pending:
+            routed = await self.adecide_tools_batch([queries[index] for index in pending])
+            for index, tool_name in zip(pending, routed):
+                if isinstance(tool_name, Exception):
+                    errors[index] = tool_name
+                else:
+                    selected_tools[index] = tool_name
+
+        # Raggruppa le domande per tool, così ogni tool riceve un solo prompt
+        by_tool = {}
+        for index in pending:
+            tool_name = selected_tools[index]
+            if tool_name and tool_name != 'none':
+                by_tool.setdefault(tool_name, []).append(index)
+
+        async def run_tool(tool_name, indexes):
+            tool = self.tools[tool_name]
+            tool_queries = [queries[index] for index in indexes]
+            tool_filters = None
+            if hasattr(tool, "aexecute_batch"):
+                try:
+                    tool_filters = await tool.aexecute_batch(tool_queries)
+                except Exception as e:
+                    self.logger.warning("Filtri a più domande falliti per %s, fallback singolo: %s", tool_name, e)
+            if tool_filters is None:
+                tool_filters = await asyncio.gather(*(tool.aexecute(query) for query in tool_queries), return_exceptions=True)
+            for index, value in zip(indexes, tool_filters):
+                if isinstance(value, Exception):
+                    errors[index] = value
+                else:
+                    filters[index] = value
+
+        await asyncio.gather(*(run_tool(tool_name, indexes) for tool_name, indexes in by_tool.items()))
+        for index in pending:
+            if index not in errors:
+                self.semantic_cache.add(probes[index], queries[index], selected_tools[index], filters[index])
+
+        def error_result(row_id, e):
+            self.logger.error(f"Errore nell'elaborazione della query {row_id}: {e}")
+            return {
+                "success": False,
+                "result": f"Errore durante l'elaborazione: {e}",
+                "error": str(e)
+            }
+
+        async def finalize(index, row_id, query):
+            if index in errors:
+                return error_result(row_id, errors[index])
+            try:
+                return await self.afinalize_query(row_id, query, selected_tools[index], filters[index], chat)
+            except Exception as e:
+                return error_result(row_id, e)
+
+        return list(await asyncio.gather(*(
+            finalize(index, row_id, query) for index, (row_id, query) in enumerate(items)
+        )))
+
+    def template_answer(self, query, dishes, summaries):
+        """Risposta composta dai riassunti dei piatti secondo la modalità configurata (None = la formula il LLM)."""
+        if not self.answers.use_template(query, dishes):
+            ANSWERS.inc(mode="llm")
+            return None
+        ANSWERS.inc(mode="template")
+        response = self.answers.render(dishes, summaries)
+        tracing.debug("Risposta da template", response=response)
+        return response
+
+    def build_dish_response_prompt(self, query, dishes, ingredients_str, techniques_str):
+        """Costruisce il prompt per la risposta in chat sui piatti trovati."""
 
         # Se c'è un solo piatto, struttura la risposta al singolare
         if isinstance(dishes, str):
@@ -545,23 +1026,140 @@ class VegaMindAgent:
         **Utente chiede:** {query}
         **Risposta:** "{', '.join(dishes)}"
         """
+        return prompt
+
+    def dish_response_cache_key(self, query, dishes, model=None):
+        """
+        Chiave di cache della risposta in chat: domanda normalizzata e insieme dei piatti trovati.
+        La versione del catalogo fa parte dell'impronta: una nuova ingestion invalida le risposte.
+        `model` è il modello che ha risposto (predefinito: quello di Groq).
+        """
+        template = fingerprint(
+            self.build_dish_response_prompt("{query}", ["{dish}"], "{ingredients}", "{techniques}"),
+            self.catalog.current().version
+        )
+        dish_set = sorted(set(dishes)) if isinstance(dishes, list) else dishes
+        return self.cache.key(
+            "get_dish_response", template, model or self.llm.model_name("groq"), [normalize_query(query), dish_set]
+        )
+
+    @timed("get_dish_response")
+    @deadline.with_deadline("get_dish_response")
+    async def aget_dish_response(self, query, dishes, ingredients_str, techniques_str):
+        """Genera una risposta confermando la richiesta dell'utente sui piatti cercati, includendo descrizioni, ingredienti e tecniche."""
 
+        cache_key = self.dish_response_cache_key(query, dishes)
+        cached = await self.cache.aget(cache_key)
+        if cached is not None:
+            return cached
 
-        # Chiamata al modello per generare la risposta
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
+        prompt = self.build_dish_response_prompt(query, dishes, ingredients_str, techniques_str)
+
+        answer = Answer()
+        content = await self.llm.achat(
+            "groq", [{"role": "user", "content": prompt}], temperature=0.2, stage="get_dish_response", answer=answer
         )
 
-        # Estrai la risposta dal modello
-        response_content = response.choices[0].message.content.strip()
-        
-        # Rimuovi eventuali tag <think>...</think>
-        if "<think>" in response_content and "</think>" in response_content:
-            response_content = response_content.split("</think>")[-1].strip()
+        response = strip_think(content)
+        await self.cache.aset(self.dish_response_cache_key(query, dishes, answer.model), response or None)
+        return response
+
+    async def astream_dish_response(self, query, dishes, ingredients_str, techniques_str):
+        """
+        Versione in streaming di aget_dish_response: il blocco <think> viene filtrato al volo.
+        Una risposta in cache viene emessa in un solo frammento; una risposta completa viene memorizzata.
+        """
+
+        cache_key = self.dish_response_cache_key(query, dishes)
+        cached = await self.cache.aget(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        prompt = self.build_dish_response_prompt(query, dishes, ingredients_str, techniques_str)
+        think_filter = ThinkFilter()
+        parts = []
+        answer = Answer()
+
+        with track_stage("get_dish_response"):
+            pieces = self.llm.astream(
+                "groq", [{"role": "user", "content": prompt}], temperature=0.2, stage="get_dish_response", answer=answer
+            )
+            async for piece in deadline.iterate("get_dish_response", pieces):
+                text = think_filter.feed(piece)
+                if text:
+                    parts.append(text)
+                    yield text
+
+        tail = think_filter.flush()
+        if tail:
+            parts.append(tail)
+            yield tail
+
+        await self.cache.aset(self.dish_response_cache_key(query, dishes, answer.model), "".join(parts).strip() or None)
+
+    async def astream_query(self, query):
+        """
+        Elabora una query in modalità chat emettendo eventi man mano che le fasi terminano.
 
-        return response_content
+        Genera coppie (evento, dati): "tool", "filters", "dishes", poi un "token" per ogni
+        frammento della risposta e infine "done" con la risposta completa.
+        """
+        tracing.info("Inizio elaborazione della query (streaming)", query=query)
+
+        probe = await self.semantic_cache.aprobe(query, self.semantic_template())
+        reused = self.reuse_filters(probe)
+
+        selected_tool, filters = reused or await self.aplan_query(query)
+        yield "tool", {"tool": selected_tool}
+
+        dish_names, ingredients_str, techniques_str, summaries = "", "", "", {}
+
+        if selected_tool and selected_tool != 'none':
+            if not reused:
+                if filters is None:
+                    filters = await self.tools[selected_tool].aexecute(query)
+                self.semantic_cache.add(probe, query, selected_tool, filters)
+            yield "filters", {"filters": filters}
+
+            if not filters:
+                EMPTY_RESULTS.inc(reason="no_filters")
+                yield "done", {"success": False, "result": "Nessun filtro generato per la tua richiesta."}
+                return
+
+            dish_names, ingredients_str, techniques_str, summaries = await self.aretrieve_relevant_context(filters)
+            yield "dishes", {"dishes": dish_names}
+
+            if not dish_names:
+                response = "Mi dispiace, non ho trovato piatti correlati alla tua richiesta."
+                EMPTY_RESULTS.inc(reason="no_dishes")
+                yield "token", {"text": response}
+                yield "done", {"success": True, "result": response}
+                return
+
+        response = self.template_answer(query, dish_names, summaries)
+        if response is not None:
+            yield "token", {"text": response}
+            yield "done", {"success": True, "result": response}
+            return
+
+        parts = []
+        async for text in self.astream_dish_response(query, dish_names, ingredients_str, techniques_str):
+            parts.append(text)
+            yield "token", {"text": text}
+
+        yield "done", {"success": True, "result": "".join(parts)}
+
+    async def aclose(self):
+        """Chiude i client asincroni di agent, tool e Qdrant."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._owns_llm:
+            await self.llm.aclose()
+        for tool in self.tools.values():
+            if hasattr(tool, "aclose"):
+                await tool.aclose()
+        await self.qdrant_handler.aclose()
 
     # Mi sarebbe piaciuto effettuare un check intermedio per validare la risposta.
     # Una sorta di "2 Step Verification", ma non ci sono arrivato con i tempi e ho inserito tutte le istruzioni nel prompt principale.
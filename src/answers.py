@@ -0,0 +1,95 @@
+import re
+from src.catalog import normalize_text
+from src.metrics import REGISTRY
+
+ANSWERS = REGISTRY.counter(
+    "vegamind_answers_total", "Risposte in chat per modalità (template: senza LLM, llm: aget_dish_response).", ["mode"])
+
+MODES = ("llm", "template", "auto")
+
+# Domande aperte (spiegazioni, consigli, confronti): in modalità auto le risponde il LLM
+OPEN_ENDED = re.compile(
+    r"\b(perche|perché|come mai|come si|spiega\w*|raccont\w*|consigl\w*|suggeri\w*|differenz\w*|confront\w*|"
+    r"paragon\w*|descriv\w*|storia|parlami|cosa ne pensi|quale scegliere|migliore)\b"
+)
+
+NO_TOOL = (
+    "Posso aiutarti a trovare piatti per ingredienti, tecniche, ristoranti, pianeti o licenze degli chef. "
+    "Prova a riformulare la richiesta indicando cosa cerchi."
+)
+
+
+def names(values):
+    """Elenco leggibile di nomi: "a, b e c"."""
+    values = [str(value) for value in values if value]
+    if len(values) <= 1:
+        return "".join(values)
+    return f"{', '.join(values[:-1])} e {values[-1]}"
+
+
+def dish_summary(payload):
+    """
+    Riassunto di un piatto dai suoi metadati (payload Qdrant): nome, ristorante e pianeta, ingredienti e tecniche.
+    Calcolato in ingestion e salvato nel payload come `summary`.
+    """
+    summary = payload.get("dish") or "Piatto senza nome"
+    planets = payload.get("planet") or []
+    planets = [planet for planet in (planets if isinstance(planets, list) else [planets]) if planet]
+    place = [payload["restaurant_name"]] if payload.get("restaurant_name") else []
+    if planets:
+        place.append(f"{'pianeta' if len(planets) == 1 else 'pianeti'} {names(planets)}")
+    if place:
+        summary += f" ({', '.join(place)})"
+    details = []
+    if payload.get("ingredients"):
+        details.append(f"ingredienti: {names(payload['ingredients'])}")
+    if payload.get("techniques"):
+        details.append(f"tecniche: {names(payload['techniques'])}")
+    if details:
+        summary += f" - {'; '.join(details)}"
+    return summary + "."
+
+
+class AnswerRenderer:
+    """
+    Modalità delle risposte in chat:
+
+    - llm: ogni risposta viene formulata da `aget_dish_response`;
+    - template: le risposte vengono composte dai riassunti dei piatti, senza chiamate al LLM;
+    - auto: template quando la ricerca ha trovato piatti e la domanda non è aperta (spiegazioni, consigli,
+      confronti), LLM negli altri casi (domande aperte o senza tool).
+    """
+
+    def __init__(self, mode="llm", max_dishes=10):
+        if mode not in MODES:
+            raise ValueError(f"Modalità delle risposte sconosciuta: {mode}")
+        self.mode = mode
+        self.max_dishes = max(1, int(max_dishes))
+
+    @classmethod
+    def from_config(cls, config):
+        answers_config = config.get("answers", {})
+        return cls(mode=answers_config.get("mode", "llm"), max_dishes=answers_config.get("max_dishes", 10))
+
+    def use_template(self, query, dishes):
+        """True se la risposta va composta dai template invece che dal LLM."""
+        if self.mode != "auto":
+            return self.mode == "template"
+        return bool(dishes) and OPEN_ENDED.search(normalize_text(query)) is None
+
+    def render(self, dishes, summaries):
+        """Risposta con i piatti trovati, nell'ordine dei risultati della ricerca (senza piatti: nessun tool scelto)."""
+        if not dishes:
+            return NO_TOOL
+        found = set(dishes)
+        ordered = [dish for dish in summaries if dish in found]
+        ordered += [dish for dish in dishes if dish not in summaries]
+        lines = [summaries.get(dish) or f"{dish}." for dish in ordered[:self.max_dishes]]
+
+        if len(ordered) == 1:
+            return f"Ecco il piatto che cercavi: {lines[0]}"
+        text = f"Ho trovato {len(ordered)} piatti per la tua richiesta:\n" + "\n".join(f"- {line}" for line in lines)
+        others = len(ordered) - self.max_dishes
+        if others > 0:
+            text += "\n... e un altro piatto." if others == 1 else f"\n... e altri {others} piatti."
+        return text
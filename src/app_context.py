@@ -0,0 +1,173 @@
+import logging
+import threading
+from src import deadline, tracing
+from src.catalog import CatalogStore
+from src.llm_gateway import LLMGateway
+from src.response_cache import ResponseCache
+from src.semantic_cache import SemanticCache
+from src.router import ToolRouter
+from src.embedding import EmbeddingHandler
+from src.config_loader import ConfigLoader
+from src.qdrant_client import QdrantHandler
+from src.rate_limiter import RateLimiterRegistry
+from src.profiler import Profiler
+from src.scheduler import PriorityScheduler
+from src.singleflight import SingleFlight
+from src.jobs import JobManager
+from src.agent import VegaMindAgent
+from src.tools.tool_generate_filters import ToolGenerateFilters
+from src.tools.tool_generate_filters_sirius import ToolGenerateFiltersSirius
+
+
+class AppContext:
+    """
+    Contenitore delle risorse condivise dall'applicazione FastAPI.
+
+    Agent, tool e client Qdrant vengono costruiti una sola volta all'avvio
+    (configurazione, CSV e JSON letti una volta sola) e riutilizzati da tutti gli endpoint.
+    """
+
+    def __init__(self, config_path="config/config.yaml"):
+        self.logger = logging.getLogger(__name__)
+        self.config_path = config_path
+        self.config = None
+        self.qdrant_handler = None
+        self.catalog = None
+        self.rate_limiters = None
+        self.llm = None
+        self.cache = None
+        self.semantic_cache = None
+        self.router = None
+        self.tools = {}
+        self.agent = None
+        self.jobs = None
+        self.scheduler = None
+        self.inflight_queries = None
+        self.profiler = None
+
+        # Stato del warm-up (usato dalla readiness probe)
+        self._ready = threading.Event()
+        self._closing = threading.Event()
+        self.warmup_error = None
+
+    @property
+    def ready(self):
+        """True solo quando il warm-up è terminato con successo."""
+        return self._ready.is_set()
+
+    def build(self):
+        """Carica la configurazione e costruisce client, tool e agent."""
+        print("\n[INIT] Costruzione del contesto applicativo...\n")
+        self.config = ConfigLoader(self.config_path).get_config()
+        tracing.configure(self.config)
+        deadline.configure(self.config)
+
+        self.qdrant_handler = QdrantHandler(config=self.config)
+
+        # Catalogo versionato mappato in memoria: tutti i worker leggono le stesse pagine e passano
+        # alla nuova versione pubblicata da /setup_db/ senza riavvio
+        self.catalog = CatalogStore.from_config(self.config)
+        self.catalog.ensure(self.config)
+
+        # Un unico registro di rate limiter: agent e tool condividono la quota di ogni provider
+        self.rate_limiters = RateLimiterRegistry(self.config)
+        # Un unico gateway LLM: pool di connessioni keep-alive per provider condivisi da agent, tool e ingestion
+        self.llm = LLMGateway(self.config, self.rate_limiters)
+        # Cache delle risposte deterministiche (routing, filtri, risposte in chat) condivisa da agent e tool
+        self.cache = ResponseCache.from_config(self.config)
+        # Cache semantica: il modello di embedding viene caricato al warm-up
+        self.semantic_cache = SemanticCache.from_config(
+            self.config,
+            embedder_factory=lambda: EmbeddingHandler(self.config_path).generate_query_embedding,
+            catalog=self.catalog
+        )
+        # Router locale della scelta del tool, addestrato sulle decisioni del LLM
+        self.router = ToolRouter.from_config(self.config)
+
+        # Priorità tra richieste interattive e batch sugli stessi provider LLM
+        self.scheduler = PriorityScheduler.from_config(self.config)
+        # Query identiche in corso (es. starter della chat cliccati insieme) condividono una sola esecuzione
+        self.inflight_queries = SingleFlight("process_query")
+        # Profiling a campionamento su richiesta (disattivato di default)
+        self.profiler = Profiler.from_config(self.config)
+
+        # Inizializza i tool che VegaMindAgent può usare
+        self.tools = {
+            "generate_filters": ToolGenerateFilters(config=self.config, llm=self.llm, catalog=self.catalog, cache=self.cache),
+            "generate_filters_sirius": ToolGenerateFiltersSirius(config=self.config, llm=self.llm, catalog=self.catalog, cache=self.cache),
+        }
+
+        self.agent = VegaMindAgent(
+            tools=self.tools,
+            qdrant_handler=self.qdrant_handler,
+            config=self.config,
+            llm=self.llm,
+            catalog=self.catalog,
+            cache=self.cache,
+            semantic_cache=self.semantic_cache,
+            router=self.router
+        )
+        # Thread pool dei job (ingestion, batch) separato da quello che serve le query
+        jobs_config = self.config.get("jobs", {})
+        self.jobs = JobManager(
+            max_workers=jobs_config.get("max_workers", 1),
+            max_history=jobs_config.get("max_history", 100)
+        )
+        print("[OK] Contesto applicativo costruito!\n")
+        return self
+
+    def warmup(self):
+        """Esegue il warm-up delle risorse; la readiness diventa True solo al termine."""
+        app_config = self.config.get("app", {})
+        attempts = app_config.get("warmup_attempts", 5)
+        delay = app_config.get("warmup_retry_delay", 2)
+
+        for attempt in range(1, attempts + 1):
+            try:
+                self.agent.warmup()
+                self.warmup_error = None
+                self._ready.set()
+                print("[OK] Warm-up completato, servizio pronto.\n")
+                return True
+            except Exception as e:
+                self.warmup_error = str(e)
+                self.logger.error(f"Warm-up fallito (tentativo {attempt} di {attempts}): {e}")
+                # Attesa interrompibile: lo spegnimento dell'app non resta bloccato sul warm-up
+                if attempt < attempts and self._closing.wait(delay * attempt):
+                    break
+        return False
+
+    def close(self):
+        """Rilascia le risorse aperte (connessioni verso Qdrant, cache su disco)."""
+        self._ready.clear()
+        self._closing.set()
+        if self.jobs is not None:
+            self.jobs.shutdown()
+        if self.qdrant_handler is not None and hasattr(self.qdrant_handler, "client"):
+            try:
+                self.qdrant_handler.client.close()
+            except Exception as e:
+                self.logger.warning(f"Errore nella chiusura del client Qdrant: {e}")
+        if self.cache is not None:
+            self.cache.close()
+        if self.router is not None:
+            self.router.close()
+        if self.semantic_cache is not None:
+            try:
+                self.semantic_cache.save()
+            except Exception as e:
+                self.logger.warning(f"Errore nel salvataggio della cache semantica: {e}")
+
+    async def aclose(self):
+        """Rilascia anche i client asincroni (gateway LLM, Qdrant) usati dal percorso non bloccante."""
+        self.close()
+        if self.agent is not None:
+            try:
+                await self.agent.aclose()
+            except Exception as e:
+                self.logger.warning(f"Errore nella chiusura dei client asincroni: {e}")
+        if self.llm is not None:
+            try:
+                await self.llm.aclose()
+            except Exception as e:
+                self.logger.warning(f"Errore nella chiusura del gateway LLM: {e}")
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+
+
+class BatchExecutor:
+    """
+    Esegue un lavoro asincrono su una lista di elementi con concorrenza limitata.
+
+    Il ritmo effettivo è dettato dai rate limiter dei provider LLM: l'executor si limita
+    a tenere al massimo `max_concurrency` elementi in volo e a restituire i risultati
+    nell'ordine originale degli elementi.
+    """
+
+    def __init__(self, max_concurrency=4):
+        self.logger = logging.getLogger(__name__)
+        self.max_concurrency = max(1, int(max_concurrency))
+
+    async def run(self, items, worker, on_result=None):
+        """
+        Applica `worker(item)` a tutti gli elementi.
+
+        :param items: Lista di elementi da elaborare.
+        :param worker: Coroutine function che elabora un singolo elemento.
+        :param on_result: Callback opzionale `on_result(item, result)` chiamata nell'ordine degli elementi,
+                          appena tutti i precedenti sono completati.
+        :return: Lista di risultati nello stesso ordine di `items` (None per gli elementi falliti).
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = [None] * len(items)
+        done = [False] * len(items)
+        next_to_emit = 0
+
+        async def run_one(index, item):
+            nonlocal next_to_emit
+            async with semaphore:
+                try:
+                    results[index] = await worker(item)
+                except Exception as e:
+                    self.logger.error(f"Errore nell'elaborazione dell'elemento {index}: {e}")
+            done[index] = True
+
+            # Emette in ordine tutti i risultati contigui già pronti
+            while next_to_emit < len(items) and done[next_to_emit]:
+                if on_result is not None:
+                    on_result(items[next_to_emit], results[next_to_emit])
+                next_to_emit += 1
+
+        await asyncio.gather(*(run_one(index, item) for index, item in enumerate(items)))
+        return results
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from src.metrics import REGISTRY
+
+CASSETTE_LOOKUPS = REGISTRY.counter(
+    "vegamind_llm_cassette_total", "Chiamate LLM registrate o riprodotte dalla cassetta per esito (recorded, hit, miss).",
+    ["provider", "result"])
+
+logger = logging.getLogger(__name__)
+
+MODES = ("off", "record", "replay")
+
+
+def normalize_prompt(text):
+    """Prompt senza differenze di spaziatura (indentazione dei template, righe vuote)."""
+    return " ".join((text or "").split())
+
+
+def cassette_key(provider, model, texts, temperature=None):
+    """
+    Hash di (provider, modello, testi dei messaggi normalizzati, temperatura).
+    Contano solo i testi, nell'ordine: Gemini riceve i messaggi come parti senza ruolo,
+    così la chiave si può calcolare anche dal lato del server stub.
+    """
+    payload = json.dumps(
+        [provider, model, [normalize_prompt(text) for text in texts], temperature],
+        ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CassetteMiss(Exception):
+    """Chiamata non presente nella cassetta in modalità replay (con `on_miss: error`)."""
+
+    def __init__(self, provider, key):
+        super().__init__(f"Chiamata a `{provider}` non registrata nella cassetta ({key[:12]})")
+        self.provider = provider
+        self.key = key
+
+
+class Cassette:
+    """
+    Registrazione e riproduzione delle chiamate LLM del gateway (file JSONL, una chiamata per riga).
+
+    - record: ogni risposta riuscita viene aggiunta al file con la sua chiave (l'ultima registrata vince);
+    - replay: le risposte vengono servite dal file senza contattare i provider; una chiamata mancante
+      solleva CassetteMiss (`on_miss: error`) o passa al provider (`on_miss: live`);
+    - off: nessun effetto.
+    Il file viene caricato all'avvio in entrambe le modalità attive.
+    """
+
+    def __init__(self, mode="off", path="data/cassettes/llm.jsonl", on_miss="error"):
+        # In YAML un `off` non quotato diventa False
+        mode = "off" if mode in (None, False) else mode
+        if mode not in MODES:
+            raise ValueError(f"Modalità della cassetta sconosciuta: {mode}")
+        self.mode = mode
+        self.path = path
+        self.on_miss = on_miss
+        self._entries = {}
+        self._lock = threading.Lock()
+        if mode != "off":
+            self._load()
+
+    @classmethod
+    def from_config(cls, config):
+        cassette_config = config.get("cassettes", {})
+        return cls(
+            mode=cassette_config.get("mode", "off"),
+            path=cassette_config.get("path", "data/cassettes/llm.jsonl"),
+            on_miss=cassette_config.get("on_miss", "error")
+        )
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("key") and isinstance(record.get("text"), str):
+                    self._entries[record["key"]] = record["text"]
+        logger.info("Cassetta `%s`: %d chiamate caricate", self.path, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def replay(self, calls, messages, temperature=None):
+        """
+        (provider, modello, risposta registrata) per la prima delle chiamate candidate [(provider, modello), ...]
+        presente nella cassetta; None se la chiamata va fatta al provider.
+        """
+        if not self.replaying:
+            return None
+        texts = [message.get("content", "") for message in messages]
+        keys = [(provider, model, cassette_key(provider, model, texts, temperature)) for provider, model in calls]
+        for provider, model, key in keys:
+            text = self._entries.get(key)
+            if text is not None:
+                CASSETTE_LOOKUPS.inc(provider=provider, result="hit")
+                return provider, model, text
+
+        provider, _, key = keys[0]
+        CASSETTE_LOOKUPS.inc(provider=provider, result="miss")
+        if self.on_miss != "live":
+            raise CassetteMiss(provider, key)
+        return None
+
+    def record(self, provider, model, messages, temperature, text):
+        """Aggiunge la risposta di una chiamata riuscita al file (solo in modalità record)."""
+        if not self.recording or text is None:
+            return
+        key = cassette_key(provider, model, [message.get("content", "") for message in messages], temperature)
+        line = json.dumps({
+            "key": key, "provider": provider, "model": model, "temperature": temperature,
+            "messages": messages, "text": text
+        }, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._entries[key] = text
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+        CASSETTE_LOOKUPS.inc(provider=provider, result="recorded")
@@ -0,0 +1,568 @@
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Formato del file (little endian):
+#   header:    magic (8 byte), versione del formato (u32), numero di sezioni (u32)
+#   directory: per ogni sezione nome (16 byte, ascii), offset (u64), lunghezza (u64)
+#   sezioni:   allineate a 8 byte
+MAGIC = b"VMCATLG\x00"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<16sQQ")
+NONE = 0xFFFFFFFF  # Riferimento assente (es. piatto senza ristorante)
+
+# Record a dimensione fissa: l'id di un'entità è la sua posizione nella tabella
+DISH = struct.Struct("<6I")          # codice, ristorante, inizio e numero ingredienti, inizio e numero tecniche
+RESTAURANT = struct.Struct("<3I")    # pianeta, inizio e numero licenze
+LICENSE = struct.Struct("<2I")       # tipo di licenza, grado
+
+ENTITIES = ("dishes", "ingredients", "techniques", "categories", "restaurants", "planets", "licenses")
+
+
+# Entità che si cercano nel testo delle domande
+MENTIONABLE = ("ingredients", "techniques", "categories", "restaurants", "planets", "licenses")
+
+
+# Parole frequenti nelle domande che non aiutano a scegliere le entità candidate di un prompt
+STOPWORDS = frozenset({
+    "piatto", "piatti", "quali", "quale", "sono", "preparati", "preparato", "contengono", "contiene",
+    "utilizzano", "utilizza", "usano", "usando", "tecnica", "tecniche", "ingrediente", "ingredienti",
+    "ristorante", "ristoranti", "pianeta", "pianeti", "licenza", "licenze", "grado", "almeno", "della",
+    "delle", "dello", "degli", "nella", "nelle", "sulla", "sulle", "anni", "luce", "distanza", "cucina",
+    "senza", "anche", "oppure", "tutti", "tutte", "manuale",
+})
+
+
+def normalize_text(text):
+    """Minuscole, punteggiatura sostituita da spazi e spazi compattati (confronto tra nomi e domande)."""
+    return " ".join("".join(char if char.isalnum() else " " for char in str(text).lower()).split())
+
+
+def stems(text):
+    """Radici grossolane (prime 4 lettere) delle parole significative: "funghi" e "fungo" condividono "fung"."""
+    return {word[:4] for word in normalize_text(text).split() if len(word) >= 4 and word not in STOPWORDS}
+
+
+def menu_restaurants(menus_dir):
+    """Nomi dei ristoranti ricavati dai file PDF dei menu (usati finché l'ingestion non li ha estratti)."""
+    try:
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(menus_dir) if name.endswith(".pdf"))
+    except OSError as e:
+        logger.warning("Menu non disponibili in %s: %s", menus_dir, e)
+        return []
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+# ---------------------------------------------------------------------------------------------
+# Scrittura
+# ---------------------------------------------------------------------------------------------
+
+def _pack_strings(names):
+    """Tabella di stringhe: numero, offset, id ordinati per nome (ricerca binaria) e testo utf-8."""
+    encoded = [name.encode("utf-8") for name in names]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    sorted_ids = sorted(range(len(encoded)), key=encoded.__getitem__)
+    count = len(encoded)
+    return (struct.pack(f"<I{count + 1}I{count}I", count, *offsets, *sorted_ids) + b"".join(encoded))
+
+
+def _pack_u32(values):
+    return struct.pack(f"<{len(values)}I", *values)
+
+
+class _Interner:
+    """Assegna id consecutivi ai nomi nell'ordine in cui compaiono."""
+
+    def __init__(self, names=()):
+        self.ids = {}
+        self.names = []
+        for name in names:
+            self.id(name)
+
+    def id(self, name):
+        if name is None:
+            return NONE
+        name = str(name).strip()
+        if not name:
+            return NONE
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+
+def build_catalog(config, metadata=None):
+    """
+    Costruisce il contenuto binario del catalogo dai file sorgente (mappatura dei piatti, distanze,
+    tecniche di cottura) e, se disponibili, dai metadati dei piatti prodotti dall'ingestion.
+    """
+    paths = config["paths"]
+    with open(paths["dish_mapping"], "r") as f:
+        dish_mapping = json.load(f)
+    distances_df = pd.read_csv(paths["distances"], index_col=0)
+    distances_df.columns = distances_df.columns.str.strip()
+    distances_df.index = distances_df.index.astype(str).str.strip()
+    techniques_df = pd.read_csv(paths["tecniche_di_cottura"])
+
+    planets = _Interner(str(planet).strip() for planet in distances_df.columns)
+    # I pianeti dei metadati vengono dall'estrazione del LLM: solo quelli di Distanze.csv entrano nel catalogo
+    known_planets = {name.lower(): planet_id for planet_id, name in enumerate(planets.names)}
+    categories = _Interner()
+    techniques = _Interner()
+    technique_categories = []
+    for category, technique in zip(techniques_df["Categoria"], techniques_df["Tecnica"]):
+        if techniques.id(technique) == len(technique_categories):
+            technique_categories.append(categories.id(category))
+    # L'ingestion normalizza le tecniche in minuscolo: vengono ricondotte ai nomi del CSV
+    known_techniques = {name.lower(): technique_id for technique_id, name in enumerate(techniques.names)}
+
+    def technique_id(name):
+        known = known_techniques.get(name.strip().lower())
+        return known if known is not None else techniques.id(name)
+
+    dishes = _Interner()
+    ingredients = _Interner()
+    restaurants = _Interner()
+    licenses = _Interner()
+    dish_info = {}
+    restaurant_info = {}
+
+    for meta in metadata or []:
+        dish_id = dishes.id(meta.get("dish"))
+        if dish_id == NONE:
+            continue
+        restaurant_id = restaurants.id(meta.get("restaurant_name"))
+        if restaurant_id != NONE and restaurant_id not in restaurant_info:
+            planet = meta.get("planet")
+            restaurant_info[restaurant_id] = (
+                known_planets.get(planet.strip().lower(), NONE) if isinstance(planet, str) else NONE,
+                [(licenses.id(key[len("chef_license_"):]), int(grade))
+                 for key, grade in meta.items()
+                 if key.startswith("chef_license_") and isinstance(grade, (int, float))]
+            )
+        dish_info[dish_id] = (
+            restaurant_id,
+            [ingredients.id(value) for value in meta.get("ingredients") or [] if isinstance(value, str)],
+            [technique_id(value) for value in meta.get("techniques") or [] if isinstance(value, str)]
+        )
+
+    # Anche senza ingestion il catalogo contiene tutti i piatti noti, con il loro codice
+    for name in dish_mapping:
+        dishes.id(name)
+    # ... e i ristoranti, dai nomi dei file dei menu
+    if not restaurants.names and paths.get("menus_dir"):
+        for name in menu_restaurants(paths["menus_dir"]):
+            restaurants.id(name)
+
+    dish_records, dish_ingredients, dish_techniques = [], [], []
+    for dish_id, name in enumerate(dishes.names):
+        restaurant_id, ingredient_ids, technique_ids = dish_info.get(dish_id, (NONE, [], []))
+        ingredient_ids = [value for value in dict.fromkeys(ingredient_ids) if value != NONE]
+        technique_ids = [value for value in dict.fromkeys(technique_ids) if value != NONE]
+        code = dish_mapping.get(name)
+        dish_records.append(DISH.pack(
+            int(code) if code is not None else NONE, restaurant_id,
+            len(dish_ingredients), len(ingredient_ids), len(dish_techniques), len(technique_ids)
+        ))
+        dish_ingredients.extend(ingredient_ids)
+        dish_techniques.extend(technique_ids)
+
+    restaurant_records, restaurant_licenses = [], []
+    for restaurant_id in range(len(restaurants.names)):
+        planet_id, license_grades = restaurant_info.get(restaurant_id, (NONE, []))
+        restaurant_records.append(RESTAURANT.pack(planet_id, len(restaurant_licenses), len(license_grades)))
+        restaurant_licenses.extend(LICENSE.pack(license_id, grade) for license_id, grade in license_grades)
+
+    # Matrice delle distanze (float32, NaN se mancante) per colonne: i valori di un pianeta sono contigui
+    matrix = distances_df.reindex(index=distances_df.columns).apply(pd.to_numeric, errors="coerce")
+    distances = struct.pack(f"<{matrix.size}f", *matrix.to_numpy(dtype=float).T.ravel())
+
+    sections = {f"str.{entity}": _pack_strings(table.names) for entity, table in (
+        ("dishes", dishes), ("ingredients", ingredients), ("techniques", techniques), ("categories", categories),
+        ("restaurants", restaurants), ("planets", planets), ("licenses", licenses)
+    )}
+    sections.update({
+        "dishes": b"".join(dish_records),
+        "dish.ingredients": _pack_u32(dish_ingredients),
+        "dish.techniques": _pack_u32(dish_techniques),
+        "restaurants": b"".join(restaurant_records),
+        "rest.licenses": b"".join(restaurant_licenses),
+        "tech.categories": _pack_u32(technique_categories),
+        "distances": distances,
+        "dist.size": _pack_u32([matrix.shape[0]]),
+    })
+    return _serialize(sections)
+
+
+def _serialize(sections):
+    directory_size = HEADER.size + SECTION.size * len(sections)
+    offset = _align(directory_size)
+    directory, body = [], []
+    for name, data in sections.items():
+        if len(name) > 16:
+            raise ValueError(f"Nome di sezione troppo lungo: {name}")
+        directory.append(SECTION.pack(name.encode("ascii"), offset, len(data)))
+        padding = _align(len(data)) - len(data)
+        body.append(data + b"\x00" * padding)
+        offset += len(data) + padding
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)) + b"".join(directory)
+    return header + b"\x00" * (_align(directory_size) - directory_size) + b"".join(body)
+
+
+# ---------------------------------------------------------------------------------------------
+# Lettura
+# ---------------------------------------------------------------------------------------------
+
+class _U32Array:
+    __slots__ = ("buffer", "offset", "count")
+
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = length // 4
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from("<I", self.buffer, self.offset + 4 * index)[0]
+
+    def slice(self, start, count):
+        return struct.unpack_from(f"<{count}I", self.buffer, self.offset + 4 * start)
+
+
+class EntityTable:
+    """Nomi di un tipo di entità: id -> nome e nome -> id (ricerca binaria), letti direttamente dal file mappato."""
+
+    __slots__ = ("buffer", "count", "_offsets", "_sorted", "_text")
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.count = struct.unpack_from("<I", buffer, offset)[0]
+        self._offsets = offset + 4
+        self._sorted = self._offsets + 4 * (self.count + 1)
+        self._text = self._sorted + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def _bytes(self, entity_id):
+        start, end = struct.unpack_from("<2I", self.buffer, self._offsets + 4 * entity_id)
+        return self.buffer[self._text + start:self._text + end]
+
+    def name(self, entity_id):
+        if entity_id == NONE or not 0 <= entity_id < self.count:
+            return None
+        return self._bytes(entity_id).decode("utf-8")
+
+    def id(self, name):
+        """Id dell'entità con questo nome (confronto esatto), None se non esiste."""
+        key = name.encode("utf-8")
+        sorted_ids = _U32Array(self.buffer, self._sorted, 4 * self.count)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = self._bytes(sorted_ids[middle])
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return sorted_ids[middle]
+        return None
+
+    def names(self):
+        return [self._bytes(entity_id).decode("utf-8") for entity_id in range(self.count)]
+
+
+class Catalog:
+    """
+    Catalogo in sola lettura mappato in memoria: piatti, ingredienti, tecniche, ristoranti, pianeti e licenze.
+
+    Le pagine del file sono condivise tra tutti i worker tramite la page cache del sistema operativo:
+    nessun worker ne tiene una copia in strutture Python.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = os.path.basename(path)[len("catalog-"):-len(".bin")]
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, count = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"File di catalogo non valido: {path}")
+        self._sections = {}
+        for index in range(count):
+            name, offset, length = SECTION.unpack_from(self.buffer, HEADER.size + SECTION.size * index)
+            self._sections[name.rstrip(b"\x00").decode("ascii")] = (offset, length)
+
+        for entity in ENTITIES:
+            setattr(self, entity, EntityTable(self.buffer, self._sections[f"str.{entity}"][0]))
+        self._dish_ingredients = self._array("dish.ingredients")
+        self._dish_techniques = self._array("dish.techniques")
+        self._technique_categories = self._array("tech.categories")
+        # Lato della matrice delle distanze (i cataloghi precedenti non lo salvano: si ricava dalla lunghezza)
+        if "dist.size" in self._sections:
+            self._distance_count = self._array("dist.size")[0]
+        else:
+            self._distance_count = math.isqrt(self._sections["distances"][1] // 4)
+        self._techniques_by_category = None
+        self._mention_index = None
+        self._stem_index = None
+
+    def _array(self, section):
+        offset, length = self._sections[section]
+        return _U32Array(self.buffer, offset, length)
+
+    def _record(self, section, layout, index):
+        return layout.unpack_from(self.buffer, self._sections[section][0] + layout.size * index)
+
+    # Piatti
+
+    def dish_code(self, name):
+        """Codice del piatto (quello di dish_mapping.json), None se il piatto non è nel catalogo."""
+        dish_id = self.dishes.id(name)
+        if dish_id is None:
+            return None
+        code = self._record("dishes", DISH, dish_id)[0]
+        return None if code == NONE else code
+
+    def dish(self, name):
+        """Scheda di un piatto: codice, ristorante, pianeta, ingredienti e tecniche (None se non esiste)."""
+        dish_id = self.dishes.id(name)
+        if dish_id is None:
+            return None
+        code, restaurant_id, ingredients_start, ingredients_count, techniques_start, techniques_count = \
+            self._record("dishes", DISH, dish_id)
+        restaurant = self.restaurant(restaurant_id) if restaurant_id != NONE else None
+        return {
+            "dish": name,
+            "code": None if code == NONE else code,
+            "restaurant": restaurant["restaurant"] if restaurant else None,
+            "planet": restaurant["planet"] if restaurant else None,
+            "ingredients": [self.ingredients.name(i) for i in self._dish_ingredients.slice(ingredients_start, ingredients_count)],
+            "techniques": [self.techniques.name(i) for i in self._dish_techniques.slice(techniques_start, techniques_count)],
+        }
+
+    # Ristoranti
+
+    def restaurant(self, restaurant_id):
+        planet_id, licenses_start, licenses_count = self._record("restaurants", RESTAURANT, restaurant_id)
+        offset = self._sections["rest.licenses"][0]
+        licenses = {}
+        for index in range(licenses_start, licenses_start + licenses_count):
+            license_id, grade = LICENSE.unpack_from(self.buffer, offset + LICENSE.size * index)
+            licenses[self.licenses.name(license_id)] = grade
+        return {"restaurant": self.restaurants.name(restaurant_id), "planet": self.planets.name(planet_id), "licenses": licenses}
+
+    # Tecniche
+
+    def techniques_by_category(self):
+        """Tecniche raggruppate per categoria ({Categoria: [tecniche]}), come nel CSV delle tecniche di cottura."""
+        if self._techniques_by_category is None:
+            grouped = {}
+            for technique_id in range(len(self._technique_categories)):
+                category = self.categories.name(self._technique_categories[technique_id])
+                grouped.setdefault(category, []).append(self.techniques.name(technique_id))
+            self._techniques_by_category = dict(sorted(grouped.items()))
+        return self._techniques_by_category
+
+    # Entità citate
+
+    def mentions(self, text):
+        """
+        Entità del catalogo citate in un testo, nella forma {tipo: [nomi]} (solo i tipi presenti).
+        Il confronto è per parole intere, senza maiuscole né punteggiatura.
+        """
+        if self._mention_index is None:
+            self._mention_index = [
+                (f" {normalize_text(name)} ", entity, name)
+                for entity in MENTIONABLE
+                for name in getattr(self, entity).names()
+                if normalize_text(name)
+            ]
+        padded = f" {normalize_text(text)} "
+        found = {}
+        for needle, entity, name in self._mention_index:
+            if needle in padded:
+                found.setdefault(entity, []).append(name)
+        return found
+
+    def candidates(self, texts, limit=15):
+        """
+        Entità candidate per i prompt di un gruppo di testi, nella forma {tipo: [nomi]} (solo i tipi presenti).
+        Prima le entità citate per intero, poi quelle che condividono più radici di parole con i testi
+        (nomi scritti in modo diverso, singolari e plurali), al massimo `limit` per tipo.
+        """
+        if self._stem_index is None:
+            index = {}
+            for entity in MENTIONABLE:
+                for name in getattr(self, entity).names():
+                    for stem in stems(name):
+                        index.setdefault(stem, []).append((entity, name))
+            self._stem_index = index
+
+        found = {}
+        for text in texts:
+            for entity, names in self.mentions(text).items():
+                found.setdefault(entity, {}).update(dict.fromkeys(names))
+
+        scores = {}
+        for stem in set().union(*(stems(text) for text in texts)) if texts else ():
+            for key in self._stem_index.get(stem, ()):
+                scores[key] = scores.get(key, 0) + 1
+        for entity, name in sorted(scores, key=lambda key: (-scores[key], key[1])):
+            names = found.setdefault(entity, {})
+            if len(names) < limit:
+                names[name] = None
+
+        return {entity: list(names)[:limit] for entity, names in found.items() if names}
+
+    # Pianeti
+
+    def distance(self, origin, destination):
+        """Distanza tra due pianeti (None se uno dei due non è nel catalogo o la distanza manca)."""
+        row, column = self.planets.id(origin), self.planets.id(destination)
+        count = self._distance_count
+        if row is None or column is None or row >= count or column >= count:
+            return None
+        value = struct.unpack_from("<f", self.buffer, self._sections["distances"][0] + 4 * (column * count + row))[0]
+        return None if math.isnan(value) else value
+
+    def planets_within(self, planet, max_distance):
+        """Pianeti entro `max_distance` da `planet` (lui compreso); lista vuota se il pianeta non è noto."""
+        column = self.planets.id(planet)
+        count = self._distance_count
+        if column is None or column >= count:
+            return []
+        offset = self._sections["distances"][0]
+        return [
+            self.planets.name(row)
+            for row, value in enumerate(struct.unpack_from(f"<{count}f", self.buffer, offset + 4 * count * column))
+            if value <= max_distance
+        ]
+
+
+# ---------------------------------------------------------------------------------------------
+# Versioni e pubblicazione
+# ---------------------------------------------------------------------------------------------
+
+class CatalogStore:
+    """
+    Cartella dei cataloghi versionati (`catalog-<versione>.bin`) con il puntatore `CURRENT` alla versione attiva.
+
+    La pubblicazione scrive il nuovo file e poi sostituisce atomicamente `CURRENT`; ogni worker controlla
+    il puntatore al massimo ogni `check_interval` secondi e, se è cambiato, mappa la nuova versione.
+    Le richieste già in corso continuano a usare il catalogo che avevano ottenuto.
+    """
+
+    POINTER = "CURRENT"
+
+    def __init__(self, directory="data/catalog", check_interval=1.0, keep=3):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.keep = max(1, int(keep))
+        self._catalog = None
+        self._pointer_stat = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        catalog_config = config.get("catalog", {})
+        return cls(
+            directory=catalog_config.get("dir", "data/catalog"),
+            check_interval=catalog_config.get("check_interval", 1.0),
+            keep=catalog_config.get("keep", 3)
+        )
+
+    @property
+    def pointer_path(self):
+        return os.path.join(self.directory, self.POINTER)
+
+    def ensure(self, config):
+        """Se non è ancora stato pubblicato un catalogo, ne costruisce uno dai soli file sorgente (senza ingestion)."""
+        if not os.path.exists(self.pointer_path):
+            logger.info("Nessun catalogo pubblicato: costruzione dai file sorgente")
+            self.publish(build_catalog(config))
+        return self.current()
+
+    def publish(self, content):
+        """Scrive una nuova versione del catalogo e la rende attiva; restituisce la versione."""
+        os.makedirs(self.directory, exist_ok=True)
+        version = f"{time.strftime('%Y%m%d%H%M%S')}-{hashlib.sha256(content).hexdigest()[:12]}"
+        filename = f"catalog-{version}.bin"
+        self._atomic_write(os.path.join(self.directory, filename), content)
+        self._atomic_write(self.pointer_path, filename.encode("ascii"))
+        self._prune(filename)
+        logger.info("Catalogo pubblicato: versione %s (%d byte)", version, len(content))
+        return version
+
+    def _atomic_write(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".catalog-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _prune(self, active):
+        """Elimina le versioni più vecchie; i worker che le hanno ancora mappate continuano a leggerle."""
+        versions = sorted(name for name in os.listdir(self.directory) if name.startswith("catalog-") and name.endswith(".bin"))
+        for name in versions[:-self.keep]:
+            if name != active:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def current(self):
+        """Catalogo attivo; se il puntatore è cambiato dall'ultimo controllo, passa alla nuova versione."""
+        now = time.monotonic()
+        if self._catalog is not None and now - self._checked_at < self.check_interval:
+            return self._catalog
+        with self._lock:
+            if self._catalog is None or now - self._checked_at >= self.check_interval:
+                self._refresh()
+                self._checked_at = now
+        if self._catalog is None:
+            raise FileNotFoundError(f"Nessun catalogo pubblicato in {self.directory}")
+        return self._catalog
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.pointer_path)
+        except FileNotFoundError:
+            return
+        pointer_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if pointer_stat == self._pointer_stat:
+            return
+        with open(self.pointer_path, "r") as f:
+            filename = f.read().strip()
+        if self._catalog is None or os.path.basename(self._catalog.path) != filename:
+            # Il vecchio mapping viene rilasciato quando nessuna richiesta lo usa più
+            self._catalog = Catalog(os.path.join(self.directory, filename))
+            logger.info("Catalogo caricato: versione %s", self._catalog.version)
+        self._pointer_stat = pointer_stat
@@ -3,55 +3,43 @@ import PyPDF2
 import json
 import pandas as pd
 from bs4 import BeautifulSoup
-import time
-import groq
+from src.answers import dish_summary
 from src.config_loader import ConfigLoader
+from src.llm_gateway import LLMGateway, clean_response, extract_json
+from src.metrics import INGESTION_ITEMS, timed, track_ingestion
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential
-import requests
 
 class DataProcessor:
-    def __init__(self, config_path="config/config.yaml"):
+    def __init__(self, config_path="config/config.yaml", config=None, llm=None):
         # Configura il logging
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
         self.logger = logging.getLogger(__name__)
         
-        # Carica la configurazione utilizzando la classe ConfigLoader
-        self.config_loader = ConfigLoader(config_path)
-        self.config = self.config_loader.get_config()
-        print("Configurazione caricata correttamente.")
+        # Carica la configurazione utilizzando la classe ConfigLoader (se non già fornita)
+        if config is None:
+            config = ConfigLoader(config_path).get_config()
+            print("Configurazione caricata correttamente.")
+        self.config = config
         
-        # Inizializza il client Groq
-        print("[INIT] Inizializzazione del client Groq...\n")
-        self.client = groq.Client(api_key=self.config["groq"]["api_key"])
-        self.model = self.config["groq"]["model"]
-        print("[OK] Client Groq inizializzato con il modello:", self.model, "\n")
+        # Gateway LLM: connessioni keep-alive verso Groq e Gemini riutilizzate per tutti i documenti
+        self.llm = llm or LLMGateway(self.config)
         
         # Carica i nomi dei pianeti dal file CSV
         distances_path = self.config["paths"]["distances"]
         self.planets = self._load_planets_from_csv(distances_path)
         self.logger.info(f"Nomi dei pianeti caricati: {self.planets}")
     
-    @retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=4, max=10))
     def make_request_with_retry(self, system_prompt, prompt):
-        """Invia una richiesta con retry in caso di errore 429."""
-        try:
-            response = self.groq_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt},
-                ],
-                model=self.config["groq"]["deepseek_model"],
-                temperature=0.0
-            )
-            return response
-        except Exception as e:
-            if "429" in str(e):  # Se l'errore è 429, attendi e riprova
-                self.logger.warning("Rate limit raggiunto. Riprovo...")
-                raise
-            else:
-                self.logger.error(f"Errore durante la richiesta: {e}")
-                raise
+        """Invia una richiesta a Groq; i 429 vengono ripetuti dal gateway secondo il limiter adattivo."""
+        return self.llm.chat(
+            "groq",
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.0,
+            model=self.config["groq"].get("deepseek_model")
+        )
     
     def _load_planets_from_csv(self, csv_path):
         """Carica i nomi dei pianeti dal file CSV."""
@@ -132,12 +120,6 @@ class DataProcessor:
         tecniche_df = pd.read_csv(tecniche_path)
         techniques_str = ", ".join(tecniche_df["Tecnica"].tolist())  # Converti in stringa separata da virgole
         
-        # Recupera le variabili dalla configurazione
-        api_key = self.config["google"]["api_key"]
-        base_url = self.config["google"]["model"]
-
-        # Costruisci l'URL
-        url = f"{base_url}{api_key}"
         
         # Definiamo il System Prompt (per definire il comportamento del modello)
         system_prompt = f"""
@@ -371,54 +353,23 @@ class DataProcessor:
 
             Now analyze the following dishes and return ONLY the JSON, without extra text.
         """
-        # Prompt per l'LLM
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": system_prompt
-                        },
-                        {
-                            "text": user_prompt
-                        }
-                    ]
-                }
+        # Invia la richiesta a Gemini (temperature controlla la creatività, 0 = massima precisione)
+        generated_text = self.llm.chat(
+            "gemini",
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
             ],
-            "generationConfig": {
-                "temperature": 0.6  # Controlla la creatività (0 = massima precisione)
-                # "topP": 0.9,  # Controlla la diversità delle risposte
-            }
-        }
-
-        # Intestazioni per la richiesta API
-        headers = {
-            "Content-Type": "application/json"
-        }
-
-        # Invia la richiesta POST all'API di Gemini
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-        # Verifica se la richiesta è andata a buon fine
-        if response.status_code == 200:
-            # Estrai la risposta JSON
-            response_json = response.json()
-            # Estrai il contenuto generato da Gemini
-            generated_text = response_json['candidates'][0]['content']['parts'][0]['text']
-            # Rimuovi i blocchi di codice
-            generated_text = generated_text.replace("```json", "").replace("```", "").strip()
-            
-            parsed_response = json.loads(generated_text)
-
-            # Se la risposta è una lista, prendiamo il primo elemento
-            if isinstance(parsed_response, list):
-                parsed_response = parsed_response[0]
+            temperature=0.6
+        )
+        parsed_response = extract_json(generated_text)
 
-            print(parsed_response)
-            return parsed_response
+        # Se la risposta è una lista, prendiamo il primo elemento
+        if isinstance(parsed_response, list):
+            parsed_response = parsed_response[0]
 
-        else:
-            raise Exception(f"Errore nella richiesta API: {response.status_code}, {response.text}")
+        print(parsed_response)
+        return parsed_response
     
     def extract_dishes_info(self, text):
         """
@@ -435,20 +386,9 @@ class DataProcessor:
         tecniche_df = pd.read_csv(tecniche_path)
         techniques_str = ", ".join(tecniche_df["Tecnica"].tolist())  # Converti in stringa separata da virgole
         
-        # Recupera le variabili dalla configurazione
-        api_key = self.config["google"]["api_key"]
-        base_url = self.config["google"]["model"]
-
-        # Costruisci l'URL
-        url = f"{base_url}{api_key}"
         
         # Prompt per l'LLM
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": f"""
+        prompt = f"""
                                 Given the following text, extract the following information for each dish:
                                 1. Name of the dish
                                 2. List of ingredients
@@ -477,31 +417,10 @@ class DataProcessor:
 
                                 ### Response (JSON ONLY, no comments or additional text):
                             """
-                        }
-                    ]
-                }
-            ]
-        }
-
-        # Intestazioni per la richiesta API
-        headers = {
-            "Content-Type": "application/json"
-        }
-
-        # Invia la richiesta POST all'API di Gemini
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-        # Verifica se la richiesta è andata a buon fine
-        if response.status_code == 200:
-            # Estrai la risposta JSON
-            response_json = response.json()
-            # Estrai il contenuto generato da Gemini
-            generated_text = response_json['candidates'][0]['content']['parts'][0]['text']
-            # Rimuovi i blocchi di codice
-            generated_text = generated_text.replace("```json", "").replace("```", "").strip()
-            return json.loads(generated_text)
-        else:
-            raise Exception(f"Errore nella richiesta API: {response.status_code}, {response.text}")
+
+        # Invia la richiesta a Gemini
+        generated_text = self.llm.chat("gemini", [{"role": "user", "content": prompt}])
+        return extract_json(generated_text)
     
     def extract_restaurant_info(self, text):
         """Usa Gemini per estrarre informazioni del ristorante."""
@@ -510,12 +429,6 @@ class DataProcessor:
         # Lista dei pianeti noti
         known_planets = self.planets
         
-        # Recupera le variabili dalla configurazione
-        api_key = self.config["google"]["api_key"]
-        base_url = self.config["google"]["model"]
-
-        # Costruisci l'URL
-        url = f"{base_url}{api_key}"
 
         # Prompt con richiesta di risposta in formato JSON
         prompt = f"""
@@ -562,44 +475,13 @@ class DataProcessor:
             ```
         """
 
-        # Payload per la richiesta API
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": prompt
-                        }
-                    ]
-                }
-            ],
-            "generationConfig": {
-                "temperature": 0.0,
-            }
-        }
-
-        # Intestazioni per la richiesta API
-        headers = {
-            "Content-Type": "application/json"
-        }
-
-        # Invia la richiesta POST all'API di Gemini
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-        # Verifica se la richiesta è andata a buon fine
-        if response.status_code == 200:
-            # Estrai la risposta JSON
-            response_json = response.json()
-            
-            # Estrai e pulisci il testo generato
-            generated_text = response_json['candidates'][0]['content']['parts'][0]['text'].replace("```json", "").replace("```", "").strip()
-            self.logger.info("Risposta LLM ricevuta con successo.")
-                
-            self.logger.debug(f"Risposta LLM: {generated_text}")
+        # Invia la richiesta a Gemini e pulisci il testo generato
+        generated_text = clean_response(self.llm.chat("gemini", [{"role": "user", "content": prompt}], temperature=0.0))
+        self.logger.info("Risposta LLM ricevuta con successo.")
             
-            return self._parse_restaurant_info_response(generated_text)
-        else:
-            raise Exception(f"Errore nella richiesta API: {response.status_code}, {response.text}")
+        self.logger.debug(f"Risposta LLM: {generated_text}")
+        
+        return self._parse_restaurant_info_response(generated_text)
         
     def split_dishes(self, text, dish_mapping):
         """
@@ -612,20 +494,9 @@ class DataProcessor:
         """
         self.logger.info("Estrazione informazioni dei piatti con LLM...")
         
-        # Recupera le variabili dalla configurazione
-        api_key = self.config["google"]["api_key"]
-        base_url = self.config["google"]["model"]
-
-        # Costruisci l'URL
-        url = f"{base_url}{api_key}"
         
         # Prompt per l'LLM
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": f"""
+        prompt = f"""
                                 Given the following text, extract the following information for each dish:
                                 1. Name of the dish
                                 2. Description (must include key ingredients and cooking techniques)
@@ -664,31 +535,10 @@ class DataProcessor:
 
                                 ### Response (JSON ONLY, no comments or additional text):
                             """
-                        }
-                    ]
-                }
-            ]
-        }
-
-        # Intestazioni per la richiesta API
-        headers = {
-            "Content-Type": "application/json"
-        }
-
-        # Invia la richiesta POST all'API di Gemini
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-
-        # Verifica se la richiesta è andata a buon fine
-        if response.status_code == 200:
-            # Estrai la risposta JSON
-            response_json = response.json()
-            # Estrai il contenuto generato da Gemini
-            generated_text = response_json['candidates'][0]['content']['parts'][0]['text']
-            # Rimuovi i blocchi di codice
-            generated_text = generated_text.replace("```json", "").replace("```", "").strip()
-            return json.loads(generated_text)
-        else:
-            raise Exception(f"Errore nella richiesta API: {response.status_code}, {response.text}")
+
+        # Invia la richiesta a Gemini
+        generated_text = self.llm.chat("gemini", [{"role": "user", "content": prompt}])
+        return extract_json(generated_text)
     
     def _parse_restaurant_info_response(self, response):
         """Analizza la risposta del LLM (in formato JSON) per estrarre le informazioni del ristorante."""
@@ -736,8 +586,14 @@ class DataProcessor:
                 "chef_licenses_grades": []
             }
     
-    def split_text_by_dishes(self, text, dish_mapping):
-        """Divide il testo in chunk basati sui piatti identificati."""
+    @timed("split_text_by_dishes", tracker=track_ingestion)
+    def split_text_by_dishes(self, text, dish_mapping, on_dish=None, cancel_check=None):
+        """
+        Divide il testo in chunk basati sui piatti identificati.
+
+        :param on_dish: Callback opzionale `on_dish(done, total)` chiamata dopo ogni piatto elaborato.
+        :param cancel_check: Callback opzionale chiamata prima di ogni piatto; solleva un'eccezione per interrompere.
+        """
         self.logger.info("Inizio divisione del testo in chunk basati sui piatti...")
         chunks = []
         metadata = []
@@ -747,16 +603,14 @@ class DataProcessor:
         restaurant_info = self.extract_restaurant_info(restaurant_description)
         self.logger.info(f"Informazioni del ristorante estratte: {restaurant_info}")
         
-        # Pausa di 5 secondi
-        print('\n...pausa di 3 secondi...\n')
-        time.sleep(3)
-        
         dishes_json = self.split_dishes(dishes_text, dish_mapping)
         num_dishes = len(dishes_json)  # Conta il numero di piatti estratti
         self.logger.info(f"\nNumero di piatti estratti: {num_dishes} \n")
         
         # Itera su ogni piatto in dishes_info
         for i, dish in enumerate(dishes_json):
+            if cancel_check is not None:
+                cancel_check()
             try:
                 # Estrai nome e descrizione del piatto
                 dish_title = dish.get("name", "Unknown Dish")  # Nome del piatto (con valore di default "Unknown Dish")
@@ -788,20 +642,21 @@ class DataProcessor:
                     **dish_info,  # Informazioni estratte dal modello LLM
                     **restaurant_info  # Aggiungi informazioni del ristorante
                 }
+                # Riassunto del piatto per le risposte in chat da template (senza LLM)
+                dish_metadata["summary"] = dish_summary(dish_metadata)
                 metadata.append(dish_metadata)
 
                 self.logger.info(f"Chunk e metadati creati per il piatto: {dish_title}")
-                
-                # Pausa tra le richieste per evitare sovraccarico API
-                if i < len(dishes_json) - 1:
-                    self.logger.info("Pausa tra le elaborazioni...")
-                    time.sleep(3)
 
             except Exception as e:
                 self.logger.error(f"Errore nell'elaborazione del piatto {dish_title}: {str(e)}")
 
+            if on_dish is not None:
+                on_dish(i + 1, num_dishes)
+
         # Al termine, restituisci i chunk e i metadati
         self.logger.info(f"Divisione del testo completata con successo. Trovati {len(chunks)} piatti.")
+        INGESTION_ITEMS.inc(len(chunks), stage="split_text_by_dishes")
         return chunks, metadata
     
     def extract_restaurant_description_and_dishes(self, text):
@@ -840,8 +695,13 @@ class DataProcessor:
         sentences = [sent.text.strip() for sent in doc.sents]
         return sentences
     
-    def process_all_documents(self):
-        """Elabora tutti i documenti e genera chunks con metadati."""
+    def process_all_documents(self, progress_callback=None, cancel_check=None):
+        """
+        Elabora tutti i documenti e genera chunks con metadati.
+
+        :param progress_callback: Callback opzionale `progress_callback(files_done, files_total, dishes_done)`.
+        :param cancel_check: Callback opzionale chiamata tra un'unità di lavoro e l'altra; solleva un'eccezione per interrompere.
+        """
         menus_dir = self.config["paths"]["menus_dir"]
         recipes_content = self.process_all_pdfs(menus_dir)
         
@@ -858,10 +718,23 @@ class DataProcessor:
         all_chunks = []
         metadata = []
         
+        files_total = len(recipes_content)
+        dishes_done = 0
+
+        def on_dish(done, total):
+            if progress_callback is not None:
+                progress_callback(idx - 1, files_total, dishes_done + done)
+
         for idx, (filename, content) in enumerate(recipes_content.items(), start=1):
-            print(f"\n\n Elaborazione del file {idx} di {len(recipes_content)}: {filename} \n\n")
-            doc_chunks, doc_metadata = self.split_text_by_dishes(content, dish_mapping)
+            if cancel_check is not None:
+                cancel_check()
+            print(f"\n\n Elaborazione del file {idx} di {files_total}: {filename} \n\n")
+            doc_chunks, doc_metadata = self.split_text_by_dishes(content, dish_mapping, on_dish=on_dish, cancel_check=cancel_check)
             all_chunks.extend(doc_chunks)
             for meta in doc_metadata:
                 metadata.append({"source": filename, "type": "recipe", **meta})
+
+            dishes_done += len(doc_chunks)
+            if progress_callback is not None:
+                progress_callback(idx, files_total, dishes_done)
         return all_chunks, metadata
\ No newline at end of file
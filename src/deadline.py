@@ -0,0 +1,120 @@
+import asyncio
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from src.metrics import REGISTRY
+
+DEADLINE_HITS = REGISTRY.counter(
+    "vegamind_deadline_exceeded_total", "Fasi interrotte per esaurimento del budget di tempo.", ["stage"])
+CANCELLED = REGISTRY.counter(
+    "vegamind_requests_cancelled_total", "Richieste il cui lavoro è stato cancellato prima del termine.", ["reason"])
+
+# Istante (time.monotonic) entro cui la richiesta corrente deve terminare
+_deadline = contextvars.ContextVar("vegamind_deadline", default=None)
+
+# Timeout massimo per fase, dalla sezione `deadlines.stages` della configurazione
+_stage_timeouts = {}
+
+
+class DeadlineExceeded(Exception):
+    """Sollevata quando una fase non termina entro il budget residuo della richiesta."""
+
+    def __init__(self, stage):
+        super().__init__(f"Tempo esaurito durante la fase `{stage}`")
+        self.stage = stage
+
+
+def configure(config):
+    """Legge i timeout per fase dalla configurazione."""
+    _stage_timeouts.clear()
+    _stage_timeouts.update(config.get("deadlines", {}).get("stages", {}))
+
+
+def remaining():
+    """Secondi rimasti alla richiesta corrente (None se non c'è una scadenza)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@contextmanager
+def budget(seconds):
+    """
+    Imposta il budget della richiesta corrente (`with budget(60): ...`).
+    Un budget annidato non può estendere quello esterno: vale la scadenza più vicina.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        try:
+            _deadline.reset(token)
+        except ValueError:
+            pass
+
+
+def stage_timeout(stage):
+    """Tempo concesso alla fase: il minimo tra il suo timeout e il budget residuo della richiesta."""
+    candidates = [value for value in (remaining(), _stage_timeouts.get(stage)) if value is not None]
+    return min(candidates) if candidates else None
+
+
+def exceeded(stage):
+    """Registra il superamento della scadenza e restituisce l'eccezione da sollevare."""
+    DEADLINE_HITS.labels(stage=stage).inc()
+    return DeadlineExceeded(stage)
+
+
+async def run_stage(stage, awaitable):
+    """Attende `awaitable` entro il tempo concesso alla fase; allo scadere il lavoro viene cancellato."""
+    timeout = stage_timeout(stage)
+    if timeout is None:
+        return await awaitable
+    if timeout <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise exceeded(stage)
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise exceeded(stage) from None
+
+
+def with_deadline(stage):
+    """Decoratore per coroutine function: la chiamata eredita e rispetta la scadenza della richiesta."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_stage(stage, func(*args, **kwargs))
+        return wrapper
+
+    return decorator
+
+
+async def iterate(stage, iterator):
+    """Itera un async iterator (es. uno stream di token) interrompendolo allo scadere della fase."""
+    iterator = iterator.__aiter__()
+    timeout = stage_timeout(stage)
+    end = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        if end is None:
+            item_timeout = None
+        else:
+            item_timeout = end - time.monotonic()
+            if item_timeout <= 0:
+                raise exceeded(stage)
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), item_timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise exceeded(stage) from None
+        yield item
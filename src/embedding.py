@@ -1,6 +1,7 @@
 import torch
 from sentence_transformers import SentenceTransformer
 from src.config_loader import ConfigLoader
+from src.metrics import INGESTION_ITEMS, timed, track_ingestion
 import logging
 
 class EmbeddingHandler:
@@ -38,6 +39,7 @@ class EmbeddingHandler:
         self.logger.info("Generazione embedding completata.")
         return embedding
     
+    @timed("generate_embeddings", tracker=track_ingestion)
     def generate_embeddings(self, texts):
         """Genera gli embedding per una lista di testi."""
         self.logger.info("Inizio generazione embedding per i testi.")
@@ -54,6 +56,7 @@ class EmbeddingHandler:
             embeddings.append(embedding)
         
         self.logger.info("Generazione embedding completata.")
+        INGESTION_ITEMS.inc(len(embeddings), stage="generate_embeddings")
         return embeddings
 
 
@@ -0,0 +1,233 @@
+import asyncio
+import inspect
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """Sollevata all'interno di un job quando ne è stata richiesta la cancellazione."""
+
+
+class JobConflict(Exception):
+    """Sollevata da `submit(..., exclusive=True)` quando un job dello stesso tipo non è ancora terminato."""
+
+    def __init__(self, job):
+        super().__init__(f"Job {job.kind} già in corso ({job.id})")
+        self.job = job
+
+
+class Job:
+    """Stato e avanzamento di un job in background."""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = Job.PENDING
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # Incrementato a ogni cambiamento: permette lo streaming dei soli aggiornamenti
+        self.version = 0
+
+        self._cancel_event = threading.Event()
+        self._task = None
+        self._future = None
+
+    @property
+    def finished(self):
+        return self.status in (Job.COMPLETED, Job.FAILED, Job.CANCELLED)
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def raise_if_cancelled(self):
+        """Punto di cancellazione cooperativa per i job sincroni."""
+        if self._cancel_event.is_set():
+            raise JobCancelled(f"Job {self.id} cancellato")
+
+    def update(self, done=None, total=None, **details):
+        """
+        Aggiorna l'avanzamento del job.
+
+        :param done: Unità di lavoro completate (es. file elaborati).
+        :param total: Unità di lavoro totali; con `done` permette di stimare l'ETA.
+        :param details: Altri contatori (es. dishes_done, phase).
+        """
+        self.progress.update(details)
+        if done is not None:
+            self.progress["done"] = done
+        if total is not None:
+            self.progress["total"] = total
+
+        done = self.progress.get("done")
+        total = self.progress.get("total")
+        if self.started_at and done and total:
+            elapsed = time.time() - self.started_at
+            self.progress["eta_seconds"] = round(elapsed * (total - done) / done, 1)
+        self.version += 1
+
+    def _set_status(self, status, result=None, error=None):
+        self.status = status
+        if status == Job.RUNNING:
+            self.started_at = time.time()
+        if status in (Job.COMPLETED, Job.FAILED, Job.CANCELLED):
+            self.finished_at = time.time()
+            self.progress.pop("eta_seconds", None)
+        if result is not None:
+            self.result = result
+        if error is not None:
+            self.error = error
+        self.version += 1
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Esegue job di lunga durata (ingestion, batch CSV) fuori dal ciclo richiesta/risposta.
+
+    I job sincroni girano in un thread pool dedicato, separato da quello usato per servire le query;
+    i job asincroni (coroutine) girano come task sull'event loop e vengono cancellati con `task.cancel()`.
+    """
+
+    def __init__(self, max_workers=1, max_history=100):
+        self.logger = logging.getLogger(__name__)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vegamind-job")
+        self.max_history = max_history
+        self.jobs = OrderedDict()
+
+    def submit(self, kind, func, *args, exclusive=False):
+        """
+        Avvia un job e restituisce subito l'oggetto Job.
+
+        `func(job, *args)` può essere una funzione sincrona (eseguita nel thread pool dei job)
+        oppure una coroutine function (eseguita come task sull'event loop corrente).
+        Con `exclusive` solleva JobConflict se un job dello stesso tipo non è ancora terminato
+        (anche se ne è stata richiesta la cancellazione: finché gira usa ancora le stesse risorse).
+        """
+        if exclusive:
+            active = self.active(kind)
+            if active is not None:
+                raise JobConflict(active)
+        job = Job(kind)
+        self._register(job)
+
+        if inspect.iscoroutinefunction(func):
+            job._task = asyncio.get_running_loop().create_task(self._run_async(job, func, args))
+            job._task.add_done_callback(lambda task: self._on_task_done(job, task))
+        else:
+            job._future = self.executor.submit(self._run_sync, job, func, args)
+        self.logger.info(f"Job {job.id} ({kind}) avviato")
+        return job
+
+    def _register(self, job):
+        self.jobs[job.id] = job
+        # Mantiene solo lo storico più recente dei job terminati
+        while len(self.jobs) > self.max_history:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if not oldest.finished:
+                break
+            del self.jobs[oldest_id]
+
+    def _run_sync(self, job, func, args):
+        if job.cancel_requested:
+            job._set_status(Job.CANCELLED)
+            return
+        job._set_status(Job.RUNNING)
+        try:
+            result = func(job, *args)
+            job._set_status(Job.COMPLETED, result=result)
+        except JobCancelled:
+            job._set_status(Job.CANCELLED)
+        except Exception as e:
+            self.logger.error(f"Job {job.id} fallito: {e}")
+            job._set_status(Job.FAILED, error=str(e))
+
+    async def _run_async(self, job, func, args):
+        job._set_status(Job.RUNNING)
+        try:
+            result = await func(job, *args)
+            job._set_status(Job.COMPLETED, result=result)
+        except (asyncio.CancelledError, JobCancelled):
+            job._set_status(Job.CANCELLED)
+        except Exception as e:
+            self.logger.error(f"Job {job.id} fallito: {e}")
+            job._set_status(Job.FAILED, error=str(e))
+
+    def _on_task_done(self, job, task):
+        # Un task cancellato prima di partire non esegue mai _run_async
+        if not job.finished and task.cancelled():
+            job._set_status(Job.CANCELLED)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def active(self, kind):
+        """Job non ancora terminato del tipo indicato, None se non ce ne sono."""
+        return next((job for job in self.jobs.values() if job.kind == kind and not job.finished), None)
+
+    def list(self):
+        return [job.to_dict() for job in reversed(self.jobs.values())]
+
+    def cancel(self, job_id):
+        """Richiede la cancellazione del job. Restituisce False se il job non esiste."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        if job.finished:
+            return True
+
+        job._cancel_event.set()
+        if job._task is not None:
+            job._task.cancel()
+        elif job._future is not None and job._future.cancel():
+            # Il job era ancora in coda nel thread pool
+            job._set_status(Job.CANCELLED)
+        return True
+
+    async def stream(self, job_id, poll_interval=0.5):
+        """Genera uno snapshot del job a ogni cambiamento, fino al termine del job."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+
+        last_version = -1
+        while True:
+            if job.version != last_version:
+                last_version = job.version
+                yield job.to_dict()
+            if job.finished:
+                return
+            await asyncio.sleep(poll_interval)
+
+    def shutdown(self):
+        """Cancella i job in corso e ferma il thread pool."""
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+        self.executor.shutdown(wait=False, cancel_futures=True)
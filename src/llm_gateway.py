@@ -0,0 +1,501 @@
+import asyncio
+import contextvars
+import json
+import logging
+import time
+import groq
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from src.cassette import Cassette
+from src.llm_policy import LLM_FAILOVERS, LLM_HEDGES, CallPolicy
+from src.metrics import LLM_RETRIES, REGISTRY
+from src.rate_limiter import AdaptiveLimiterRegistry, RateLimiterRegistry, estimate_messages_tokens
+
+LLM_REQUESTS = REGISTRY.counter(
+    "vegamind_llm_requests_total", "Chiamate ai provider LLM per esito.", ["provider", "outcome"])
+LLM_DURATION = REGISTRY.histogram(
+    "vegamind_llm_request_duration_seconds", "Durata delle chiamate ai provider LLM (per gli stream: fino all'ultimo frammento).", ["provider"])
+
+
+def strip_think(text):
+    """Rimuove il ragionamento `<think>...</think>` dei modelli di reasoning."""
+    if "</think>" in text:
+        return text.split("</think>")[-1].strip()
+    return text.strip()
+
+
+def strip_code_fences(text):
+    """Rimuove i delimitatori dei blocchi di codice (```json ... ```)."""
+    return text.replace("```json", "").replace("```", "").strip()
+
+
+def clean_response(text):
+    """Testo utile di una risposta: senza ragionamento e senza blocchi di codice."""
+    return strip_code_fences(strip_think(text or ""))
+
+
+def extract_json(text):
+    """
+    Estrae il JSON da una risposta del modello. Se il testo pulito non è un JSON valido
+    prova con il primo oggetto o array che contiene; altrimenti solleva json.JSONDecodeError.
+    """
+    cleaned = clean_response(text)
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError as error:
+        starts = [index for index in (cleaned.find("{"), cleaned.find("[")) if index >= 0]
+        if not starts:
+            raise
+        try:
+            return json.JSONDecoder().raw_decode(cleaned, min(starts))[0]
+        except json.JSONDecodeError:
+            raise error from None
+
+
+# Contatore dei token del contesto corrente (es. un task speculativo), se qualcuno li sta contando
+_usage = contextvars.ContextVar("llm_usage", default=None)
+
+
+class TokenUsage:
+    """Chiamate e token (stimati, o riportati dal provider) fatti nel contesto in cui è attivo."""
+
+    __slots__ = ("calls", "tokens")
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens = 0
+
+
+class Answer:
+    """
+    Provider e modello che hanno risposto a una chiamata (con il failover possono non essere quelli richiesti).
+    Va passato al gateway (`answer=`) da chi usa il modello nelle chiavi di cache delle risposte.
+    """
+
+    __slots__ = ("provider", "model")
+
+    def __init__(self):
+        self.provider = None
+        self.model = None
+
+
+def track_usage(usage):
+    """Conta in `usage` le chiamate asincrone fatte da qui in avanti nel contesto corrente (es. dentro un task)."""
+    _usage.set(usage)
+
+
+class LLMError(Exception):
+    """Risposta di errore di un provider LLM."""
+
+    def __init__(self, provider, status_code, body, headers=None):
+        super().__init__(f"Errore nella richiesta API: {status_code}, {body}")
+        self.provider = provider
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+
+class CircuitOpenError(LLMError):
+    """Nessun provider disponibile: i circuit breaker di tutti i candidati sono aperti."""
+
+    def __init__(self, providers):
+        Exception.__init__(self, f"Circuito aperto per {', '.join(providers)}")
+        self.provider = providers[0] if providers else None
+        self.status_code = None
+
+
+class _Call:
+    """Misura una chiamata a un provider: durata ed esito."""
+
+    __slots__ = ("provider", "start")
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        LLM_DURATION.labels(provider=self.provider).observe(time.perf_counter() - self.start)
+        LLM_REQUESTS.labels(provider=self.provider, outcome="ok" if exc_type is None else "error").inc()
+        return False
+
+
+class LLMGateway:
+    """
+    Punto unico di accesso ai provider LLM (Groq e Gemini) per agent, tool e ingestion.
+
+    - Un pool di connessioni keep-alive per provider, sincrono e asincrono: le chiamate successive
+      riutilizzano la connessione TCP/TLS invece di aprirne una nuova.
+    - Un'unica interfaccia chat (messaggi in formato {"role", "content"}) per entrambi i provider:
+      `chat` (sincrona), `achat` (asincrona) e `astream` (frammenti di testo).
+    - Le chiamate asincrone rispettano i rate limiter per provider e ne correggono la stima con l'usage reale;
+      quelle sincrone (ingestion) i limiter adattivi (`adaptive_limits`), guidati dai 429 e dagli header dei provider.
+    - Failover, circuit breaker e hedging secondo la `CallPolicy` (`llm.policy`): il parametro `stage`
+      seleziona l'elenco ordinato di provider e modelli da provare per la fase.
+    - Registrazione e riproduzione delle chiamate su cassetta (`cassettes`) per esecuzioni senza provider.
+    - Con `answer` (Answer) il chiamante riceve provider e modello che hanno risposto, per le chiavi di cache.
+    """
+
+    PROVIDERS = ("groq", "gemini")
+
+    def __init__(self, config, rate_limiters=None):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.rate_limiters = rate_limiters or RateLimiterRegistry(config)
+        self.adaptive_limiters = AdaptiveLimiterRegistry(config)
+        self.policy = CallPolicy.from_config(config)
+        self.cassette = Cassette.from_config(config)
+
+        self.timeout = config.get("deadlines", {}).get("http_timeout", 60)
+        pool_config = config.get("llm", {}).get("pool", {})
+        max_connections = pool_config.get("max_connections", 20)
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=pool_config.get("max_keepalive_connections", 10),
+            keepalive_expiry=pool_config.get("keepalive_expiry", 30)
+        )
+
+        # Groq: i client SDK usano i pool httpx del gateway; base_url permette di puntare a un server locale
+        self.groq_model = config["groq"]["model"]
+        api_key = config["groq"]["api_key"]
+        groq_options = {
+            "api_key": api_key, "timeout": self.timeout, "base_url": config["groq"].get("base_url"),
+            # Con failover e hedging i tentativi dell'SDK allungherebbero solo la coda delle latenze
+            "max_retries": config.get("llm", {}).get("max_retries", 2),
+        }
+        self.groq = groq.Client(**groq_options, http_client=httpx.Client(limits=limits, timeout=self.timeout))
+        self.async_groq = groq.AsyncClient(**groq_options, http_client=httpx.AsyncClient(limits=limits, timeout=self.timeout))
+
+        # Gemini: sessione requests (ingestion, percorso sincrono) e client httpx asincrono
+        self.gemini_url = f"{config['google']['model']}{config['google']['api_key']}"
+        self.gemini_model = config["google"]["model"].split("/models/")[-1].split(":")[0]
+        self.gemini_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.gemini_session.mount("https://", adapter)
+        self.gemini_session.mount("http://", adapter)
+        self.async_gemini = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+
+    # Groq
+
+    def _groq_kwargs(self, messages, temperature, model):
+        kwargs = {"model": model or self.groq_model, "messages": messages}
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        return kwargs
+
+    # Gemini
+
+    def _gemini_payload(self, messages, temperature):
+        """I messaggi diventano le parti di un unico contenuto, nell'ordine in cui sono dati."""
+        payload = {"contents": [{"parts": [{"text": message["content"]} for message in messages]}]}
+        if temperature is not None:
+            payload["generationConfig"] = {"temperature": temperature}
+        return payload
+
+    def _gemini_request_url(self, model):
+        """URL di generateContent per il modello (quello configurato se `model` è None)."""
+        if not model or model == self.gemini_model:
+            return self.gemini_url
+        return self.gemini_url.replace(f"/models/{self.gemini_model}:", f"/models/{model}:")
+
+    def _gemini_text(self, status_code, body, response_json, headers=None):
+        if status_code != 200:
+            raise LLMError("gemini", status_code, body, headers)
+        return response_json["candidates"][0]["content"]["parts"][0]["text"]
+
+    # Interfaccia comune
+
+    def model_name(self, provider, model=None):
+        """Nome del modello che risponde alle chiamate del provider (parte delle chiavi di cache)."""
+        if model:
+            return model
+        return self.groq_model if provider == "groq" else self.gemini_model
+
+    def _answer(self, answer, provider, model):
+        if answer is not None:
+            answer.provider, answer.model = provider, self.model_name(provider, model)
+
+    def _candidates(self, stage, provider, model):
+        candidates = self.policy.candidates(stage, provider, model)
+        for candidate, _ in candidates:
+            if candidate not in self.PROVIDERS:
+                raise ValueError(f"Provider LLM sconosciuto: {candidate}")
+        return candidates
+
+    def _replay(self, candidates, messages, temperature, answer=None):
+        """Risposta della cassetta in modalità replay (None = chiamata da fare ai provider)."""
+        replayed = self.cassette.replay(
+            [(candidate, self.model_name(candidate, model)) for candidate, model in candidates], messages, temperature
+        )
+        if replayed is None:
+            return None
+        provider, model, text = replayed
+        self._answer(answer, provider, model)
+        return text
+
+    def _record(self, provider, model, messages, temperature, text):
+        self.cassette.record(provider, self.model_name(provider, model), messages, temperature, text)
+
+    def _failover(self, stage, provider, reason, error=None):
+        LLM_FAILOVERS.inc(stage=stage or "other", provider=provider, reason=reason)
+        if error is not None:
+            self.logger.warning("Chiamata a `%s` fallita (fase %s): %s", provider, stage or "-", error)
+
+    def _request_once(self, provider, messages, temperature, model):
+        """Una chiamata sincrona a un provider: testo e header della risposta."""
+        started = time.perf_counter()
+        with _Call(provider):
+            if provider == "groq":
+                raw = self.groq.chat.completions.with_raw_response.create(**self._groq_kwargs(messages, temperature, model))
+                text, headers = raw.parse().choices[0].message.content, raw.headers
+            else:
+                response = self.gemini_session.post(
+                    self._gemini_request_url(model), json=self._gemini_payload(messages, temperature), timeout=self.timeout
+                )
+                headers = response.headers
+                text = self._gemini_text(
+                    response.status_code, response.text, response.json() if response.status_code == 200 else None, headers
+                )
+        self.policy.record_latency(provider, self.model_name(provider, model), time.perf_counter() - started)
+        self._record(provider, model, messages, temperature, text)
+        return text, headers
+
+    def _request(self, provider, messages, temperature, model, retry_throttled=True):
+        """
+        Una chiamata sincrona a un provider, distanziata dal suo limiter adattivo (se configurato).
+        Con `retry_throttled` un 429 viene ripetuto dopo l'attesa indicata dal provider; altrimenti passa al failover.
+        """
+        limiter = self.adaptive_limiters.get(provider)
+        if limiter is None:
+            return self._request_once(provider, messages, temperature, model)[0]
+
+        attempts = self.adaptive_limiters.max_attempts if retry_throttled else 1
+        for attempt in range(1, attempts + 1):
+            limiter.acquire()
+            try:
+                text, headers = self._request_once(provider, messages, temperature, model)
+            except Exception as e:
+                status_code = getattr(e, "status_code", None)
+                if status_code != 429:
+                    raise
+                response = getattr(e, "response", None)
+                limiter.throttled(
+                    getattr(e, "headers", None) or getattr(response, "headers", None),
+                    getattr(e, "body", None) if isinstance(e, LLMError) else getattr(response, "text", None)
+                )
+                if attempt == attempts:
+                    raise
+                LLM_RETRIES.inc(provider=provider)
+                continue
+            limiter.success(headers)
+            return text
+
+    def chat(self, provider, messages, temperature=None, model=None, stage=None, answer=None):
+        """Chiamata sincrona: restituisce il testo generato (senza pulizia). Failover e circuit breaker, senza hedging."""
+        candidates = self._candidates(stage, provider, model)
+        text = self._replay(candidates, messages, temperature, answer)
+        if text is not None:
+            return text
+        error = None
+        for candidate, candidate_model in candidates:
+            breaker = self.policy.breaker(candidate)
+            if not breaker.allow():
+                self._failover(stage, candidate, "circuit_open")
+                continue
+            try:
+                # Con un solo candidato un 429 si ripete dopo l'attesa; con il failover si passa al successivo
+                text = self._request(candidate, messages, temperature, candidate_model, retry_throttled=len(candidates) == 1)
+            except Exception as e:
+                breaker.error(e)
+                self._failover(stage, candidate, "error", e)
+                error = e
+                continue
+            breaker.success()
+            self._answer(answer, candidate, candidate_model)
+            return text
+        raise error or CircuitOpenError([candidate for candidate, _ in candidates])
+
+    async def _arequest(self, provider, messages, temperature, model):
+        """Una chiamata asincrona a un provider, nel rispetto del suo rate limit."""
+        estimated = await self.rate_limiters.acquire(provider, messages)
+        # Il prompt viene inviato (e pagato) anche se la chiamata viene poi cancellata
+        counter = _usage.get()
+        prompt_tokens = estimate_messages_tokens(messages)
+        if counter is not None:
+            counter.calls += 1
+            counter.tokens += prompt_tokens
+        started = time.perf_counter()
+        with _Call(provider):
+            if provider == "groq":
+                response = await self.async_groq.chat.completions.create(**self._groq_kwargs(messages, temperature, model))
+                usage = getattr(response, "usage", None)
+                total_tokens = getattr(usage, "total_tokens", None)
+                self.rate_limiters.record_usage(provider, estimated, total_tokens)
+                text = response.choices[0].message.content
+            else:
+                response = await self.async_gemini.post(
+                    self._gemini_request_url(model), json=self._gemini_payload(messages, temperature)
+                )
+                response_json = response.json() if response.status_code == 200 else None
+                text = self._gemini_text(response.status_code, response.text, response_json, response.headers)
+                total_tokens = response_json.get("usageMetadata", {}).get("totalTokenCount")
+                self.rate_limiters.record_usage(provider, estimated, total_tokens)
+        self.policy.record_latency(provider, self.model_name(provider, model), time.perf_counter() - started)
+        self._record(provider, model, messages, temperature, text)
+
+        if counter is not None:
+            counter.tokens += (total_tokens - prompt_tokens) if total_tokens else estimate_messages_tokens([{"content": text}])
+        return text
+
+    async def _aattempt(self, provider, messages, temperature, model, breaker, count_errors=True):
+        """
+        Una chiamata che aggiorna il circuit breaker del provider.
+        Con `count_errors` False l'errore lo registra il chiamante (una coppia con hedging è una sola chiamata logica).
+        """
+        try:
+            text = await self._arequest(provider, messages, temperature, model)
+        except Exception as e:
+            if count_errors:
+                breaker.error(e)
+            raise
+        except BaseException:
+            # Cancellata (es. hedge perdente): nessun esito da registrare
+            breaker.release()
+            raise
+        breaker.success()
+        return text
+
+    async def _ahedged(self, provider, messages, temperature, model, breaker):
+        """
+        Chiamata con hedging: se non risponde entro il ritardo (quantile recente delle durate) parte un duplicato
+        verso lo stesso provider e vince la prima risposta riuscita; l'altra viene cancellata.
+        """
+        delay = self.policy.hedge_delay(provider, self.model_name(provider, model))
+        if delay is None:
+            return await self._aattempt(provider, messages, temperature, model, breaker)
+
+        primary = asyncio.ensure_future(self._aattempt(provider, messages, temperature, model, breaker, count_errors=False))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except BaseException:
+            primary.cancel()
+            raise
+        # Con il circuito non chiuso (es. richiesta di prova) non si duplica il traffico
+        if done or not breaker.closed:
+            try:
+                return await primary
+            except Exception as e:
+                breaker.error(e)
+                raise
+
+        hedge = asyncio.ensure_future(self._aattempt(provider, messages, temperature, model, breaker, count_errors=False))
+        pending, winner, error = {primary, hedge}, None, None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+            if winner is None:
+                # Entrambe fallite: un solo errore per il circuit breaker
+                breaker.error(error)
+                raise error
+            return winner.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            LLM_HEDGES.inc(provider=provider, winner="primary" if winner is primary else "hedge" if winner is hedge else "none")
+
+    async def achat(self, provider, messages, temperature=None, model=None, stage=None, answer=None):
+        """Chiamata asincrona con failover, circuit breaker e hedging; rispetta il rate limit condiviso dei provider."""
+        candidates = self._candidates(stage, provider, model)
+        text = self._replay(candidates, messages, temperature, answer)
+        if text is not None:
+            return text
+        error = None
+        for candidate, candidate_model in candidates:
+            breaker = self.policy.breaker(candidate)
+            if not breaker.allow():
+                self._failover(stage, candidate, "circuit_open")
+                continue
+            try:
+                text = await self._ahedged(candidate, messages, temperature, candidate_model, breaker)
+            except Exception as e:
+                self._failover(stage, candidate, "error", e)
+                error = e
+                continue
+            self._answer(answer, candidate, candidate_model)
+            return text
+        raise error or CircuitOpenError([candidate for candidate, _ in candidates])
+
+    async def astream(self, provider, messages, temperature=None, model=None, stage=None, answer=None):
+        """
+        Frammenti di testo man mano che arrivano (Gemini: la risposta completa in un solo frammento).
+        Il failover è possibile solo finché lo stream non è stato aperto; in replay la risposta arriva in un solo frammento.
+        """
+        candidates = self._candidates(stage, provider, model)
+        text = self._replay(candidates, messages, temperature, answer)
+        if text is not None:
+            yield text
+            return
+        error = None
+        for candidate, candidate_model in candidates:
+            breaker = self.policy.breaker(candidate)
+            if not breaker.allow():
+                self._failover(stage, candidate, "circuit_open")
+                continue
+            if candidate != "groq":
+                try:
+                    text = await self._aattempt(candidate, messages, temperature, candidate_model, breaker)
+                except Exception as e:
+                    self._failover(stage, candidate, "error", e)
+                    error = e
+                    continue
+                self._answer(answer, candidate, candidate_model)
+                yield text
+                return
+
+            opened = False
+            chunks = []
+            try:
+                await self.rate_limiters.acquire(candidate, messages)
+                with _Call(candidate):
+                    stream = await self.async_groq.chat.completions.create(
+                        **self._groq_kwargs(messages, temperature, candidate_model), stream=True
+                    )
+                    opened = True
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            chunks.append(chunk.choices[0].delta.content)
+                            yield chunk.choices[0].delta.content
+            except Exception as e:
+                breaker.error(e)
+                if opened:
+                    raise
+                self._failover(stage, candidate, "error", e)
+                error = e
+                continue
+            except BaseException:
+                # Stream cancellato o chiuso dal consumatore
+                breaker.release()
+                raise
+            breaker.success()
+            self._answer(answer, candidate, candidate_model)
+            self._record(candidate, candidate_model, messages, temperature, "".join(chunks))
+            return
+        raise error or CircuitOpenError([candidate for candidate, _ in candidates])
+
+    def close(self):
+        self.groq.close()
+        self.gemini_session.close()
+
+    async def aclose(self):
+        """Chiude i pool di connessioni (sincroni e asincroni)."""
+        self.close()
+        await self.async_groq.close()
+        await self.async_gemini.aclose()
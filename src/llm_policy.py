@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from collections import deque
+from src.metrics import REGISTRY
+
+LLM_HEDGES = REGISTRY.counter(
+    "vegamind_llm_hedges_total", "Richieste duplicate inviate dopo il ritardo di hedging, per vincitore (primary, hedge, none).",
+    ["provider", "winner"])
+LLM_FAILOVERS = REGISTRY.counter(
+    "vegamind_llm_failovers_total", "Passaggi al provider successivo per fase, provider scartato e motivo (error, circuit_open).",
+    ["stage", "provider", "reason"])
+LLM_CIRCUIT_STATE = REGISTRY.gauge(
+    "vegamind_llm_circuit_state", "Stato del circuit breaker per provider (0 chiuso, 1 in prova, 2 aperto).", ["provider"])
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyWindow:
+    """Durate delle ultime chiamate riuscite di un (provider, modello), per stimarne un quantile."""
+
+    def __init__(self, size=200):
+        self._durations = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, duration):
+        with self._lock:
+            self._durations.append(duration)
+
+    def quantile(self, q, min_samples):
+        """Quantile `q` delle durate, None con meno di `min_samples` campioni."""
+        with self._lock:
+            if len(self._durations) < max(1, min_samples):
+                return None
+            durations = sorted(self._durations)
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker di un provider.
+
+    - closed: le richieste passano; dopo `failure_threshold` errori consecutivi il circuito si apre.
+    - open: le richieste vengono rifiutate per `reset_timeout` secondi.
+    - half_open: passa una sola richiesta di prova; se riesce il circuito si chiude, altrimenti si riapre.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, provider, failure_threshold=5, reset_timeout=30.0):
+        self.provider = provider
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        LLM_CIRCUIT_STATE.labels(provider=provider).set(0)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker `%s`: %s -> %s", self.provider, self.state, state)
+        self.state = state
+        LLM_CIRCUIT_STATE.labels(provider=self.provider).set(self.STATE_VALUES[state])
+
+    def allow(self):
+        """True se la richiesta può partire (in half_open solo la prima, come prova)."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    @property
+    def closed(self):
+        return self.state == self.CLOSED
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def error(self, error):
+        """
+        Esito di una richiesta fallita. Un 429 segnala la quota del provider, non un guasto (può dipendere
+        anche dall'ingestion che condivide il gateway): libera la prova in corso senza contare un errore.
+        """
+        if getattr(error, "status_code", None) == 429:
+            self.release()
+        else:
+            self.failure()
+
+    def release(self):
+        """Richiesta interrotta senza esito (es. hedge perdente cancellato): libera la prova in corso."""
+        with self._lock:
+            self._probing = False
+
+
+class CallPolicy:
+    """
+    Politica delle chiamate LLM del gateway:
+
+    - failover: per ogni fase, elenco ordinato di (provider, modello) da provare finché uno risponde;
+      le fasi non configurate usano solo il provider richiesto dal chiamante;
+    - circuit breaker per provider: un provider degradato viene saltato finché non supera una prova;
+    - hedging: se una chiamata supera il quantile `quantile` delle durate recenti del suo (provider, modello),
+      ne parte un duplicato e vince la prima risposta.
+    """
+
+    def __init__(self, failover=None, hedging=False, quantile=0.95, min_samples=20, window=200,
+                 min_delay=0.5, max_delay=10.0, failure_threshold=5, reset_timeout=30.0):
+        # {fase: [(provider, modello o None), ...]}
+        self.failover = {
+            stage: [(entry["provider"], entry.get("model")) for entry in entries]
+            for stage, entries in (failover or {}).items() if entries
+        }
+        self.hedging = hedging
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        policy_config = config.get("llm", {}).get("policy", {})
+        hedging_config = policy_config.get("hedging", {})
+        breaker_config = policy_config.get("circuit_breaker", {})
+        return cls(
+            failover=policy_config.get("failover", {}),
+            hedging=hedging_config.get("enabled", False),
+            quantile=hedging_config.get("quantile", 0.95),
+            min_samples=hedging_config.get("min_samples", 20),
+            window=hedging_config.get("window", 200),
+            min_delay=hedging_config.get("min_delay", 0.5),
+            max_delay=hedging_config.get("max_delay", 10.0),
+            failure_threshold=breaker_config.get("failure_threshold", 5),
+            reset_timeout=breaker_config.get("reset_timeout", 30.0)
+        )
+
+    def candidates(self, stage, provider, model=None):
+        """(provider, modello) da provare in ordine per la fase."""
+        return self.failover.get(stage) or [(provider, model)]
+
+    def breaker(self, provider):
+        with self._lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker(provider, self.failure_threshold, self.reset_timeout)
+            return self._breakers[provider]
+
+    def _window(self, provider, model):
+        with self._lock:
+            key = (provider, model)
+            if key not in self._latencies:
+                self._latencies[key] = LatencyWindow(self.window)
+            return self._latencies[key]
+
+    def record_latency(self, provider, model, duration):
+        self._window(provider, model).add(duration)
+
+    def hedge_delay(self, provider, model):
+        """Attesa prima del duplicato (quantile recente, limitato a [min_delay, max_delay]); None = niente hedging."""
+        if not self.hedging:
+            return None
+        delay = self._window(provider, model).quantile(self.quantile, self.min_samples)
+        if delay is None:
+            return None
+        return min(max(delay, self.min_delay), self.max_delay)
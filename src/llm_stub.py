@@ -0,0 +1,276 @@
+"""
+Server LLM locale per esecuzioni senza provider: parla il protocollo di Groq (compatibile OpenAI, anche in streaming)
+e quello di Gemini `generateContent`, con latenza, quota ed errori configurabili.
+
+    python -m src.llm_stub --port 8100 --cassette data/cassettes/llm.jsonl --latency 0.3 --error-rate 0.05
+
+Per usarlo: `groq.base_url: "http://127.0.0.1:8100"` e
+`google.model: "http://127.0.0.1:8100/v1beta/models/gemini-1.5-flash-latest:generateContent?key="`.
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.cassette import Cassette, cassette_key
+from src.rate_limiter import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+GROQ_PATH = "/openai/v1/chat/completions"
+GEMINI_PATH = re.compile(r"^/v1beta/models/(?P<model>[^/:]+):generateContent$")
+
+
+class StubBehavior:
+    """
+    Comportamento del server: risposte (dalla cassetta, altrimenti `default_response`), latenza, quota ed errori.
+
+    - latency ± jitter: attesa prima di ogni risposta; `chunk_delay` tra i frammenti di uno stream.
+    - error_rate: frazione di richieste che falliscono con `error_status` (429 con Retry-After `retry_after`).
+    - requests_per_minute: quota simulata a finestre di un minuto; oltre la quota si risponde 429 fino alla
+      finestra successiva. Le risposte riportano gli header `x-ratelimit-*` come Groq.
+    """
+
+    def __init__(self, cassette=None, default_response="OK", latency=0.0, jitter=0.0, chunk_delay=0.0,
+                 error_rate=0.0, error_status=429, retry_after=1.0, requests_per_minute=None, seed=None):
+        self.cassette = cassette
+        self.default_response = default_response
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self._random = random.Random(seed)
+        self._window_start = time.time()
+        self._window_requests = 0
+        self._lock = threading.Lock()
+
+    def response_text(self, provider, model, texts, temperature):
+        text = self.cassette.get(cassette_key(provider, model, texts, temperature)) if self.cassette else None
+        return text if text is not None else self.default_response
+
+    def delay(self):
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        return max(0.0, self.latency + jitter)
+
+    def admit(self):
+        """(errore da restituire o None, header di rate limit) per una nuova richiesta."""
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= 60:
+                self._window_start, self._window_requests = now, 0
+            reset = max(0.0, 60 - (now - self._window_start))
+            headers = {}
+            if self.requests_per_minute:
+                if self._window_requests >= self.requests_per_minute:
+                    headers = {
+                        "x-ratelimit-limit-requests": str(self.requests_per_minute),
+                        "x-ratelimit-remaining-requests": "0",
+                        "x-ratelimit-reset-requests": f"{reset:.2f}s",
+                        "retry-after": str(max(1, round(reset))),
+                    }
+                    return (429, reset), headers
+                self._window_requests += 1
+                headers = {
+                    "x-ratelimit-limit-requests": str(self.requests_per_minute),
+                    "x-ratelimit-remaining-requests": str(self.requests_per_minute - self._window_requests),
+                    "x-ratelimit-reset-requests": f"{reset:.2f}s",
+                }
+            if self.error_rate and self._random.random() < self.error_rate:
+                error_headers = {"retry-after": str(self.retry_after)} if self.error_status == 429 else {}
+                return (self.error_status, self.retry_after), {**headers, **error_headers}
+        return None, headers
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    behavior = StubBehavior()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send(self, status, body, headers=None, content_type="application/json"):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        # Il corpo va sempre letto, altrimenti resterebbe sulla connessione keep-alive
+        try:
+            request = self._read_json()
+        except json.JSONDecodeError:
+            self._send(400, {"error": {"message": "JSON non valido"}})
+            return
+        path = self.path.split("?", 1)[0]
+        gemini = GEMINI_PATH.match(path)
+        if path != GROQ_PATH and gemini is None:
+            self._send(404, {"error": {"message": f"Percorso sconosciuto: {path}"}})
+            return
+
+        error, headers = self.behavior.admit()
+        time.sleep(self.behavior.delay())
+        if error is not None:
+            self._send_error(gemini is not None, error, headers)
+        elif gemini is not None:
+            self._gemini(gemini.group("model"), request, headers)
+        else:
+            self._groq(request, headers)
+
+    def _send_error(self, is_gemini, error, headers):
+        status, retry_after = error
+        if is_gemini:
+            details = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{retry_after:.2f}s"}]
+            body = {"error": {"code": status, "message": "Errore simulato", "status": "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE",
+                              "details": details if status == 429 else []}}
+        else:
+            body = {"error": {"message": "Errore simulato", "type": "rate_limit_exceeded" if status == 429 else "server_error"}}
+        self._send(status, body, headers)
+
+    def _groq(self, request, headers):
+        messages = request.get("messages", [])
+        texts = [message.get("content", "") for message in messages]
+        model = request.get("model", "")
+        text = self.behavior.response_text("groq", model, texts, request.get("temperature"))
+        prompt_tokens = sum(estimate_tokens(content) for content in texts)
+        completion_tokens = estimate_tokens(text)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not request.get("stream"):
+            self._send(200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            }, headers)
+            return
+
+        # Stream SSE: un frammento per parola, poi il frammento finale e [DONE]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event({"role": "assistant", "content": ""})
+        for piece in re.findall(r"\S+\s*|\s+", text):
+            time.sleep(self.behavior.chunk_delay)
+            event({"content": piece})
+        event({}, "stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _gemini(self, model, request, headers):
+        parts = [part for content in request.get("contents", []) for part in content.get("parts", [])]
+        texts = [part.get("text", "") for part in parts]
+        temperature = request.get("generationConfig", {}).get("temperature")
+        text = self.behavior.response_text("gemini", model, texts, temperature)
+        prompt_tokens = sum(estimate_tokens(content) for content in texts)
+        completion_tokens = estimate_tokens(text)
+        self._send(200, {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": completion_tokens,
+                              "totalTokenCount": prompt_tokens + completion_tokens},
+        }, headers)
+
+
+class StubLLMServer:
+    """Server stub in un thread in background (per benchmark e test): `start()` / `stop()` o `with StubLLMServer(...)`."""
+
+    def __init__(self, host="127.0.0.1", port=0, behavior=None):
+        handler = type("Handler", (StubHandler,), {"behavior": behavior or StubBehavior()})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def gemini_model_url(self, model="gemini-1.5-flash-latest"):
+        """Valore di `google.model` che punta al server."""
+        return f"{self.url}/v1beta/models/{model}:generateContent?key="
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="llm-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server LLM locale (Groq/OpenAI e Gemini) per esecuzioni offline.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--cassette", help="Cassetta JSONL da cui servire le risposte registrate")
+    parser.add_argument("--default-response", default="OK", help="Risposta alle chiamate assenti dalla cassetta")
+    parser.add_argument("--latency", type=float, default=0.0, help="Secondi di attesa prima di ogni risposta")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Variazione casuale (±) della latenza")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Secondi tra i frammenti di uno stream")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Frazione di richieste che falliscono")
+    parser.add_argument("--error-status", type=int, default=429, help="Stato HTTP degli errori simulati")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After (secondi) degli errori 429")
+    parser.add_argument("--requests-per-minute", type=int, help="Quota simulata (429 oltre la quota)")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    behavior = StubBehavior(
+        cassette=Cassette("replay", args.cassette, on_miss="live") if args.cassette else None,
+        default_response=args.default_response,
+        latency=args.latency,
+        jitter=args.jitter,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        requests_per_minute=args.requests_per_minute,
+        seed=args.seed
+    )
+    server = StubLLMServer(args.host, args.port, behavior)
+    logger.info("Server LLM stub in ascolto su %s", server.url)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from src import tracing
+
+# Tempi di una singola fase del percorso di query: da pochi ms (filtri, lookup) a decine di secondi (LLM)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Le fasi di ingestion lavorano su interi menu: da secondi a decine di minuti
+INGESTION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterValue:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # L'ultimo bucket è +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class _Metric:
+    """Metrica con etichette: ogni combinazione di valori delle etichette ha il proprio valore."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        value = self._values.get(key)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(key, self._new_value())
+        return value
+
+    def _samples(self, key, value):
+        yield self.name, _format_labels(self.labelnames, key), value.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self._values.items()):
+            for name, labels, sample in self._samples(key, value):
+                lines.append(f"{name}{labels} {_format_value(sample)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_value(self):
+        return _GaugeValue()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def _samples(self, key, value):
+        with value._lock:
+            counts, total, count = list(value.counts), value.sum, value.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            yield f"{self.name}_bucket", _format_labels(self.labelnames, key, ("le", _format_value(bound))), cumulative
+        yield f"{self.name}_sum", _format_labels(self.labelnames, key), total
+        yield f"{self.name}_count", _format_labels(self.labelnames, key), count
+
+
+class MetricsRegistry:
+    """Registro delle metriche del processo, esposto in formato Prometheus su /metrics."""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metrica `{name}` già registrata come {metric.type}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_DURATION = REGISTRY.histogram(
+    "vegamind_stage_duration_seconds", "Durata delle fasi di elaborazione di una query.", ["stage"])
+STAGE_IN_FLIGHT = REGISTRY.gauge(
+    "vegamind_stage_in_flight", "Fasi di elaborazione attualmente in corso.", ["stage"])
+STAGE_ERRORS = REGISTRY.counter(
+    "vegamind_stage_errors_total", "Fasi terminate con un'eccezione.", ["stage"])
+
+LLM_RETRIES = REGISTRY.counter(
+    "vegamind_llm_retries_total", "Chiamate LLM ripetute dopo un errore.", ["provider"])
+JSON_PARSE_FALLBACKS = REGISTRY.counter(
+    "vegamind_json_parse_fallbacks_total", "Risposte LLM non valide sostituite da un valore di default o da una nuova chiamata.", ["stage"])
+EMPTY_RESULTS = REGISTRY.counter(
+    "vegamind_empty_results_total", "Query terminate senza risultati.", ["reason"])
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "vegamind_http_requests_total", "Richieste HTTP servite.", ["path", "status"])
+HTTP_DURATION = REGISTRY.histogram(
+    "vegamind_http_request_duration_seconds", "Tempo fino all'invio della risposta (per gli stream: fino al primo byte).", ["path"])
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    "vegamind_http_requests_in_flight", "Richieste HTTP in corso.")
+
+INGESTION_DURATION = REGISTRY.histogram(
+    "vegamind_ingestion_duration_seconds", "Durata delle fasi di ingestion.", ["stage"], buckets=INGESTION_BUCKETS)
+INGESTION_IN_FLIGHT = REGISTRY.gauge(
+    "vegamind_ingestion_in_flight", "Fasi di ingestion attualmente in corso.", ["stage"])
+INGESTION_ITEMS = REGISTRY.counter(
+    "vegamind_ingestion_items_total", "Elementi prodotti dalle fasi di ingestion (piatti, embedding, documenti).", ["stage"])
+
+# Codice delle funzioni decorate con @timed -> nome della fase (annotazioni degli stack del profiler)
+STAGE_CODES = {}
+
+
+class StageTimer:
+    """
+    Context manager che misura una fase: istogramma della durata, gauge in corso e contatore degli errori.
+    Apre anche lo span omonimo nella traccia corrente (no-op se la richiesta non è campionata).
+    """
+
+    __slots__ = ("duration", "in_flight", "errors", "span", "start")
+
+    def __init__(self, duration, in_flight, errors=None, span=tracing.NOOP_SPAN):
+        self.duration = duration
+        self.in_flight = in_flight
+        self.errors = errors
+        self.span = span
+
+    def __enter__(self):
+        self.in_flight.inc()
+        self.span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration.observe(time.perf_counter() - self.start)
+        self.in_flight.dec()
+        self.span.__exit__(exc_type, exc, traceback)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc()
+        return False
+
+
+def track_stage(stage):
+    """Misura una fase del percorso di query: `with track_stage("decide_tool"): ...`"""
+    return StageTimer(
+        STAGE_DURATION.labels(stage=stage),
+        STAGE_IN_FLIGHT.labels(stage=stage),
+        STAGE_ERRORS.labels(stage=stage),
+        span=tracing.span(stage)
+    )
+
+
+def track_ingestion(stage):
+    """Misura una fase di ingestion: `with track_ingestion("upload_documents"): ...`"""
+    return StageTimer(INGESTION_DURATION.labels(stage=stage), INGESTION_IN_FLIGHT.labels(stage=stage), span=tracing.span(stage))
+
+
+def timed(stage, tracker=track_stage):
+    """Decoratore che misura ogni chiamata della funzione (sincrona o coroutine) come fase `stage`."""
+
+    def decorator(func):
+        STAGE_CODES[inspect.unwrap(func).__code__] = stage
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracker(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracker(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
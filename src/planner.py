@@ -0,0 +1,255 @@
+import copy
+import json
+import logging
+from src import deadline, tracing
+from src.llm_gateway import Answer, clean_response, extract_json
+from src.metrics import REGISTRY, timed
+from src.prompts import measure
+from src.response_cache import fingerprint
+from src.singleflight import SingleFlight, normalize_query
+
+PLANNER_RESULTS = REGISTRY.counter(
+    "vegamind_planner_results_total",
+    "Piani combinati (tool + filtri) per esito: ok, invalid_json, invalid_tool, invalid_filters, no_techniques, error.",
+    ["result"])
+
+logger = logging.getLogger(__name__)
+
+TOOLS = ("generate_filters", "generate_filters_sirius", "none")
+
+# Campi accettati da build_qdrant_filter per ciascuna sezione
+LIST_FIELDS = ("ingredients", "techniques", "planet", "exclude_ingredients", "exclude_techniques")
+AND_FIELDS = frozenset(LIST_FIELDS + ("restaurant_name", "chef_licenses", "chef_licenses_grades", "planet_distance"))
+OR_FIELDS = frozenset(("ingredients", "techniques"))
+OPERATORS = ("==", ">=", ">", "<=", "<")
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_names(value):
+    return isinstance(value, list) and all(isinstance(item, str) and item.strip() for item in value)
+
+
+def filters_problem(filters):
+    """Motivo per cui i filtri non sono nel formato accettato da build_qdrant_filter, o None se sono validi."""
+    if not isinstance(filters, dict) or not filters:
+        return "filtri vuoti o non in forma di oggetto"
+    unknown = set(filters) - {"AND", "OR", "min_should_count"}
+    if unknown:
+        return f"sezioni sconosciute: {sorted(unknown)}"
+    if not filters.get("AND") and not filters.get("OR"):
+        return "nessuna condizione"
+
+    for section, allowed in (("AND", AND_FIELDS), ("OR", OR_FIELDS)):
+        conditions = filters.get(section, {})
+        if not isinstance(conditions, dict):
+            return f"{section} non è un oggetto"
+        unknown = set(conditions) - allowed
+        if unknown:
+            return f"campi sconosciuti in {section}: {sorted(unknown)}"
+        for field in LIST_FIELDS:
+            if field in conditions and not is_names(conditions[field]):
+                return f"{section}.{field} non è una lista di nomi"
+
+    and_filters = filters.get("AND", {})
+    if "restaurant_name" in and_filters and not isinstance(and_filters["restaurant_name"], str):
+        return "AND.restaurant_name non è un nome"
+
+    licenses = and_filters.get("chef_licenses", [])
+    if not isinstance(licenses, list) or not all(
+        isinstance(item, dict) and isinstance(item.get("tipo_licenza"), str)
+        and item.get("operator") in OPERATORS and is_number(item.get("grade"))
+        for item in licenses
+    ):
+        return "AND.chef_licenses non valido"
+
+    grades = and_filters.get("chef_licenses_grades", {"operator": "==", "grade": 0})
+    if not isinstance(grades, dict) or grades.get("operator") not in OPERATORS or not is_number(grades.get("grade")):
+        return "AND.chef_licenses_grades non valido"
+
+    distances = and_filters.get("planet_distance", [])
+    if not isinstance(distances, list) or not all(
+        isinstance(item, dict) and isinstance(item.get("planet"), str)
+        and is_number(item.get("max_distance")) and item["max_distance"] > 0
+        for item in distances
+    ):
+        return "AND.planet_distance non valido"
+
+    min_should_count = filters.get("min_should_count", 1)
+    if not isinstance(min_should_count, int) or isinstance(min_should_count, bool) or min_should_count < 1:
+        return "min_should_count non valido"
+    return None
+
+
+class Plan:
+    """
+    Esito del planner: tool (None = routing da rifare) e filtri (None = da generare con il tool).
+    `model` è il modello che ha risposto (con il failover può non essere quello del provider configurato).
+    """
+
+    __slots__ = ("tool", "filters", "result", "model")
+
+    def __init__(self, tool, filters, result, model=None):
+        self.tool = tool
+        self.filters = filters
+        self.result = result
+        self.model = model
+
+
+class QueryPlanner:
+    """
+    Planner a un solo passaggio: un'unica chiamata al LLM sceglie il tool e genera i filtri,
+    nello stesso formato prodotto dai tool e accettato da `build_qdrant_filter`.
+
+    Il piano viene validato prima dell'uso:
+    - tool non valido: il routing e la generazione dei filtri seguono il percorso in due passi;
+    - tool valido ma filtri non validi: si salta solo il routing e i filtri vengono generati dal tool.
+    Solo i piani validi vengono memorizzati nella cache delle risposte (fase `plan`).
+    """
+
+    def __init__(self, agent, enabled=False, provider="gemini"):
+        self.agent = agent
+        self.provider = provider
+        # Il prompt riusa le istruzioni del tool dei filtri: senza il tool il planner resta spento
+        self.enabled = enabled and hasattr(agent.tools.get("generate_filters"), "build_instructions")
+        self.inflight = SingleFlight("plan")
+
+    @classmethod
+    def from_config(cls, config, agent):
+        planner_config = config.get("planner", {})
+        return cls(
+            agent,
+            enabled=planner_config.get("enabled", False),
+            provider=planner_config.get("provider", "gemini")
+        )
+
+    def extract_techniques(self, user_query):
+        """Tecniche del Manuale di Sirius Cosmo delle categorie citate nella domanda."""
+        sirius = self.agent.tools.get("generate_filters_sirius")
+        return sirius.extract_techniques(user_query) if sirius is not None else {}
+
+    def build_messages(self, user_query, techniques_by_category):
+        """Costruisce i messaggi del planner: regole di routing, istruzioni dei filtri e formato combinato."""
+        techniques_str = "\n".join(
+            f"{category}: {', '.join(techniques)}" for category, techniques in techniques_by_category.items()
+        ) if techniques_by_category else "Nessuna categoria del manuale citata nella domanda."
+
+        prompt = f"""
+        {self.agent.build_routing_rules()}
+
+        ### GENERAZIONE DEI FILTRI
+        Se il tool scelto non è "none", genera anche i filtri di ricerca seguendo queste istruzioni:
+        {self.agent.tools["generate_filters"].build_instructions([user_query])}
+
+        ### TECNICHE DEL MANUALE DI SIRIUS COSMO CITATE NELLA DOMANDA
+        {techniques_str}
+        - Con "generate_filters_sirius" le tecniche di queste categorie vengono aggiunte automaticamente ai filtri.
+
+        ### FORMATO DI RISPOSTA
+        - Rispondi con un unico oggetto JSON con le chiavi "tool" e "filters".
+        - "filters" segue il formato descritto sopra; con il tool "none" omettilo.
+
+        **Esempi di output:**
+        ```json
+        {{
+            "tool": "generate_filters",
+            "filters": {{"AND": {{"ingredients": ["ingrediente1"]}}}}
+        }}
+        ```
+        ```json
+        {{
+            "tool": "none"
+        }}
+        ```
+
+        --- DOMANDA UTENTE ---
+        {user_query}
+
+        --- RISPOSTA (solo JSON) ---
+        """
+
+        return [
+            {"role": "system", "content": self.agent.ROUTING_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+
+    def cache_template(self):
+        """Impronta del prompt: le tecniche incluse dipendono dal catalogo, la cui versione fa parte dell'impronta."""
+        return fingerprint(self.build_messages("{query}", {}), self.agent.catalog.current().version)
+
+    def cache_key(self, user_query, model=None):
+        return self.agent.cache.key(
+            "plan", self.cache_template(), model or self.agent.llm.model_name(self.provider), normalize_query(user_query)
+        )
+
+    def parse_plan(self, content, user_query, techniques_by_category):
+        """Valida la risposta del planner; i filtri vengono verificati costruendo il filtro Qdrant."""
+        tracing.debug("Risposta del planner ricevuta", response=lambda: clean_response(content))
+        try:
+            plan = extract_json(content)
+        except json.JSONDecodeError as e:
+            logger.warning("Risposta del planner non valida: %s", e)
+            return Plan(None, None, "invalid_json")
+
+        tool = plan.get("tool") if isinstance(plan, dict) else None
+        if tool not in TOOLS:
+            logger.warning("Tool del planner non valido: %r", tool)
+            return Plan(None, None, "invalid_tool")
+        if tool == "none":
+            return Plan(tool, None, "ok")
+        if tool == "generate_filters_sirius" and not techniques_by_category:
+            # Il tool risponde con il suo messaggio di errore, come nel percorso in due passi
+            return Plan(tool, None, "no_techniques")
+
+        filters = plan.get("filters")
+        problem = filters_problem(filters)
+        if problem is None:
+            if tool == "generate_filters_sirius":
+                filters = self.agent.tools[tool].add_techniques(filters, user_query, techniques_by_category)
+            try:
+                # build_qdrant_filter modifica i filtri che riceve
+                if self.agent.build_qdrant_filter(copy.deepcopy(filters)) is None:
+                    problem = "filtro Qdrant non costruito"
+            except Exception as e:
+                problem = f"filtro Qdrant non costruito: {e}"
+        if problem is not None:
+            logger.warning("Filtri del planner non validi (%s), li genera il tool %s", problem, tool)
+            return Plan(tool, None, "invalid_filters")
+
+        return Plan(tool, filters, "ok")
+
+    @timed("plan")
+    @deadline.with_deadline("plan")
+    async def aplan(self, user_query):
+        """Tool e filtri della domanda con una sola chiamata; in caso di errore restituisce un piano vuoto."""
+        cache_key = self.cache_key(user_query)
+        cached = await self.agent.cache.aget(cache_key)
+        if cached is not None:
+            return Plan(cached["tool"], cached["filters"], "ok")
+
+        try:
+            plan = await self.inflight.do(normalize_query(user_query), self._aplan, user_query)
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.warning("Planner non disponibile, uso il percorso in due passi: %s", e)
+            plan = Plan(None, None, "error")
+
+        PLANNER_RESULTS.inc(result=plan.result)
+        tracing.info("Piano: %s", plan.tool, result=plan.result)
+        if plan.result == "ok":
+            await self.agent.cache.aset(self.cache_key(user_query, plan.model), {"tool": plan.tool, "filters": plan.filters})
+        return plan
+
+    async def _aplan(self, user_query):
+        techniques_by_category = self.extract_techniques(user_query)
+        answer = Answer()
+        content = await self.agent.llm.achat(
+            self.provider, measure("plan", self.build_messages(user_query, techniques_by_category)), temperature=0.0, stage="plan",
+            answer=answer
+        )
+        plan = self.parse_plan(content, user_query, techniques_by_category)
+        plan.model = answer.model
+        return plan
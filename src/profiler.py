@@ -0,0 +1,329 @@
+import asyncio
+import contextvars
+import hmac
+import os
+import random
+import sys
+import sysconfig
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from src import tracing
+from src.metrics import REGISTRY, STAGE_CODES
+
+PROFILES = REGISTRY.counter(
+    "vegamind_profiles_total", "Profili salvati, per origine (header, sample, admin).", ["trigger"])
+PROFILES_SKIPPED = REGISTRY.counter(
+    "vegamind_profiles_skipped_total", "Profili richiesti ma non avviati perché il limite di sessioni era raggiunto.", ["trigger"])
+
+# Sessione di profiling della richiesta corrente: i task creati al suo interno vengono campionati
+_session = contextvars.ContextVar("vegamind_profile", default=None)
+
+# Profondità massima di uno stack campionato
+MAX_DEPTH = 128
+
+_STDLIB = sysconfig.get_paths()["stdlib"] + os.sep
+
+
+def _frame_label(code, _cache={}):
+    """Nome di una funzione nel formato `file:funzione`, senza `;` (separatore del formato collapsed)."""
+    label = _cache.get(code)
+    if label is None:
+        filename = code.co_filename
+        if "site-packages" in filename:
+            filename = filename.split("site-packages" + os.sep, 1)[-1]
+        elif filename.startswith(_STDLIB):
+            filename = filename[len(_STDLIB):]
+        elif filename.startswith(os.getcwd()):
+            filename = os.path.relpath(filename)
+        label = _cache[code] = f"{filename}:{code.co_qualname}".replace(";", ",")
+    return label
+
+
+def _append_frame(stack, code):
+    # Le fasi misurate con @timed vengono annotate nello stack (`[stage decide_tool]`)
+    stage = STAGE_CODES.get(code)
+    if stage is not None:
+        stack.append(f"[stage {stage}]")
+    stack.append(_frame_label(code))
+
+
+def _thread_stack(frame):
+    """Stack di un thread, dalla radice alla foglia."""
+    frames = []
+    while frame is not None and len(frames) < MAX_DEPTH:
+        frames.append(frame.f_code)
+        frame = frame.f_back
+    stack = []
+    for code in reversed(frames):
+        _append_frame(stack, code)
+    return stack
+
+
+def _coroutine_stack(coro):
+    """Stack di un task sospeso: la catena di coroutine in attesa, dalla radice all'oggetto atteso."""
+    stack = []
+    while coro is not None and len(stack) < MAX_DEPTH:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        _append_frame(stack, frame.f_code)
+        coro = getattr(coro, "cr_await", None) if hasattr(coro, "cr_await") else getattr(coro, "gi_yieldfrom", None)
+    if coro is not None:
+        stack.append(f"[await {type(coro).__name__}]")
+    return stack
+
+
+class ProfileSession:
+    """
+    Sessione di campionamento: un thread legge gli stack a intervalli regolari e li aggrega
+    nel formato "collapsed" (una riga `radice;...;foglia conteggio`), leggibile da flamegraph.pl e speedscope.
+
+    Ogni task asyncio tracciato produce un campione per intervallo: `on-cpu` se in quel momento
+    sta girando sull'event loop (stack reale del thread), `off-cpu` se è sospeso (catena di await).
+    Con `include_threads` vengono campionati anche tutti i thread del processo.
+    """
+
+    def __init__(self, trigger, label, interval, max_seconds, directory, trace_id=None, all_tasks=False, include_threads=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.trigger = trigger
+        self.label = label
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.directory = directory
+        self.trace_id = trace_id
+        self.all_tasks = all_tasks
+        self.include_threads = include_threads
+
+        self.tasks = set()
+        self.stacks = Tally()
+        self.samples = 0
+        self.overhead = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._loop = None
+        self._loop_thread_id = None
+
+    def start(self):
+        """Avvia il campionamento; va chiamato dal thread dell'event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _run(self):
+        deadline = self.started_at + self.max_seconds
+        while not self._stop.wait(self.interval):
+            start = time.perf_counter()
+            try:
+                self._sample()
+            except Exception as e:
+                tracing.debug("Campione di profiling scartato: %s", e)
+            self.overhead += time.perf_counter() - start
+            # Limite di sicurezza: il campionamento si ferma anche se la richiesta non termina
+            if time.monotonic() >= deadline:
+                break
+
+    def _sample(self):
+        frames = sys._current_frames()
+        own_id = threading.get_ident()
+
+        if self.include_threads:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id != own_id:
+                    self._record([f"thread {names.get(thread_id, thread_id)}"] + _thread_stack(frame))
+
+        tasks = asyncio.all_tasks(self._loop) if self.all_tasks else list(self.tasks)
+        running = asyncio.current_task(self._loop)
+        for task in tasks:
+            if task.done():
+                continue
+            if task is running and self._loop_thread_id in frames:
+                self._record(["on-cpu"] + _thread_stack(frames[self._loop_thread_id]))
+            else:
+                self._record(["off-cpu"] + _coroutine_stack(task.get_coro()))
+        self.samples += 1
+
+    def _record(self, stack):
+        self.stacks[";".join(stack)] += 1
+
+    def stop(self):
+        """Ferma il campionamento e salva il profilo; restituisce i metadati del file scritto."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        duration = time.monotonic() - self.started_at
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.trigger}-{self.id}.folded"
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+
+        PROFILES.labels(trigger=self.trigger).inc()
+        info = {
+            "name": name,
+            "path": path,
+            "trigger": self.trigger,
+            "label": self.label,
+            "trace_id": self.trace_id,
+            "duration_s": round(duration, 3),
+            "samples": self.samples,
+            "overhead_ms": round(self.overhead * 1000, 1),
+        }
+        tracing.info("Profilo salvato in %s (%d campioni)", path, self.samples, profile=info)
+        return info
+
+
+class Profiler:
+    """
+    Profiling a campionamento su richiesta, disattivato di default (sezione `profiling` della configurazione).
+
+    Una richiesta viene profilata se porta l'header `X-Profile` (con `token` configurato il valore deve
+    coincidere) oppure se viene estratta con probabilità `sample_rate`; in alternativa `/admin/profile`
+    campiona l'intero processo per qualche secondo. Al massimo `max_sessions` sessioni girano insieme:
+    oltre il limite la richiesta viene servita senza profiling.
+    """
+
+    HEADER = "x-profile"
+
+    def __init__(self, enabled=False, directory="logs/profiles", interval_ms=10, sample_rate=0.0,
+                 max_seconds=30, max_sessions=1, max_files=50, token=None, paths=()):
+        self.enabled = enabled
+        self.directory = directory
+        self.interval = max(1, interval_ms) / 1000
+        self.sample_rate = float(sample_rate)
+        self.max_seconds = max_seconds
+        self.max_sessions = max(1, int(max_sessions))
+        self.max_files = max_files
+        self.token = token
+        self.paths = set(paths)
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        profiling_config = config.get("profiling", {})
+        return cls(
+            enabled=profiling_config.get("enabled", False),
+            directory=profiling_config.get("dir", "logs/profiles"),
+            interval_ms=profiling_config.get("interval_ms", 10),
+            sample_rate=profiling_config.get("sample_rate", 0.0),
+            max_seconds=profiling_config.get("max_seconds", 30),
+            max_sessions=profiling_config.get("max_sessions", 1),
+            max_files=profiling_config.get("max_files", 50),
+            token=profiling_config.get("token"),
+            paths=profiling_config.get("paths", ["/process_query/"])
+        )
+
+    def install(self, loop):
+        """Installa sull'event loop la task factory che associa i nuovi task alla sessione che li crea."""
+        if not self.enabled:
+            return
+        previous = loop.get_task_factory()
+
+        def task_factory(loop, coro, context=None):
+            if previous is not None:
+                task = previous(loop, coro) if context is None else previous(loop, coro, context=context)
+            else:
+                task = asyncio.Task(coro, loop=loop, context=context)
+            session = _session.get() if context is None else context.get(_session)
+            if session is not None:
+                session.track(task)
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    def check_token(self, value):
+        return self.token is None or (value is not None and hmac.compare_digest(str(value), str(self.token)))
+
+    def is_admin(self, value):
+        """True se `value` è il token configurato; senza token nessuna richiesta è considerata admin."""
+        return self.token is not None and self.check_token(value)
+
+    def trigger_for(self, path, headers):
+        """Motivo per cui la richiesta va profilata (`header` o `sample`), None altrimenti."""
+        if not self.enabled or path not in self.paths:
+            return None
+        value = headers.get(self.HEADER)
+        if value is not None and self.check_token(value):
+            return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def _open(self, trigger, **kwargs):
+        with self._lock:
+            if self._active >= self.max_sessions:
+                PROFILES_SKIPPED.labels(trigger=trigger).inc()
+                return None
+            self._active += 1
+        return ProfileSession(trigger, interval=self.interval, max_seconds=self.max_seconds, directory=self.directory, **kwargs)
+
+    def _close(self, session):
+        try:
+            return session.stop()
+        finally:
+            with self._lock:
+                self._active -= 1
+            self._prune()
+
+    def start_request(self, trigger, label):
+        """
+        Avvia la profilazione della richiesta corrente (task corrente e task che creerà).
+        Restituisce (sessione, token del contextvar) oppure None se il limite di sessioni è raggiunto.
+        """
+        session = self._open(trigger, label=label, trace_id=tracing.current_trace_id())
+        if session is None:
+            return None
+        session.track(asyncio.current_task())
+        token = _session.set(session)
+        return session.start(), token
+
+    async def finish_request(self, session, token):
+        _session.reset(token)
+        return await asyncio.to_thread(self._close, session)
+
+    async def profile_process(self, seconds):
+        """Campiona tutti i thread e tutti i task del processo per `seconds` secondi (al massimo `max_seconds`)."""
+        session = self._open("admin", label="process", all_tasks=True, include_threads=True)
+        if session is None:
+            return None
+        session.start()
+        try:
+            await asyncio.sleep(min(seconds, self.max_seconds))
+        finally:
+            info = await asyncio.to_thread(self._close, session)
+        return info
+
+    def list_profiles(self):
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((name for name in os.listdir(self.directory) if name.endswith(".folded")), reverse=True)
+        return [{"name": name, "size": os.path.getsize(os.path.join(self.directory, name))} for name in names]
+
+    def profile_path(self, name):
+        """Percorso di un profilo salvato (None se non esiste); il nome non può uscire dalla cartella."""
+        if os.path.basename(name) != name or not name.endswith(".folded"):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def _prune(self):
+        """Conserva solo gli ultimi `max_files` profili."""
+        for profile in self.list_profiles()[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, profile["name"]))
+            except OSError:
+                pass
@@ -0,0 +1,38 @@
+from src.metrics import REGISTRY
+from src.rate_limiter import estimate_messages_tokens
+
+PROMPT_TOKENS = REGISTRY.histogram(
+    "vegamind_prompt_tokens", "Token stimati dei prompt inviati al LLM per fase.", ["stage"],
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000, 16000))
+
+# Etichette delle entità del catalogo nei prompt (in inglese e in italiano, come i prompt dei tool)
+ENTITY_LABELS = {
+    "restaurants": "Restaurants",
+    "planets": "Planets",
+    "ingredients": "Ingredients",
+    "techniques": "Techniques",
+    "licenses": "License types",
+}
+ENTITY_LABELS_IT = {
+    "restaurants": "Ristoranti",
+    "planets": "Pianeti",
+    "ingredients": "Ingredienti",
+    "techniques": "Tecniche",
+    "licenses": "Tipi di licenza",
+}
+
+
+def entity_lines(candidates, labels, empty):
+    """Righe "- Tipo: nome1, nome2" delle entità candidate; `empty` se non ce n'è nessuna."""
+    lines = [
+        f"- {label}: {', '.join(candidates[entity])}"
+        for entity, label in labels.items()
+        if candidates.get(entity)
+    ]
+    return "\n        ".join(lines) if lines else empty
+
+
+def measure(stage, messages):
+    """Registra i token stimati del prompt della fase e restituisce i messaggi invariati."""
+    PROMPT_TOKENS.labels(stage=stage).observe(estimate_messages_tokens(messages))
+    return messages
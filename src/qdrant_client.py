@@ -1,21 +1,31 @@
+import logging
 import qdrant_client
 from qdrant_client.models import VectorParams, Distance, PointStruct
+from src import deadline, tracing
 from src.config_loader import ConfigLoader
+from src.metrics import INGESTION_ITEMS, timed, track_ingestion
 
 class QdrantHandler:
-    def __init__(self, config_path="config/config.yaml"):
-        """Inizializza il client Qdrant con i parametri da config.yaml."""
-        self.config_loader = ConfigLoader(config_path)
-        self.config = self.config_loader.get_config()
+    def __init__(self, config_path="config/config.yaml", config=None):
+        """Inizializza il client Qdrant con i parametri da config.yaml (o con una configurazione già caricata)."""
+        self.logger = logging.getLogger(__name__)
+        if config is None:
+            config = ConfigLoader(config_path).get_config()
+        self.config = config
 
         try:
             self.client = qdrant_client.QdrantClient(
                 host=self.config["qdrant"]["host"],
                 port=self.config["qdrant"]["port"]
             )
-            print(f"[OK] Connesso a Qdrant su {self.config['qdrant']['host']}:{self.config['qdrant']['port']}")
+            # Client asincrono per il percorso di query non bloccante
+            self.async_client = qdrant_client.AsyncQdrantClient(
+                host=self.config["qdrant"]["host"],
+                port=self.config["qdrant"]["port"]
+            )
+            self.logger.info("Connesso a Qdrant su %s:%s", self.config["qdrant"]["host"], self.config["qdrant"]["port"])
         except Exception as e:
-            print(f"[ERRORE] Impossibile connettersi a Qdrant: {e}")
+            self.logger.error("Impossibile connettersi a Qdrant: %s", e)
 
     def setup_collection(self, vector_size):
         """Configura o ricrea la collezione in Qdrant."""
@@ -33,10 +43,11 @@ class QdrantHandler:
                 collection_name=self.config["qdrant"]["collection_name"],
                 vectors_config=VectorParams(size=vector_size, distance=selected_metric)
             )
-            print(f"[OK] Collezione `{self.config['qdrant']['collection_name']}` configurata con metrica `{metric}`")
+            self.logger.info("Collezione `%s` configurata con metrica `%s`", self.config["qdrant"]["collection_name"], metric)
         except Exception as e:
-            print(f"[ERRORE] Errore nella creazione della collezione: {e}")
+            self.logger.error("Errore nella creazione della collezione: %s", e)
 
+    @timed("upload_documents", tracker=track_ingestion)
     def upload_documents(self, embeddings, payload):
         """Carica i documenti nella collezione Qdrant usando `upsert`."""
         try:
@@ -49,9 +60,10 @@ class QdrantHandler:
                 collection_name=self.config["qdrant"]["collection_name"],
                 points=points
             )
-            print(f"[OK] Caricati {len(points)} documenti nella collezione `{self.config['qdrant']['collection_name']}`")
+            INGESTION_ITEMS.inc(len(points), stage="upload_documents")
+            self.logger.info("Caricati %d documenti nella collezione `%s`", len(points), self.config["qdrant"]["collection_name"])
         except Exception as e:
-            print(f"[ERRORE] Problema durante l'upload dei documenti: {e}")
+            self.logger.error("Problema durante l'upload dei documenti: %s", e)
 
     def search(self, query_vector, k=5, qdrant_filter=None):
         """Esegue una ricerca vettoriale nella collezione Qdrant con filtri opzionali.
@@ -71,12 +83,13 @@ class QdrantHandler:
                 limit=k,
                 query_filter=qdrant_filter  # Aggiungi il filtro Qdrant
             )
-            print(f"[OK] Ricerca completata: {len(results)} risultati trovati")
+            tracing.debug("Ricerca completata: %d risultati trovati", len(results))
             return results
         except Exception as e:
-            print(f"[ERRORE] Errore nella ricerca: {e}")
+            self.logger.error("Errore nella ricerca (trace %s): %s", tracing.current_trace_id(), e)
             return []
     
+    @timed("search_with_filters")
     def search_with_filters(self, qdrant_filter, k=5):
         """Esegue una ricerca in Qdrant basata solo sui filtri."""
         try:
@@ -89,5 +102,41 @@ class QdrantHandler:
             )
             return results[0]  # Restituisce la lista dei risultati
         except Exception as e:
-            print(f"[ERRORE] Errore durante la ricerca con filtri: {e}")
+            self.logger.error("Errore durante la ricerca con filtri (trace %s): %s", tracing.current_trace_id(), e)
+            return []
+
+    @timed("search_with_filters")
+    @deadline.with_deadline("search_with_filters")
+    async def asearch_with_filters(self, qdrant_filter, k=5):
+        """Versione asincrona di search_with_filters basata su AsyncQdrantClient."""
+        try:
+            results = await self.async_client.scroll(
+                collection_name=self.config["qdrant"]["collection_name"],
+                scroll_filter=qdrant_filter,
+                limit=k,
+                with_payload=True,
+                with_vectors=False
+            )
+            return results[0]  # Restituisce la lista dei risultati
+        except Exception as e:
+            self.logger.error("Errore durante la ricerca con filtri (trace %s): %s", tracing.current_trace_id(), e)
             return []
+
+    def warmup(self):
+        """
+        Apre la connessione verso Qdrant e verifica che la collezione sia raggiungibile.
+        Su un deployment nuovo la collezione non esiste finché non gira /setup_db/: il servizio è pronto
+        ma vuoto (le ricerche non trovano piatti) e il warm-up viene ripetuto alla fine del setup.
+        """
+        collection_name = self.config["qdrant"]["collection_name"]
+        if not self.client.collection_exists(collection_name=collection_name):
+            self.logger.warning("Collezione `%s` non ancora creata: eseguire /setup_db/ per caricare i dati", collection_name)
+            return
+        # Una scroll minima inizializza il pool di connessioni usato dalle query
+        self.client.scroll(collection_name=collection_name, limit=1, with_payload=False, with_vectors=False)
+        self.logger.info("Warm-up di Qdrant completato sulla collezione `%s`", collection_name)
+
+    async def aclose(self):
+        """Chiude il client Qdrant asincrono."""
+        if hasattr(self, "async_client"):
+            await self.async_client.close()
@@ -0,0 +1,315 @@
+import asyncio
+import email.utils
+import json
+import logging
+import os
+import re
+import threading
+import time
+from src.metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:  # Windows: il file di stato non viene bloccato, il lock vale solo tra i thread
+    fcntl = None
+
+LLM_THROTTLED = REGISTRY.counter(
+    "vegamind_llm_throttled_total", "Risposte 429 dei provider LLM alle chiamate sincrone (ingestion).", ["provider"])
+LLM_ADAPTIVE_RPM = REGISTRY.gauge(
+    "vegamind_llm_adaptive_rpm", "Richieste/minuto correnti del limiter adattivo per provider.", ["provider"])
+LLM_THROTTLE_WAIT = REGISTRY.counter(
+    "vegamind_llm_throttle_wait_seconds_total", "Attesa imposta dal limiter adattivo prima delle chiamate sincrone.", ["provider"])
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text):
+    """Stima approssimativa dei token di un testo (circa 4 caratteri per token)."""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+def estimate_messages_tokens(messages):
+    """Stima i token di una lista di messaggi in formato chat ({"role", "content"})."""
+    return sum(estimate_tokens(message.get("content", "")) for message in messages)
+
+
+class TokenBucket:
+    """
+    Token bucket asincrono: `capacity` token disponibili, ricaricati a `refill_rate` token al secondo.
+    I richiedenti vengono serviti in ordine di arrivo.
+    """
+
+    def __init__(self, capacity, refill_rate):
+        self.capacity = float(capacity)
+        self.refill_rate = float(refill_rate)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        """Attende finché `amount` token sono disponibili e li consuma."""
+        # Una richiesta più grande della capacità non potrebbe mai essere servita
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.refill_rate)
+
+    def adjust(self, delta):
+        """Restituisce (delta > 0) o addebita (delta < 0) token dopo aver conosciuto il consumo reale."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class ProviderRateLimiter:
+    """Limita richieste/minuto e token/minuto verso un singolo provider LLM."""
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, completion_tokens=0):
+        self.name = name
+        self.completion_tokens = completion_tokens
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0) if tokens_per_minute else None
+
+    async def acquire(self, prompt_tokens):
+        """Prenota una richiesta e i token stimati (prompt + completamento atteso). Restituisce la stima."""
+        estimated = prompt_tokens + self.completion_tokens
+        await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(estimated)
+        return estimated
+
+    def record_usage(self, estimated, actual):
+        """Corregge il bucket dei token con il consumo reale riportato dal provider."""
+        if self.tokens is not None and actual is not None:
+            self.tokens.adjust(estimated - actual)
+
+
+class RateLimiterRegistry:
+    """Registro dei rate limiter per provider, condiviso da agent e tool."""
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(__name__)
+        self.limiters = {}
+
+        for provider, limits in config.get("rate_limits", {}).items():
+            self.limiters[provider] = ProviderRateLimiter(
+                provider,
+                requests_per_minute=limits["requests_per_minute"],
+                tokens_per_minute=limits.get("tokens_per_minute"),
+                completion_tokens=limits.get("completion_tokens", 0)
+            )
+            self.logger.info(f"Rate limiter `{provider}`: {limits}")
+
+    async def acquire(self, provider, messages):
+        """Attende il proprio turno verso `provider`. Senza limiti configurati ritorna subito."""
+        limiter = self.limiters.get(provider)
+        if limiter is None:
+            return 0
+        return await limiter.acquire(estimate_messages_tokens(messages))
+
+    def record_usage(self, provider, estimated, actual):
+        """Registra i token effettivamente consumati da una richiesta."""
+        limiter = self.limiters.get(provider)
+        if limiter is not None:
+            limiter.record_usage(estimated, actual)
+
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value):
+    """Secondi di una durata negli header/corpi dei provider ("7.66s", "1m30s", "250ms", "30"); None se illeggibile."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _header(headers, name):
+    return headers.get(name) if headers is not None else None
+
+
+def retry_after(headers, body=None):
+    """
+    Attesa suggerita dal provider dopo un 429: header Retry-After (secondi o data HTTP),
+    reset dei contatori esauriti (x-ratelimit-reset-*, Groq) o `retryDelay` nel corpo (Gemini).
+    """
+    value = _header(headers, "retry-after")
+    if value is not None:
+        seconds = parse_duration(value)
+        if seconds is None:
+            try:
+                seconds = max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            return seconds
+
+    resets = [
+        parse_duration(_header(headers, f"x-ratelimit-reset-{kind}"))
+        for kind in ("requests", "tokens")
+        if _header(headers, f"x-ratelimit-remaining-{kind}") in ("0", 0)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    if resets:
+        return max(resets)
+
+    match = re.search(r'"retryDelay"\s*:\s*"([^"]+)"', body or "")
+    return parse_duration(match.group(1)) if match else None
+
+
+class AdaptiveRateLimiter:
+    """
+    Limiter sincrono e adattivo verso un provider, condiviso tra thread e (con `state_path`) tra processi.
+
+    - Le richieste partono distanziate di 60 / `rpm` secondi.
+    - AIMD: ogni risposta riuscita aggiunge `increase` richieste/minuto (fino a `max_rpm`);
+      un 429 moltiplica la velocità per `decrease` (fino a `min_rpm`) e sospende le richieste
+      per l'attesa indicata dal provider (Retry-After, reset dei contatori o retryDelay).
+    - Se gli header di una risposta riuscita indicano un contatore esaurito, si attende il suo reset.
+    Lo stato (velocità e prossimi orari utili, in tempo di sistema) vive in un file JSON protetto da un lock
+    di file, così più processi di ingestion si dividono la stessa quota.
+    """
+
+    def __init__(self, name, requests_per_minute, min_rpm=1.0, max_rpm=None, increase=1.0, decrease=0.5, state_path=None):
+        self.name = name
+        self.min_rpm = float(min_rpm)
+        self.max_rpm = float(max_rpm or requests_per_minute)
+        self.initial_rpm = min(max(float(requests_per_minute), self.min_rpm), self.max_rpm)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._state = None
+        if state_path:
+            os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+        LLM_ADAPTIVE_RPM.labels(provider=name).set(self.initial_rpm)
+
+    def _default_state(self):
+        return {"rpm": self.initial_rpm, "next_at": 0.0, "blocked_until": 0.0}
+
+    def _update(self, change):
+        """Applica `change(state, now)` allo stato condiviso sotto lock (thread e, se possibile, processi)."""
+        with self._lock:
+            if not self.state_path:
+                if self._state is None:
+                    self._state = self._default_state()
+                result = change(self._state, time.time())
+                LLM_ADAPTIVE_RPM.labels(provider=self.name).set(self._state["rpm"])
+                return result
+
+            with open(self.state_path, "a+", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = {**self._default_state(), **json.loads(f.read() or "{}")}
+                except json.JSONDecodeError:
+                    state = self._default_state()
+                state["rpm"] = min(max(float(state["rpm"]), self.min_rpm), self.max_rpm)
+                result = change(state, time.time())
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            LLM_ADAPTIVE_RPM.labels(provider=self.name).set(state["rpm"])
+            return result
+
+    def acquire(self):
+        """Attende il turno della prossima richiesta e lo prenota. Restituisce i secondi di attesa."""
+        waited = 0.0
+        while True:
+            def reserve(state, now):
+                start = max(state["next_at"], state["blocked_until"])
+                if start > now:
+                    return start - now
+                state["next_at"] = now + 60.0 / state["rpm"]
+                return 0.0
+
+            delay = self._update(reserve)
+            if delay <= 0:
+                break
+            # Gli orari possono cambiare nel frattempo (429 di un altro processo): si ricontrolla dopo l'attesa
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            LLM_THROTTLE_WAIT.inc(waited, provider=self.name)
+        return waited
+
+    def success(self, headers=None):
+        """Risposta riuscita: aumento additivo della velocità, salvo contatori esauriti secondo gli header."""
+        # Solo i contatori: su una risposta riuscita Retry-After non ha significato
+        wait = retry_after({
+            key.lower(): value for key, value in (headers or {}).items() if key.lower().startswith("x-ratelimit")
+        })
+
+        def change(state, now):
+            state["rpm"] = min(self.max_rpm, state["rpm"] + self.increase)
+            if wait:
+                state["blocked_until"] = max(state["blocked_until"], now + wait)
+
+        self._update(change)
+
+    def throttled(self, headers=None, body=None):
+        """Risposta 429: riduzione moltiplicativa e pausa. Restituisce l'attesa applicata (secondi)."""
+        LLM_THROTTLED.inc(provider=self.name)
+        suggested = retry_after(headers, body)
+
+        def change(state, now):
+            state["rpm"] = max(self.min_rpm, state["rpm"] * self.decrease)
+            wait = suggested if suggested is not None else 60.0 / state["rpm"]
+            state["blocked_until"] = max(state["blocked_until"], now + wait)
+            return wait
+
+        wait = self._update(change)
+        logger.warning("Rate limit di `%s` raggiunto: attesa di %.1fs", self.name, wait)
+        return wait
+
+
+class AdaptiveLimiterRegistry:
+    """Limiter adattivi per provider delle chiamate sincrone del gateway (`adaptive_limits`)."""
+
+    def __init__(self, config):
+        limits_config = config.get("adaptive_limits", {})
+        self.enabled = limits_config.get("enabled", False)
+        self.max_attempts = max(1, int(limits_config.get("max_attempts", 6)))
+        state_dir = limits_config.get("state_dir")
+        self.limiters = {}
+        if not self.enabled:
+            return
+
+        # La velocità iniziale è quella dei rate limit asincroni, se non indicata
+        rate_limits = config.get("rate_limits", {})
+        for provider, limits in limits_config.get("providers", {}).items():
+            self.limiters[provider] = AdaptiveRateLimiter(
+                provider,
+                requests_per_minute=limits.get(
+                    "requests_per_minute", rate_limits.get(provider, {}).get("requests_per_minute", 30)
+                ),
+                min_rpm=limits.get("min_rpm", 1),
+                max_rpm=limits.get("max_rpm"),
+                increase=limits_config.get("increase", 1),
+                decrease=limits_config.get("decrease", 0.5),
+                state_path=os.path.join(state_dir, f"{provider}.json") if state_dir else None
+            )
+
+    def get(self, provider):
+        return self.limiters.get(provider)
@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from src.metrics import REGISTRY
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "vegamind_cache_lookups_total", "Ricerche nella cache delle risposte per fase ed esito (memory, disk, miss).", ["stage", "result"])
+CACHE_EVICTIONS = REGISTRY.counter(
+    "vegamind_cache_evictions_total", "Voci rimosse dalla cache delle risposte per motivo (ttl, size, stale, invalidate).", ["reason"])
+CACHE_MEMORY_ENTRIES = REGISTRY.gauge(
+    "vegamind_cache_memory_entries", "Voci nella cache in memoria del worker.")
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*parts):
+    """Impronta breve di un template di prompt (e delle altre parti da cui dipende la risposta)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()[:16]
+
+
+class CacheKey:
+    """Chiave di una voce: fase, impronta del template e hash di (fase, template, modello, input normalizzato)."""
+
+    __slots__ = ("stage", "template", "digest")
+
+    def __init__(self, stage, template, model, value):
+        self.stage = stage
+        self.template = template
+        payload = json.dumps([stage, template, model, value], sort_keys=True, ensure_ascii=False, default=str)
+        self.digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache a corrispondenza esatta delle risposte LLM deterministiche (routing, filtri, risposte in chat).
+
+    - Chiave: (fase, impronta del template del prompt, modello, input normalizzato).
+    - Una LRU in memoria per worker davanti a un archivio SQLite su disco condiviso tra i worker e i riavvii.
+    - Ogni voce scade dopo il TTL della sua fase; oltre `memory_entries` / `disk_entries` si eliminano
+      le voci usate meno di recente.
+    - La prima volta che una fase si presenta con un'impronta diversa (prompt o catalogo cambiati)
+      le voci con l'impronta precedente vengono cancellate; `invalidate` svuota la cache esplicitamente.
+      Le impronte di tutte le fasi includono la versione del catalogo: dopo una nuova ingestion ogni worker
+      smette di usare le voci precedenti, anche quelle nella sua LRU, senza bisogno di `invalidate`.
+    - `aget`/`aset` (percorsi asincroni) leggono e scrivono su disco in un thread, fuori dall'event loop.
+
+    Vengono memorizzate solo le fasi elencate in `stages`; per le altre `key` restituisce None e
+    `get`/`set` non fanno nulla.
+    """
+
+    PRUNE_EVERY = 200
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            template TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        )
+    """
+
+    def __init__(self, enabled=True, path="data/cache/responses.sqlite3", memory_entries=2048,
+                 disk_entries=100000, ttl=604800, stages=None):
+        self.enabled = enabled
+        self.path = path
+        self.memory_entries = max(0, int(memory_entries))
+        self.disk_entries = max(1, int(disk_entries))
+        self.ttl = ttl
+        # {fase: TTL in secondi, None = ttl predefinito}
+        self.stages = dict(stages or {})
+        self._memory = OrderedDict()
+        self._templates = {}
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = self._open() if enabled and path else None
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.get("response_cache", {})
+        return cls(
+            enabled=cache_config.get("enabled", False),
+            path=cache_config.get("path", "data/cache/responses.sqlite3"),
+            memory_entries=cache_config.get("memory_entries", 2048),
+            disk_entries=cache_config.get("disk_entries", 100000),
+            ttl=cache_config.get("ttl", 604800),
+            stages=cache_config.get("stages", {})
+        )
+
+    def _open(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(self.SCHEMA)
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            return db
+        except sqlite3.Error as e:
+            logger.warning("Cache su disco non disponibile (%s), uso solo la memoria: %s", self.path, e)
+            return None
+
+    def _execute(self, sql, params=()):
+        """Esegue una query sull'archivio su disco; un errore SQLite non deve far fallire la richiesta."""
+        if self._db is None:
+            return None
+        try:
+            return self._db.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.warning("Errore della cache su disco: %s", e)
+            return None
+
+    def key(self, stage, template, model, value):
+        """Chiave della voce, o None se la fase non viene memorizzata."""
+        if not self.enabled or stage not in self.stages:
+            return None
+        return CacheKey(stage, template, model, value)
+
+    def get(self, key):
+        """Valore memorizzato per la chiave, o None."""
+        if key is None:
+            return None
+        self._reconcile(key)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key.digest)
+            if entry is not None:
+                _, _, value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key.digest)
+                    CACHE_LOOKUPS.inc(stage=key.stage, result="memory")
+                    return json.loads(value)
+                del self._memory[key.digest]
+                CACHE_EVICTIONS.inc(reason="ttl")
+
+            cursor = self._execute("SELECT value, expires_at FROM entries WHERE key = ?", (key.digest,))
+            row = cursor.fetchone() if cursor is not None else None
+            if row is not None and row[1] > now:
+                self._execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key.digest))
+                self._remember(key, row[0], row[1])
+                CACHE_LOOKUPS.inc(stage=key.stage, result="disk")
+                return json.loads(row[0])
+
+        CACHE_LOOKUPS.inc(stage=key.stage, result="miss")
+        return None
+
+    def set(self, key, value):
+        """Memorizza il valore (serializzabile in JSON) per la chiave."""
+        if key is None or value is None:
+            return
+        now = time.time()
+        ttl = self.stages.get(key.stage) or self.ttl
+        data = json.dumps(value, ensure_ascii=False)
+
+        with self._lock:
+            self._remember(key, data, now + ttl)
+            self._execute(
+                "INSERT OR REPLACE INTO entries (key, stage, template, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key.digest, key.stage, key.template, data, now + ttl, now)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune(now)
+
+    def _in_memory(self, key):
+        """True se la voce si può servire dalla memoria senza toccare il disco."""
+        entry = self._memory.get(key.digest)
+        return self._templates.get(key.stage) == key.template and entry is not None and entry[3] > time.time()
+
+    async def aget(self, key):
+        """Versione asincrona di get: le letture su disco avvengono in un thread."""
+        if key is None:
+            return None
+        if self._db is None or self._in_memory(key):
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key, value):
+        """Versione asincrona di set: la scrittura su disco avviene in un thread."""
+        if key is None or value is None:
+            return
+        if self._db is None:
+            self.set(key, value)
+            return
+        await asyncio.to_thread(self.set, key, value)
+
+    def _remember(self, key, data, expires_at):
+        self._memory[key.digest] = (key.stage, key.template, data, expires_at)
+        self._memory.move_to_end(key.digest)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            CACHE_EVICTIONS.inc(reason="size")
+        CACHE_MEMORY_ENTRIES.labels().set(len(self._memory))
+
+    def _prune(self, now):
+        """Elimina dal disco le voci scadute e, oltre `disk_entries`, quelle usate meno di recente."""
+        cursor = self._execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        if cursor is not None and cursor.rowcount > 0:
+            CACHE_EVICTIONS.inc(cursor.rowcount, reason="ttl")
+
+        cursor = self._execute("SELECT COUNT(*) FROM entries")
+        excess = cursor.fetchone()[0] - self.disk_entries if cursor is not None else 0
+        if excess > 0:
+            self._execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)", (excess,)
+            )
+            CACHE_EVICTIONS.inc(excess, reason="size")
+
+    def _reconcile(self, key):
+        """Alla prima impronta nuova di una fase cancella le voci create con il template precedente."""
+        if self._templates.get(key.stage) == key.template:
+            return
+        with self._lock:
+            if self._templates.get(key.stage) == key.template:
+                return
+            self._templates[key.stage] = key.template
+            removed = self._drop_memory(lambda stage, template: stage == key.stage and template != key.template)
+            cursor = self._execute("DELETE FROM entries WHERE stage = ? AND template != ?", (key.stage, key.template))
+            if cursor is not None:
+                removed = max(removed, cursor.rowcount)
+            if removed:
+                CACHE_EVICTIONS.inc(removed, reason="stale")
+                logger.info("Cache `%s`: template cambiato, %d voci invalidate", key.stage, removed)
+
+    def _drop_memory(self, predicate):
+        stale = [digest for digest, (stage, template, _, _) in self._memory.items() if predicate(stage, template)]
+        for digest in stale:
+            del self._memory[digest]
+        CACHE_MEMORY_ENTRIES.labels().set(len(self._memory))
+        return len(stale)
+
+    def invalidate(self, stage=None):
+        """Svuota la cache (o una sola fase), in memoria e su disco. Restituisce le voci rimosse."""
+        with self._lock:
+            removed = self._drop_memory(lambda entry_stage, _: stage is None or entry_stage == stage)
+            if stage is None:
+                cursor = self._execute("DELETE FROM entries")
+            else:
+                cursor = self._execute("DELETE FROM entries WHERE stage = ?", (stage,))
+            if cursor is not None:
+                removed = max(removed, cursor.rowcount)
+        if removed:
+            CACHE_EVICTIONS.inc(removed, reason="invalidate")
+        logger.info("Cache delle risposte invalidata (%s): %d voci", stage or "tutte le fasi", removed)
+        return removed
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
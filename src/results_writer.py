@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import tempfile
+import pandas as pd
+
+
+class ResultsWriter:
+    """
+    Sink dei risultati dell'elaborazione batch.
+
+    - I risultati vengono accumulati in memoria e scritti a blocchi di `flush_every`.
+    - Ogni scrittura riscrive il file di output ordinato per row_id e senza duplicati
+      su un file temporaneo, poi lo sostituisce con `os.replace` (commit atomico).
+    - Un checkpoint JSON tiene i row_id completati: un batch riavviato li salta.
+    - I risultati con errore non vengono scritti né segnati come completati, così vengono ritentati.
+    """
+
+    def __init__(self, output_path, checkpoint_path=None, flush_every=10):
+        self.logger = logging.getLogger(__name__)
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or f"{os.path.splitext(output_path)[0]}.checkpoint.json"
+        self.flush_every = max(1, int(flush_every))
+
+        self.results = {}  # row_id -> riga del file di output
+        self.completed = set()
+        self.pending = []
+
+        output_dir = os.path.dirname(self.output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Carica i risultati già salvati e il checkpoint di un'esecuzione precedente."""
+        if os.path.isfile(self.output_path):
+            try:
+                previous = pd.read_csv(self.output_path)
+                if "row_id" in previous.columns:
+                    previous = previous.dropna(subset=["row_id"])
+                    for record in previous.to_dict("records"):
+                        record["row_id"] = int(record["row_id"])
+                        self.results[record["row_id"]] = record
+            except Exception as e:
+                self.logger.warning(f"Impossibile leggere i risultati esistenti da {self.output_path}: {e}")
+
+        if os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path, "r") as f:
+                self.completed = {int(row_id) for row_id in json.load(f).get("completed", [])}
+
+        # Un crash tra il commit dei risultati e quello del checkpoint lascia righe già salvate
+        self.completed.update(self.results)
+        if self.completed:
+            print(f"[OK] Checkpoint caricato: {len(self.completed)} righe già completate.")
+
+    def is_completed(self, row_id):
+        return int(row_id) in self.completed
+
+    def add(self, row_id, result):
+        """Aggiunge il risultato di una riga; scrive su disco ogni `flush_every` risultati."""
+        if result is None or "error" in result:
+            self.logger.warning(f"Riga {row_id} non completata, verrà ritentata al prossimo avvio.")
+            return
+
+        self.pending.append({**result, "row_id": int(row_id)})
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Rende persistenti i risultati in attesa e aggiorna il checkpoint."""
+        if not self.pending:
+            return
+
+        for record in self.pending:
+            self.results[record["row_id"]] = record  # L'ultimo risultato per row_id vince
+        self.completed.update(record["row_id"] for record in self.pending)
+        self.pending = []
+
+        results_df = pd.DataFrame([self.results[row_id] for row_id in sorted(self.results)])
+        # row_id come prima colonna, come nel file di output originale
+        results_df = results_df[["row_id"] + [column for column in results_df.columns if column != "row_id"]]
+
+        self._atomic_write(self.output_path, lambda f: results_df.to_csv(f, index=False))
+        self._atomic_write(self.checkpoint_path, lambda f: json.dump({"completed": sorted(self.completed)}, f))
+
+    def _atomic_write(self, path, write):
+        directory = os.path.dirname(path) or "."
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, suffix=".tmp", newline="") as f:
+            tmp_path = f.name
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        """Elimina risultati e checkpoint per ripartire da zero."""
+        self.results, self.completed, self.pending = {}, set(), []
+        for path in (self.output_path, self.checkpoint_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def close(self):
+        self.flush()
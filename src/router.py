@@ -0,0 +1,269 @@
+import json
+import logging
+import math
+import os
+import queue
+import random
+import re
+import threading
+from collections import Counter
+from src.catalog import normalize_text
+from src.metrics import REGISTRY
+
+ROUTER_DECISIONS = REGISTRY.counter(
+    "vegamind_router_decisions_total", "Decisioni di routing per origine (rule, model, llm).", ["source"])
+ROUTER_ESCALATIONS = REGISTRY.counter(
+    "vegamind_router_escalations_total", "Domande passate al LLM per motivo (low_confidence, untrained).", ["reason"])
+ROUTER_AGREEMENT = REGISTRY.counter(
+    "vegamind_router_agreement_total",
+    "Confronti tra router locale e LLM (escalation: ipotesi poco sicure; audit: decisioni locali ricontrollate).",
+    ["check", "result"])
+ROUTER_SAMPLES = REGISTRY.gauge(
+    "vegamind_router_training_samples", "Decisioni del LLM usate per addestrare il classificatore locale.")
+
+logger = logging.getLogger(__name__)
+
+TOOLS = ("generate_filters", "generate_filters_sirius", "none")
+
+
+class Route:
+    """Decisione del router locale: tool (None = serve il LLM), origine, confidenza e ipotesi migliore."""
+
+    __slots__ = ("tool", "source", "confidence", "guess", "reason")
+
+    def __init__(self, tool, source, confidence=1.0, guess=None, reason=None):
+        self.tool = tool
+        self.source = source
+        self.confidence = confidence
+        self.guess = guess if guess is not None else tool
+        self.reason = reason
+
+
+# Regole del prompt di routing che dipendono solo da parole chiave
+RULES = (
+    (re.compile(r"\bsirius\b"), "generate_filters_sirius"),
+    (re.compile(r"\bimpast\w*\b.*\btagli\w*\b|\btagli\w*\b.*\bimpast\w*\b"), "generate_filters_sirius"),
+)
+
+
+def tokens(text):
+    """Parole e coppie di parole consecutive della domanda normalizzata."""
+    words = normalize_text(text).split()
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+class NaiveBayes:
+    """Naive Bayes multinomiale con smoothing di Laplace su parole e bigrammi."""
+
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+        self.samples = 0
+        self.priors = {}
+        self.likelihoods = {}
+        self.unknown = {}
+        self.vocabulary = frozenset()
+
+    def fit(self, samples):
+        counts = {}
+        labels = Counter()
+        for text, label in samples:
+            labels[label] += 1
+            counts.setdefault(label, Counter()).update(tokens(text))
+
+        vocabulary = frozenset().union(*counts.values()) if counts else frozenset()
+        self.vocabulary = vocabulary
+        self.samples = sum(labels.values())
+        self.priors = {label: math.log(count / self.samples) for label, count in labels.items()}
+        self.likelihoods, self.unknown = {}, {}
+        for label, label_counts in counts.items():
+            total = sum(label_counts.values()) + self.alpha * (len(vocabulary) + 1)
+            self.likelihoods[label] = {
+                token: math.log((count + self.alpha) / total) for token, count in label_counts.items()
+            }
+            self.unknown[label] = math.log(self.alpha / total)
+        return self
+
+    def predict(self, text):
+        """Etichetta più probabile e la sua probabilità a posteriori (None se non addestrato)."""
+        if not self.priors:
+            return None, 0.0
+        # Le parole mai viste in addestramento non danno informazione su nessuna etichetta
+        words = [token for token in tokens(text) if token in self.vocabulary]
+        scores = {
+            label: prior + sum(self.likelihoods[label].get(token, self.unknown[label]) for token in words)
+            for label, prior in self.priors.items()
+        }
+        best = max(scores, key=scores.get)
+        normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1.0 / normalizer
+
+
+class ToolRouter:
+    """
+    Router locale della scelta del tool: regole a parole chiave e un classificatore naive Bayes
+    addestrato sulle decisioni del LLM registrate in `log_path` (JSONL).
+
+    - Le regole rispondono sempre (confidenza 1).
+    - Il classificatore risponde solo se ha almeno `min_samples` esempi e la probabilità supera `threshold`;
+      altrimenti la domanda passa al LLM, la cui risposta diventa un nuovo esempio.
+    - Una frazione `audit_rate` delle decisioni locali viene ricontrollata dal LLM per misurare il disaccordo.
+    Il modello viene riaddestrato all'avvio e ogni `retrain_every` nuove decisioni del LLM. Scrittura del log
+    e riaddestramento avvengono in un thread dedicato: `record` non blocca l'event loop e il nuovo modello
+    sostituisce il precedente con un solo assegnamento.
+    """
+
+    def __init__(self, enabled=False, threshold=0.95, min_samples=50, log_path="data/router/decisions.jsonl",
+                 retrain_every=50, audit_rate=0.0, max_samples=20000):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.log_path = log_path
+        self.retrain_every = max(1, int(retrain_every))
+        self.audit_rate = audit_rate
+        self.max_samples = max_samples
+        self.model = NaiveBayes()
+        self._samples = []
+        self._since_training = 0
+        self._pending = queue.Queue()
+        self._trainer = None
+        self._lock = threading.Lock()
+        if enabled:
+            self._load()
+
+    @classmethod
+    def from_config(cls, config):
+        router_config = config.get("router", {})
+        return cls(
+            enabled=router_config.get("enabled", False),
+            threshold=router_config.get("threshold", 0.95),
+            min_samples=router_config.get("min_samples", 50),
+            log_path=router_config.get("log_path", "data/router/decisions.jsonl"),
+            retrain_every=router_config.get("retrain_every", 50),
+            audit_rate=router_config.get("audit_rate", 0.0),
+            max_samples=router_config.get("max_samples", 20000)
+        )
+
+    def _load(self):
+        if not self.log_path or not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("tool") in TOOLS and record.get("query"):
+                    self._samples.append((record["query"], record["tool"]))
+        self._samples = self._samples[-self.max_samples:]
+        self._train()
+        logger.info("Router locale addestrato su %d decisioni", self.model.samples)
+
+    def _train(self):
+        # `route` legge il modello senza lock: viene sostituito solo quando è completo
+        model = NaiveBayes().fit(self._samples)
+        self.model = model
+        self._since_training = 0
+        ROUTER_SAMPLES.labels().set(model.samples)
+
+    def route(self, query):
+        """Decisione locale; `tool` è None quando la domanda va passata al LLM."""
+        if not self.enabled:
+            return None
+        normalized = normalize_text(query)
+        for pattern, tool in RULES:
+            if pattern.search(normalized):
+                ROUTER_DECISIONS.inc(source="rule")
+                return Route(tool, "rule")
+
+        # Con una sola etichetta vista il classificatore sarebbe sempre "sicuro"
+        model = self.model
+        if model.samples < self.min_samples or len(model.priors) < 2:
+            ROUTER_ESCALATIONS.inc(reason="untrained")
+            return Route(None, "llm", 0.0, reason="untrained")
+
+        guess, confidence = model.predict(query)
+        if confidence < self.threshold:
+            ROUTER_ESCALATIONS.inc(reason="low_confidence")
+            return Route(None, "llm", confidence, guess=guess, reason="low_confidence")
+
+        ROUTER_DECISIONS.inc(source="model")
+        return Route(guess, "model", confidence)
+
+    def should_audit(self, route):
+        """True se la decisione del classificatore va ricontrollata dal LLM (campionamento)."""
+        return route is not None and route.source == "model" and random.random() < self.audit_rate
+
+    def compare(self, route, tool, check):
+        """Registra accordo o disaccordo tra l'ipotesi locale e la scelta del LLM."""
+        if route is None or route.guess is None:
+            return
+        agree = route.guess == tool
+        ROUTER_AGREEMENT.inc(check=check, result="agree" if agree else "disagree")
+        if not agree:
+            logger.info("Router locale in disaccordo con il LLM (%s): %s invece di %s", check, route.guess, tool)
+
+    def record(self, query, tool):
+        """
+        Aggiunge una decisione del LLM agli esempi. Il log e il riaddestramento (ogni `retrain_every` decisioni)
+        vengono aggiornati dal thread di addestramento: la chiamata non blocca.
+        """
+        if not self.enabled or tool not in TOOLS:
+            return
+        ROUTER_DECISIONS.inc(source="llm")
+        self._start_trainer()
+        self._pending.put((query, tool))
+
+    def _start_trainer(self):
+        if self._trainer is not None:
+            return
+        with self._lock:
+            if self._trainer is None:
+                self._trainer = threading.Thread(target=self._run_trainer, name="router-trainer", daemon=True)
+                self._trainer.start()
+
+    def _run_trainer(self):
+        while True:
+            # Le decisioni arrivate nel frattempo vengono scritte insieme
+            decisions = [self._pending.get()]
+            while True:
+                try:
+                    decisions.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._learn([decision for decision in decisions if decision is not None])
+            except Exception as e:
+                logger.warning("Errore nell'aggiornamento del router locale: %s", e)
+            finally:
+                for _ in decisions:
+                    self._pending.task_done()
+            if None in decisions:
+                return
+
+    def _learn(self, decisions):
+        """Scrive le decisioni nel log e riaddestra il classificatore quando serve (nel thread di addestramento)."""
+        if not decisions:
+            return
+        if self.log_path:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps({"query": query, "tool": tool}, ensure_ascii=False) + "\n" for query, tool in decisions)
+        self._samples.extend(decisions)
+        if len(self._samples) > self.max_samples:
+            del self._samples[:len(self._samples) - self.max_samples]
+        self._since_training += len(decisions)
+        if self._since_training >= self.retrain_every:
+            self._train()
+
+    def flush(self):
+        """Attende che le decisioni registrate siano nel log e nel modello."""
+        if self._trainer is not None:
+            self._pending.join()
+
+    def close(self):
+        """Completa gli aggiornamenti in corso e ferma il thread di addestramento."""
+        with self._lock:
+            trainer, self._trainer = self._trainer, None
+        if trainer is not None:
+            self._pending.put(None)
+            trainer.join(timeout=10)
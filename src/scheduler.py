@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from src.metrics import REGISTRY
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "vegamind_scheduler_queue_depth", "Lavori in attesa di uno slot dello scheduler.", ["priority"])
+RUNNING = REGISTRY.gauge(
+    "vegamind_scheduler_running", "Lavori in esecuzione per priorità.", ["priority"])
+WAIT_SECONDS = REGISTRY.histogram(
+    "vegamind_scheduler_wait_seconds", "Attesa in coda prima di ottenere uno slot.", ["priority"])
+REJECTED = REGISTRY.counter(
+    "vegamind_scheduler_rejected_total", "Richieste rifiutate perché la coda era piena.", ["priority"])
+
+
+class QueueFull(Exception):
+    """Sollevata quando la coda delle richieste interattive è piena."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Coda piena, riprovare tra {retry_after} secondi")
+        self.retry_after = retry_after
+
+
+class Slot:
+    """Slot ottenuto dallo scheduler; va rilasciato (anche con `with`) al termine del lavoro."""
+
+    __slots__ = ("scheduler", "priority", "started_at", "released")
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.release()
+        return False
+
+
+class PriorityScheduler:
+    """
+    Controllo di ammissione tra traffico interattivo (chat, query singole) e batch (CSV).
+
+    - Al massimo `max_concurrency` lavori girano insieme; quando uno slot si libera
+      viene assegnato al lavoro in attesa con priorità più alta (poi in ordine di arrivo).
+    - Il batch non può occupare più di `batch_max_concurrency` slot: una parte resta sempre
+      libera per la chat. Il batch acquisisce uno slot per gruppo di domande, quindi cede il
+      passo alle richieste interattive al termine di ogni gruppo.
+    - Oltre `max_queue` richieste interattive in attesa, le nuove vengono rifiutate con
+      `QueueFull` (HTTP 429) e un Retry-After stimato dal tempo medio di servizio.
+    """
+
+    INTERACTIVE = 0
+    BATCH = 1
+    NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+    def __init__(self, max_concurrency=8, batch_max_concurrency=4, max_queue=32, default_retry_after=5):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.batch_max_concurrency = max(1, min(int(batch_max_concurrency), self.max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.default_retry_after = default_retry_after
+
+        self.running = {self.INTERACTIVE: 0, self.BATCH: 0}
+        self.waiting = {self.INTERACTIVE: 0, self.BATCH: 0}
+        self._queue = []  # heap di (priorità, sequenza, istante di accodamento, future)
+        self._sequence = itertools.count()
+
+        # Media mobile del tempo di servizio di uno slot, per stimare il Retry-After
+        self._service_time = None
+
+    @classmethod
+    def from_config(cls, config):
+        scheduler_config = config.get("scheduler", {})
+        return cls(
+            max_concurrency=scheduler_config.get("max_concurrency", 8),
+            batch_max_concurrency=scheduler_config.get("batch_max_concurrency", 4),
+            max_queue=scheduler_config.get("max_queue", 32),
+            default_retry_after=scheduler_config.get("retry_after", 5)
+        )
+
+    def _can_run(self, priority):
+        if sum(self.running.values()) >= self.max_concurrency:
+            return False
+        return priority != self.BATCH or self.running[self.BATCH] < self.batch_max_concurrency
+
+    def retry_after(self):
+        """Stima in secondi di quando si libererà uno slot per una nuova richiesta interattiva."""
+        if self._service_time is None:
+            return self.default_retry_after
+        rounds = (self.waiting[self.INTERACTIVE] + 1) / self.max_concurrency
+        return max(1, math.ceil(self._service_time * rounds))
+
+    def check_admission(self, priority=INTERACTIVE):
+        """Solleva QueueFull se una nuova richiesta interattiva dovrebbe attendere in una coda già piena."""
+        if priority == self.INTERACTIVE and not self._can_run(priority) and self.waiting[priority] >= self.max_queue:
+            REJECTED.labels(priority=self.NAMES[priority]).inc()
+            raise QueueFull(self.retry_after())
+
+    async def acquire(self, priority=INTERACTIVE, bounded=True):
+        """
+        Attende uno slot e lo restituisce.
+
+        :param bounded: Se True (default per le richieste interattive) rifiuta con QueueFull quando la coda è piena.
+        """
+        if bounded:
+            self.check_admission(priority)
+
+        name = self.NAMES[priority]
+        start = time.monotonic()
+
+        # Nessuno in coda davanti: lo slot viene assegnato subito
+        if not self._queue and self._can_run(priority):
+            return self._grant(priority, start)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), start, future))
+        # In coda potrebbero esserci solo lavori batch fermi al loro limite: si prova subito ad assegnare
+        self._dispatch()
+        if future.done():
+            return future.result()
+
+        self.waiting[priority] += 1
+        QUEUE_DEPTH.labels(priority=name).inc()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Il chiamante ha rinunciato (es. client disconnesso): se lo slot era già stato assegnato lo restituisce
+            if future.done() and not future.cancelled():
+                self._release(future.result())
+            raise
+        finally:
+            self.waiting[priority] -= 1
+            QUEUE_DEPTH.labels(priority=name).dec()
+        return future.result()
+
+    def _grant(self, priority, start):
+        name = self.NAMES[priority]
+        self.running[priority] += 1
+        RUNNING.labels(priority=name).inc()
+        WAIT_SECONDS.labels(priority=name).observe(time.monotonic() - start)
+        return Slot(self, priority)
+
+    def _release(self, slot):
+        self.running[slot.priority] -= 1
+        RUNNING.labels(priority=self.NAMES[slot.priority]).dec()
+
+        elapsed = time.monotonic() - slot.started_at
+        self._service_time = elapsed if self._service_time is None else 0.8 * self._service_time + 0.2 * elapsed
+        self._dispatch()
+
+    def _dispatch(self):
+        """Assegna gli slot liberi ai lavori in attesa, in ordine di priorità."""
+        skipped = []
+        while self._queue and sum(self.running.values()) < self.max_concurrency:
+            entry = heapq.heappop(self._queue)
+            priority, _, enqueued_at, future = entry
+            if future.done():
+                continue  # Attesa cancellata
+            if not self._can_run(priority):
+                # Batch al suo limite: resta in coda senza bloccare le richieste interattive dietro di lui
+                skipped.append(entry)
+                continue
+            future.set_result(self._grant(priority, enqueued_at))
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
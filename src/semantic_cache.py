@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import numpy as np
+from src.catalog import normalize_text
+from src.metrics import REGISTRY
+
+SEMANTIC_LOOKUPS = REGISTRY.counter(
+    "vegamind_semantic_cache_lookups_total",
+    "Ricerche nella cache semantica per esito (hit, miss, mismatch: simile ma con entità diverse, error).", ["result"])
+SEMANTIC_SIMILARITY = REGISTRY.histogram(
+    "vegamind_semantic_cache_similarity", "Similarità della domanda più vicina nell'indice (per tarare la soglia).",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.96, 0.98, 0.99, 1.0))
+SEMANTIC_ENTRIES = REGISTRY.gauge(
+    "vegamind_semantic_cache_entries", "Domande nell'indice della cache semantica del worker.")
+
+logger = logging.getLogger(__name__)
+
+# Parole che cambiano il significato dei filtri anche tra domande quasi identiche
+# ("piatti con X" / "piatti senza X", "almeno due" / "almeno tre")
+OPERATORS = frozenset({
+    "non", "senza", "escluso", "esclusi", "esclusa", "escluse", "tranne", "eccetto",
+    "almeno", "massimo", "minimo", "meno", "più", "oltre", "entro", "oppure",
+    "tutti", "tutte", "entrambi", "entrambe",
+    "due", "tre", "quattro", "cinque", "sei", "sette", "otto", "nove", "dieci",
+})
+NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+WORD = re.compile(r"[^\W\d_][\w'-]*")
+SENTENCE = re.compile(r"[.?!:;]+")
+
+
+def signature(text, catalog):
+    """
+    Insieme delle entità di una domanda: entità del catalogo citate, nomi propri (parole maiuscole
+    non a inizio frase, es. ingredienti non ancora nel catalogo), numeri e operatori.
+    Due domande possono condividere i filtri solo se hanno la stessa firma.
+    """
+    parts = set()
+    for entity, names in catalog.mentions(text).items():
+        parts.update(f"{entity}:{normalize_text(name)}" for name in names)
+    for sentence in SENTENCE.split(text):
+        words = WORD.findall(sentence)
+        parts.update(f"name:{word.lower()}" for word in words[1:] if word[0].isupper())
+    parts.update(f"number:{number.replace(',', '.')}" for number in NUMBER.findall(text))
+    parts.update(f"operator:{word}" for word in normalize_text(text).split() if word in OPERATORS)
+    return sorted(parts)
+
+
+class Probe:
+    """Esito della ricerca di una domanda: embedding e firma (per l'inserimento) e l'eventuale voce trovata."""
+
+    __slots__ = ("vector", "signature", "template", "hit", "similar_query", "similarity")
+
+    def __init__(self, vector, signature, template):
+        self.vector = vector
+        self.signature = signature
+        self.template = template
+        self.hit = None
+        self.similar_query = None
+        self.similarity = None
+
+
+class SemanticCache:
+    """
+    Cache semantica delle coppie (tool, filtri) generate per le domande passate.
+
+    Ogni domanda viene trasformata in embedding e confrontata (similarità coseno) con un piccolo indice
+    numpy delle domande già elaborate. Se una domanda supera `threshold` e ha la stessa firma di entità,
+    tool e filtri vengono riutilizzati e si saltano sia il routing sia la generazione dei filtri.
+    Una firma vuota (nessuna entità riconosciuta) non basta a garantire gli stessi filtri: in quel caso
+    si riutilizzano solo domande identiche a meno di maiuscole, punteggiatura e spazi.
+
+    L'indice è per worker, con al massimo `max_entries` domande (le più vecchie vengono sovrascritte);
+    se è configurato `path` viene caricato all'avvio e salvato alla chiusura. Cambiando l'impronta
+    (prompt, modello o catalogo) l'indice viene svuotato.
+    """
+
+    CANDIDATES = 5
+
+    def __init__(self, enabled=False, threshold=0.92, max_entries=5000, path=None, embedder_factory=None, catalog=None):
+        self.enabled = enabled and embedder_factory is not None and catalog is not None
+        self.threshold = threshold
+        self.max_entries = max(1, int(max_entries))
+        self.path = path
+        self.catalog = catalog
+        self._embedder_factory = embedder_factory
+        self._embed = None
+        self._lock = threading.Lock()
+        self._clear(None)
+        if self.enabled and path:
+            self._load()
+
+    @classmethod
+    def from_config(cls, config, embedder_factory=None, catalog=None):
+        semantic_config = config.get("semantic_cache", {})
+        return cls(
+            enabled=semantic_config.get("enabled", False),
+            threshold=semantic_config.get("threshold", 0.92),
+            max_entries=semantic_config.get("max_entries", 5000),
+            path=semantic_config.get("path"),
+            embedder_factory=embedder_factory,
+            catalog=catalog
+        )
+
+    def _clear(self, template):
+        self.template = template
+        self._vectors = None
+        self._entries = [None] * self.max_entries
+        self._size = 0
+        self._next = 0
+        SEMANTIC_ENTRIES.labels().set(0)
+
+    def _embedding(self, text):
+        if self._embed is None:
+            try:
+                self._embed = self._embedder_factory()
+            except Exception:
+                # Senza modello la cache resta spenta invece di riprovare a ogni domanda
+                self.enabled = False
+                raise
+        vector = np.asarray(self._embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def warmup(self):
+        """Carica il modello di embedding prima di servire traffico."""
+        if not self.enabled:
+            return
+        try:
+            self._embedding("warmup")
+        except Exception as e:
+            logger.error("Modello di embedding non disponibile, cache semantica disattivata: %s", e)
+
+    def probe(self, query, template):
+        """Cerca una domanda simile con la stessa firma; None se la cache è disattivata o l'embedding fallisce."""
+        if not self.enabled:
+            return None
+        try:
+            vector = self._embedding(query)
+        except Exception as e:
+            logger.warning("Embedding della domanda non riuscito, cache semantica saltata: %s", e)
+            SEMANTIC_LOOKUPS.inc(result="error")
+            return None
+
+        probe = Probe(vector, signature(query, self.catalog.current()), template)
+        result = "miss"
+        with self._lock:
+            if template != self.template:
+                if self._size:
+                    logger.info("Cache semantica: impronta cambiata, indice svuotato (%d domande)", self._size)
+                self._clear(template)
+            if self._size and self._vectors.shape[1] == vector.shape[0]:
+                scores = self._vectors[:self._size] @ vector
+                best = np.argsort(-scores)[:self.CANDIDATES]
+                SEMANTIC_SIMILARITY.labels().observe(float(scores[best[0]]))
+                for index in best:
+                    if scores[index] < self.threshold:
+                        break
+                    entry = self._entries[index]
+                    if entry["signature"] != probe.signature:
+                        result = "mismatch"
+                        continue
+                    if not probe.signature and normalize_text(entry["query"]) != normalize_text(query):
+                        result = "mismatch"
+                        continue
+                    # Copia: chi riceve i filtri può modificarli
+                    probe.hit = (entry["tool"], json.loads(entry["filters"]))
+                    probe.similar_query = entry["query"]
+                    probe.similarity = float(scores[index])
+                    result = "hit"
+                    break
+        SEMANTIC_LOOKUPS.inc(result=result)
+        return probe
+
+    def probe_many(self, queries, template):
+        return [self.probe(query, template) for query in queries]
+
+    async def aprobe(self, query, template):
+        """Versione asincrona di probe: l'embedding gira in un thread e non blocca l'event loop."""
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.probe, query, template)
+
+    async def aprobe_many(self, queries, template):
+        if not self.enabled:
+            return [None] * len(queries)
+        return await asyncio.to_thread(self.probe_many, queries, template)
+
+    def add(self, probe, query, tool, filters):
+        """Aggiunge all'indice una domanda elaborata dal LLM (solo con un tool e filtri validi)."""
+        if probe is None or probe.hit is not None or not isinstance(filters, dict) or not filters:
+            return
+        if not tool or tool == "none":
+            return
+        with self._lock:
+            if probe.template != self.template:
+                return
+            if self._vectors is None or self._vectors.shape[1] != probe.vector.shape[0]:
+                self._vectors = np.zeros((self.max_entries, probe.vector.shape[0]), dtype=np.float32)
+                self._entries = [None] * self.max_entries
+                self._size = self._next = 0
+            self._vectors[self._next] = probe.vector
+            self._entries[self._next] = {
+                "query": query, "signature": probe.signature, "tool": tool,
+                "filters": json.dumps(filters, ensure_ascii=False)
+            }
+            self._next = (self._next + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+            SEMANTIC_ENTRIES.labels().set(self._size)
+
+    def invalidate(self):
+        """Svuota l'indice (es. dopo una nuova ingestion)."""
+        with self._lock:
+            self._clear(self.template)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                state = json.loads(str(data["state"]))
+                vectors = data["vectors"]
+        except Exception as e:
+            logger.warning("Indice della cache semantica non leggibile (%s): %s", self.path, e)
+            return
+        entries = state["entries"][-self.max_entries:]
+        vectors = vectors[-self.max_entries:]
+        self._clear(state.get("template"))
+        if len(entries):
+            self._vectors = np.zeros((self.max_entries, vectors.shape[1]), dtype=np.float32)
+            self._vectors[:len(entries)] = vectors
+            self._entries[:len(entries)] = entries
+            self._size = len(entries)
+            self._next = self._size % self.max_entries
+        SEMANTIC_ENTRIES.labels().set(self._size)
+        logger.info("Cache semantica caricata: %d domande", self._size)
+
+    def save(self):
+        """Salva l'indice su `path` (scrittura atomica), dalla domanda più vecchia alla più recente."""
+        if not self.enabled or not self.path:
+            return
+        with self._lock:
+            if self._size < self.max_entries:
+                order = list(range(self._size))
+            else:
+                order = list(range(self._next, self.max_entries)) + list(range(self._next))
+            vectors = self._vectors[order] if self._vectors is not None else np.zeros((0, 0), dtype=np.float32)
+            state = {"template": self.template, "entries": [self._entries[index] for index in order]}
+
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, vectors=vectors, state=np.array(json.dumps(state, ensure_ascii=False)))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
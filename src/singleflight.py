@@ -0,0 +1,86 @@
+import asyncio
+import copy
+from src.metrics import REGISTRY
+
+EXECUTIONS = REGISTRY.counter(
+    "vegamind_singleflight_executions_total", "Esecuzioni effettive (una per gruppo di richieste identiche).", ["name"])
+COALESCED = REGISTRY.counter(
+    "vegamind_singleflight_coalesced_total", "Richieste identiche agganciate a un'esecuzione già in corso.", ["name"])
+
+
+def normalize_query(text):
+    """Chiave di coalescenza: stesse parole a meno di maiuscole e spazi."""
+    return " ".join(str(text).lower().split())
+
+
+class _Call:
+    __slots__ = ("task", "waiters", "shared", "snapshot")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.shared = False
+        self.snapshot = None
+
+
+class SingleFlight:
+    """
+    Coalescenza delle chiamate identiche in corso (senza cache persistente).
+
+    La prima chiamata con una certa chiave esegue il lavoro; le chiamate concorrenti con la stessa
+    chiave attendono lo stesso risultato (o la stessa eccezione). Terminata l'esecuzione la chiave
+    viene liberata: le chiamate successive eseguono di nuovo il lavoro.
+    Il lavoro condiviso viene cancellato solo quando tutti i chiamanti hanno rinunciato.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, func, *args):
+        """Esegue `await func(*args)` una sola volta per tutte le chiamate concorrenti con la stessa `key`."""
+        call = self._calls.get(key)
+        # Un'esecuzione già terminata (in attesa di _forget) non ha più una copia per i nuovi chiamanti
+        leader = call is None or call.task.done()
+        if leader:
+            EXECUTIONS.labels(name=self.name).inc()
+            call = _Call()
+            call.task = asyncio.ensure_future(self._run(call, func, args))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            COALESCED.labels(name=self.name).inc()
+            call.shared = True
+
+        call.waiters += 1
+        try:
+            # Shield: la cancellazione di un chiamante (es. client disconnesso) non interrompe gli altri
+            result = await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # Ultimo chiamante: il lavoro non serve più a nessuno
+                call.task.cancel()
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            raise
+        finally:
+            call.waiters -= 1
+
+        # Ogni chiamante agganciato riceve la propria copia della snapshot: nessuno vede le modifiche degli altri
+        return result if leader else copy.deepcopy(call.snapshot)
+
+    @staticmethod
+    async def _run(call, func, args):
+        result = await func(*args)
+        # Snapshot presa prima che il task si risolva: il leader riprende solo dopo e può modificare `result`
+        if call.shared:
+            call.snapshot = copy.deepcopy(result)
+        return result
+
+    def _forget(self, key, task):
+        call = self._calls.get(key)
+        if call is not None and call.task is task:
+            del self._calls[key]
+        # Evita il warning "exception was never retrieved" se tutti i chiamanti sono stati cancellati
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,67 @@
+class ThinkFilter:
+    """
+    Rimuove al volo il ragionamento <think>...</think> da una risposta ricevuta a pezzi.
+
+    I tag possono arrivare spezzati su più chunk: la parte finale del buffer che potrebbe
+    essere l'inizio di un tag viene trattenuta finché il chunk successivo non la chiarisce.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.inside_think = False
+        self.started = False
+
+    @staticmethod
+    def _partial_tag_length(text, tag):
+        """Lunghezza del più lungo suffisso di `text` che è un prefisso di `tag`."""
+        for length in range(min(len(text), len(tag) - 1), 0, -1):
+            if tag.startswith(text[-length:]):
+                return length
+        return 0
+
+    def _emit(self, text):
+        # Come nella versione non in streaming, la risposta visibile non inizia con spazi
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self.started = True
+        return text
+
+    def feed(self, chunk):
+        """Aggiunge un chunk e restituisce il testo visibile pronto per essere inviato."""
+        self.buffer += chunk
+        output = []
+
+        while self.buffer:
+            if self.inside_think:
+                end = self.buffer.find(self.CLOSE_TAG)
+                if end == -1:
+                    # Scarta il ragionamento, trattenendo solo un eventuale tag di chiusura spezzato
+                    keep = self._partial_tag_length(self.buffer, self.CLOSE_TAG)
+                    self.buffer = self.buffer[len(self.buffer) - keep:] if keep else ""
+                    break
+                self.buffer = self.buffer[end + len(self.CLOSE_TAG):]
+                self.inside_think = False
+            else:
+                start = self.buffer.find(self.OPEN_TAG)
+                if start == -1:
+                    keep = self._partial_tag_length(self.buffer, self.OPEN_TAG)
+                    ready = self.buffer[:len(self.buffer) - keep]
+                    self.buffer = self.buffer[len(self.buffer) - keep:] if keep else ""
+                    output.append(self._emit(ready))
+                    break
+                output.append(self._emit(self.buffer[:start]))
+                self.buffer = self.buffer[start + len(self.OPEN_TAG):]
+                self.inside_think = True
+
+        return "".join(output)
+
+    def flush(self):
+        """Restituisce l'eventuale testo trattenuto alla fine dello stream."""
+        text = "" if self.inside_think else self._emit(self.buffer)
+        self.buffer = ""
+        return text
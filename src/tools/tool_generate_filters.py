@@ -1,53 +1,55 @@
-import requests
+import asyncio
 import json
-import pandas as pd
 import os
 import logging
+from src.catalog import CatalogStore
 from src.config_loader import ConfigLoader
+from src import deadline, tracing
+from src.metrics import JSON_PARSE_FALLBACKS, timed
+from src.llm_gateway import Answer, LLMGateway, extract_json
+from src.prompts import ENTITY_LABELS, entity_lines, measure
+from src.response_cache import ResponseCache, fingerprint
+from src.singleflight import SingleFlight, normalize_query
 
 class ToolGenerateFilters:
-    def __init__(self, config_path="config/config.yaml"):
-        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    def __init__(self, config_path="config/config.yaml", config=None, llm=None, catalog=None, cache=None):
         self.logger = logging.getLogger(__name__)
 
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-        self.config_loader = ConfigLoader(config_path)
-        self.config = self.config_loader.get_config()
-        print("Configurazione caricata correttamente.")
+        if config is None:
+            config = ConfigLoader(config_path).get_config()
+            self.logger.info("Configurazione caricata da %s", config_path)
+        self.config = config
 
-        # Recupera le variabili dalla configurazione
-        api_key = self.config["google"]["api_key"]
-        base_url = self.config["google"]["model"]
+        # Gateway LLM: connessioni keep-alive verso Gemini e rate limiter condivisi con l'agent
+        self._owns_llm = llm is None
+        self.llm = llm or LLMGateway(self.config)
+        self.inflight = SingleFlight("generate_filters")
 
-        # Costruisci l'URL
-        self.url = f"{base_url}{api_key}"
+        # Entità (ristoranti, pianeti, ingredienti, ...) dal catalogo mappato in memoria
+        # (condiviso con l'agent quando costruito dall'AppContext)
+        if catalog is None:
+            catalog = CatalogStore.from_config(self.config)
+            catalog.ensure(self.config)
+        self.catalog = catalog
+
+        # Cache dei filtri già generati (condivisa con l'agent quando costruita dall'AppContext)
+        self.cache = cache or ResponseCache.from_config(self.config)
+
+        # Entità candidate incluse nel prompt per ciascun tipo
+        self.max_candidates = self.config.get("prompts", {}).get("max_candidates", 15)
+
+    def build_instructions(self, user_queries=()):
+        """
+        Istruzioni per la generazione dei filtri, condivise dal prompt singolo e da quello a più domande.
+        Il prompt elenca solo le entità del catalogo candidate per le richieste, non gli elenchi completi.
+        """
+        candidates = self.catalog.current().candidates(list(user_queries), self.max_candidates)
+        known_entities = entity_lines(
+            candidates, ENTITY_LABELS, "- None recognised: copy names exactly as written in the request."
+        )
 
-        self.distances_df = pd.read_csv(self.config["paths"]["distances"])
-        print("[OK] Distanze planetarie caricate!\n")
-    
-    def get_restaurant_names(self, menus_dir):
-        """Recupera i nomi dei ristoranti dai file PDF nella cartella dei menu."""
-        try:
-            restaurant_names = [
-                os.path.splitext(f)[0]  # Rimuove l'estensione .pdf
-                for f in os.listdir(menus_dir) 
-                if f.endswith(".pdf")  # Considera solo i file PDF
-            ]
-            return restaurant_names
-        except Exception as e:
-            print(f"[ERRORE] Impossibile recuperare i nomi dei ristoranti: {e}")
-            return []
-
-    def generate_filters(self, user_query):
-        """Genera filtri dinamici basati sulla richiesta dell'utente."""
-        print("\n[STEP] Generazione dei filtri dinamici...\n")
-        
-        restaurant_names = self.get_restaurant_names(self.config["paths"]["menus_dir"])
-        
-        # Ottieni i pianeti disponibili dalla matrice delle distanze
-        available_planets = list(self.distances_df.columns)[1:]
-        
         prompt = f"""
         ### CRITICAL INSTRUCTIONS
         - Extract **ONLY** ingredients, techniques, and other elements **EXPLICITLY** mentioned in the request.
@@ -55,8 +57,10 @@ class ToolGenerateFilters:
         - **COMPLETELY OMIT** empty sections (do not include empty arrays or objects).
         - If a main section (AND/OR) has no elements, omit it entirely.
         - If a subcategory (e.g., ingredients, techniques) has no elements, omit it entirely.
-        - The following are the available restaurant names: {restaurant_names}
-        - The following are the available planets in the system: {available_planets}
+
+        ### KNOWN ENTITIES
+        Catalog names that may match the request. When the request mentions one of them, use this exact spelling.
+        {known_entities}
 
         ### FILTER GENERATION RULES
         1. **AND Conditions**:
@@ -76,11 +80,9 @@ class ToolGenerateFilters:
 
         3. **Restaurant Name**:
         - Include **ONLY** if the name is explicitly mentioned in the request.
-        - Verify against the list: {restaurant_names}.
 
         4. **Planets**:
         - Include **ONLY** if the planet is explicitly mentioned in the request.
-        - Verify against the list: {available_planets}.
 
         ### CHEF LICENSES
         For chef licenses, specify:
@@ -133,6 +135,14 @@ class ToolGenerateFilters:
         "min_should_count": 2  // Numero minimo di condizioni OR che devono essere soddisfatte
         }}
         ```
+        """
+
+        return prompt
+
+    def build_prompt(self, user_query):
+        """Costruisce il prompt per la generazione dei filtri."""
+        return f"""
+        {self.build_instructions([user_query])}
 
         --- USER REQUEST ---
         {user_query}
@@ -140,31 +150,160 @@ class ToolGenerateFilters:
         --- RESPONSE (JSON only) ---
         """
 
-        payload = {
-            "contents": [
-                {
-                    "parts": [{"text": prompt}]
-                }
-            ]
+    def build_batch_prompt(self, user_queries):
+        """Costruisce un unico prompt che genera i filtri di più richieste numerate."""
+        numbered_queries = "\n".join(f"{index}. {query}" for index, query in enumerate(user_queries, start=1))
+
+        return f"""
+        {self.build_instructions(user_queries)}
+
+        ### BATCH MODE
+        - You will receive several numbered requests. Generate the filters of each request **independently**.
+        - Return **ONE** JSON object whose keys are the request numbers and whose values are the filter objects described above.
+        - Use an empty object {{}} for a request without filters.
+        - Example for 2 requests:
+        ```json
+        {{
+        "1": {{"AND": {{"ingredients": ["ingrediente1"]}}}},
+        "2": {{"OR": {{"techniques": ["tecnica1", "tecnica2"]}}, "min_should_count": 1}}
+        }}
+        ```
+
+        --- USER REQUESTS ---
+        {numbered_queries}
+
+        --- RESPONSE (JSON only) ---
+        """
+
+    def cache_template(self):
+        """
+        Impronta dei prompt (singolo e a più richieste). Le entità incluse dipendono dalla richiesta
+        e dal catalogo, quindi la versione del catalogo fa parte dell'impronta.
+        """
+        return fingerprint(
+            self.build_prompt("{query}"), self.build_batch_prompt(["{query}"]), self.catalog.current().version
+        )
+
+    def cache_key(self, user_query, template=None, model=None):
+        """Chiave di cache dei filtri; `model` è il modello che ha risposto (predefinito: quello di Gemini)."""
+        return self.cache.key(
+            "generate_filters", template or self.cache_template(), model or self.llm.model_name("gemini"),
+            normalize_query(user_query)
+        )
+
+    def parse_response(self, content):
+        """Estrae i filtri JSON dalla risposta di Gemini."""
+        try:
+            return extract_json(content)
+        except json.JSONDecodeError as e:
+            self.logger.warning("Errore nel parsing dei filtri JSON: %s", e)
+            JSON_PARSE_FALLBACKS.inc(stage="generate_filters")
+            return {}
+
+    def parse_batch_response(self, content, count):
+        """
+        Estrae i filtri di più richieste da una sola risposta.
+        Restituisce un dizionario {indice: filtri} con i soli elementi validi (indici a partire da 0).
+        """
+        try:
+            parsed = extract_json(content)
+        except json.JSONDecodeError as e:
+            self.logger.warning("Risposta a più richieste non valida: %s", e)
+            return {}
+
+        if not isinstance(parsed, dict):
+            return {}
+
+        return {
+            index: parsed[str(index + 1)]
+            for index in range(count)
+            if isinstance(parsed.get(str(index + 1)), dict)
         }
 
-        headers = {"Content-Type": "application/json"}
+    async def arequest(self, prompt, stage="generate_filters", answer=None):
+        """Invia un prompt a Gemini rispettando il rate limit condiviso e restituisce il testo della risposta."""
+        return await self.llm.achat(
+            "gemini", measure(stage, [{"role": "user", "content": prompt}]), stage="generate_filters", answer=answer
+        )
+
+    async def agenerate_filters(self, user_query):
+        """
+        Genera filtri dinamici basati sulla richiesta dell'utente, senza bloccare l'event loop durante la chiamata a Gemini.
+        Le chiamate concorrenti per la stessa richiesta condividono la stessa chiamata.
+        """
+        cached = await self.cache.aget(self.cache_key(user_query))
+        if cached is not None:
+            return cached
+        return await self.inflight.do(normalize_query(user_query), self._agenerate_filters, user_query)
+
+    async def _agenerate_filters(self, user_query):
+        answer = Answer()
+        content = await self.arequest(self.build_prompt(user_query), answer=answer)
+        filters = self.parse_response(content)
+        await self.cache.aset(self.cache_key(user_query, model=answer.model), filters or None)
+        return filters
+
+    async def agenerate_filters_batch(self, user_queries):
+        """
+        Genera i filtri di più richieste con una sola chiamata a Gemini.
+        Le richieste già in cache non entrano nel prompt; quelle con filtri mancanti o non validi
+        vengono rigenerate singolarmente.
+        """
+
+        if len(user_queries) == 1:
+            return [await self.agenerate_filters(user_queries[0])]
 
-        response = requests.post(self.url, headers=headers, data=json.dumps(payload))
+        template = self.cache_template()
+        keys = [self.cache_key(query, template) for query in user_queries]
+        filters = {}
+        for index, key in enumerate(keys):
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                filters[index] = cached
 
-        if response.status_code == 200:
-            response_json = response.json()
-            generated_text = response_json['candidates'][0]['content']['parts'][0]['text']
-            generated_text = generated_text.replace("```json", "").replace("```", "").strip()
+        pending = [index for index in range(len(user_queries)) if index not in filters]
+        if len(pending) > 1:
+            answer = Answer()
             try:
-                return json.loads(generated_text)
-            except json.JSONDecodeError as e:
-                print(f"[ERRORE] Errore nel parsing dei filtri JSON: {e}")
-                return {}
-        else:
-            raise Exception(f"Errore nella richiesta API: {response.status_code}, {response.text}")
-
-    def execute(self, user_query):
+                content = await self.arequest(
+                    self.build_batch_prompt([user_queries[index] for index in pending]), stage="generate_filters_batch",
+                    answer=answer
+                )
+                for position, value in self.parse_batch_response(content, len(pending)).items():
+                    filters[pending[position]] = value
+                    await self.cache.aset(self.cache_key(user_queries[pending[position]], template, answer.model), value or None)
+            except Exception as e:
+                self.logger.warning("Generazione dei filtri a più richieste fallita: %s", e)
+        elif pending:
+            index = pending[0]
+            filters[index] = await self.inflight.do(
+                normalize_query(user_queries[index]), self._agenerate_filters, user_queries[index]
+            )
+
+        missing = [index for index in range(len(user_queries)) if index not in filters]
+        if missing:
+            tracing.info("Filtri a più richieste incompleti, fallback singolo per %d richieste", len(missing))
+            JSON_PARSE_FALLBACKS.inc(len(missing), stage="generate_filters_batch")
+            fallback = await asyncio.gather(*(self.agenerate_filters(user_queries[index]) for index in missing))
+            filters.update(zip(missing, fallback))
+
+        return [filters[index] for index in range(len(user_queries))]
+
+    @timed("execute")
+    @deadline.with_deadline("execute")
+    async def aexecute(self, user_query):
         """Genera i filtri per la query."""
-        print("[ToolGenerateFilters] → Generazione filtri per la query standard.")
-        return self.generate_filters(user_query)
+        tracing.debug("ToolGenerateFilters: generazione filtri per la query standard")
+        return await self.agenerate_filters(user_query)
+
+    @timed("execute_batch")
+    @deadline.with_deadline("execute")
+    async def aexecute_batch(self, user_queries):
+        """Genera i filtri di più query con un solo prompt."""
+        tracing.debug("ToolGenerateFilters: generazione filtri per %d query standard", len(user_queries))
+        return await self.agenerate_filters_batch(user_queries)
+
+    async def aclose(self):
+        """Chiude il gateway LLM se è stato creato dal tool."""
+        if self._owns_llm:
+            await self.llm.aclose()
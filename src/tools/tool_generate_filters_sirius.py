@@ -1,38 +1,50 @@
-import groq
-import pandas as pd
 import json
 import os
 import logging
+from src.catalog import CatalogStore
 from src.config_loader import ConfigLoader
+from src import deadline, tracing
+from src.metrics import JSON_PARSE_FALLBACKS, timed
+from src.llm_gateway import Answer, LLMGateway, extract_json
+from src.prompts import ENTITY_LABELS_IT, entity_lines, measure
+from src.response_cache import ResponseCache, fingerprint
+from src.singleflight import SingleFlight, normalize_query
 
 class ToolGenerateFiltersSirius:
-    def __init__(self, config_path="config/config.yaml"):
-        # Configura il logging
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    def __init__(self, config_path="config/config.yaml", config=None, llm=None, catalog=None, cache=None):
+        # Logger del modulo (il logging viene configurato una sola volta da main.py)
         self.logger = logging.getLogger(__name__)
         
         # Evita problemi con i tokenizer di Hugging Face
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
         
-        # Carica la configurazione utilizzando la classe ConfigLoader
-        self.config_loader = ConfigLoader(config_path)
-        self.config = self.config_loader.get_config()
-        print("Configurazione caricata correttamente.")
+        # Carica la configurazione utilizzando la classe ConfigLoader (se non già fornita)
+        if config is None:
+            config = ConfigLoader(config_path).get_config()
+            self.logger.info("Configurazione caricata da %s", config_path)
+        self.config = config
         
-        self.cooking_techniques = self.load_cooking_techniques()
-        
-        print("[INIT] Inizializzazione del client Groq...\n")
-        self.client = groq.Client(api_key=self.config["groq"]["api_key"])
-        self.model = self.config["groq"]["model"]
-        print("[OK] Client Groq inizializzato con il modello:", self.model, "\n")
-
-    def load_cooking_techniques(self):
-        """Carica le tecniche di cottura dal file CSV in un dizionario strutturato."""
-        df = pd.read_csv(self.config["paths"]["tecniche_di_cottura"])
-
-        # Creiamo un dizionario {Categoria: [Lista di Tecniche]}
-        techniques_dict = df.groupby("Categoria")["Tecnica"].apply(list).to_dict()
-        return techniques_dict
+        # Tecniche di cottura ed entità dal catalogo mappato in memoria (condiviso con l'agent quando costruito dall'AppContext)
+        if catalog is None:
+            catalog = CatalogStore.from_config(self.config)
+            catalog.ensure(self.config)
+        self.catalog = catalog
+
+        # Gateway LLM: connessioni keep-alive verso Groq e rate limiter condivisi con l'agent
+        self._owns_llm = llm is None
+        self.llm = llm or LLMGateway(self.config)
+        self.inflight = SingleFlight("generate_filters_sirius")
+
+        # Cache dei filtri già generati (condivisa con l'agent quando costruita dall'AppContext)
+        self.cache = cache or ResponseCache.from_config(self.config)
+
+        # Entità candidate incluse nel prompt per ciascun tipo
+        self.max_candidates = self.config.get("prompts", {}).get("max_candidates", 15)
+
+    @property
+    def cooking_techniques(self):
+        """Tecniche di cottura della versione attiva del catalogo, nella forma {Categoria: [Lista di Tecniche]}."""
+        return self.catalog.current().techniques_by_category()
         
     def extract_techniques(self, user_query):
         """Recupera le tecniche di cottura dal Manuale di Sirius Cosmo."""
@@ -46,25 +58,13 @@ class ToolGenerateFiltersSirius:
         return techniques_by_category
 
 
-    def get_restaurant_names(self, menus_dir):
-        """Recupera i nomi dei ristoranti dai file PDF nella cartella dei menu."""
-        try:
-            restaurant_names = [
-                os.path.splitext(f)[0]  # Rimuove l'estensione .pdf
-                for f in os.listdir(menus_dir) 
-                if f.endswith(".pdf")  # Considera solo i file PDF
-            ]
-            return restaurant_names
-        except Exception as e:
-            print(f"[ERRORE] Impossibile recuperare i nomi dei ristoranti: {e}")
-            return []
-        
-
-    def generate_filters(self, user_query, techniques_by_category):
-        """Genera filtri dinamici basati sulla richiesta dell'utente con distinzione tra AND e OR."""
-        print("\n[STEP] Generazione dei filtri dinamici...\n")
-
-        restaurant_names = self.get_restaurant_names(self.config["paths"]["menus_dir"])
+    def build_messages(self, user_query, techniques_by_category):
+        """Costruisce i messaggi (system + user) per la generazione dei filtri."""
+        # Solo le entità del catalogo candidate per la richiesta, non gli elenchi completi
+        candidates = self.catalog.current().candidates([user_query], self.max_candidates)
+        known_entities = entity_lines(
+            candidates, ENTITY_LABELS_IT, "- Nessuna entità riconosciuta: riporta i nomi esattamente come scritti nella richiesta."
+        )
 
         # Verifica che techniques_by_category sia un dizionario
         if not isinstance(techniques_by_category, dict):
@@ -105,8 +105,11 @@ class ToolGenerateFiltersSirius:
         - OMETTI COMPLETAMENTE le sezioni vuote.
         - Se una sezione principale (AND o OR) non ha nessun elemento, omettila completamente.
         - Se una sottocategoria (ingredients, techniques, ecc.) non ha elementi, omettila completamente.
-        - I seguenti sono i nomi dei ristoranti disponibili: {restaurant_names}.
-        
+
+        ### ENTITÀ NOTE
+        Nomi del catalogo che possono corrispondere alla richiesta. Se la richiesta ne cita uno, usa esattamente questa grafia.
+        {known_entities}
+
         ### TECNICHE DI COTTURA DISPONIBILI DAL MANUALE DI SIRIUS COSMO
         {techniques_str}
 
@@ -145,56 +148,100 @@ class ToolGenerateFiltersSirius:
         --- RISPOSTA (solo JSON) ---
         """
 
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "Sei un assistente specializzato in cucina galattica. Il tuo compito è analizzare la richiesta dell'utente e generare una lista di filtri per cercare i piatti più rilevanti SOLO dalle informazioni esplicitamente menzionate nella richiesta dell'utente. Non inventare o inferire informazioni non presenti nel testo originale. Se un'informazione non è chiaramente specificata, omettila completamente dall'output JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0
+        return [
+            {"role": "system", "content": "Sei un assistente specializzato in cucina galattica. Il tuo compito è analizzare la richiesta dell'utente e generare una lista di filtri per cercare i piatti più rilevanti SOLO dalle informazioni esplicitamente menzionate nella richiesta dell'utente. Non inventare o inferire informazioni non presenti nel testo originale. Se un'informazione non è chiaramente specificata, omettila completamente dall'output JSON."},
+            {"role": "user", "content": prompt}
+        ]
+
+    def cache_template(self):
+        """
+        Impronta del prompt. Le tecniche incluse nel prompt dipendono dalla domanda e dal catalogo,
+        quindi la versione del catalogo fa parte dell'impronta.
+        """
+        return fingerprint(self.build_messages("{query}", {}), self.catalog.current().version)
+
+    def cache_key(self, user_query, model=None):
+        """Chiave di cache dei filtri; `model` è il modello che ha risposto (predefinito: quello di Groq)."""
+        return self.cache.key(
+            "generate_filters_sirius", self.cache_template(), model or self.llm.model_name("groq"), normalize_query(user_query)
         )
 
-        filters_json = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
+    def add_techniques(self, filters, user_query, techniques_by_category):
+        """Aggiunge ai filtri le tecniche delle categorie del Manuale di Sirius Cosmo citate nella richiesta."""
+        # Se il campo techniques non esiste, lo inizializziamo
+        if "AND" not in filters:
+            filters["AND"] = {}
+        if "OR" not in filters:
+            filters["OR"] = {}
+
+        # Analizziamo quali tecniche sono richieste e come inserirle nei filtri
+        for category, techniques in techniques_by_category.items():
+            if any(term in user_query.lower() for term in ["almeno una", "una delle"]):
+                filters["OR"].setdefault("techniques", []).extend(techniques)
+                filters["min_should_count"] = max(len(techniques_by_category), 1)  # Minimo 1 tecnica
+            else:
+                filters["AND"].setdefault("techniques", []).extend(techniques)
 
-        # Remove <think>...</think>
-        if "<think>" in filters_json and "</think>" in filters_json:
-            filters_json = filters_json.split("</think>")[-1].strip()
-            
+        return filters
+
+    def parse_filters(self, content, user_query, techniques_by_category):
+        """Estrae i filtri JSON dalla risposta del modello e aggiunge le tecniche del Manuale di Sirius Cosmo."""
         try:
-            filters = json.loads(filters_json)
-
-            # Se il campo techniques non esiste, lo inizializziamo
-            if "AND" not in filters:
-                filters["AND"] = {}
-            if "OR" not in filters:
-                filters["OR"] = {}
-
-            # Analizziamo quali tecniche sono richieste e come inserirle nei filtri
-            for category, techniques in techniques_by_category.items():
-                if any(term in user_query.lower() for term in ["almeno una", "una delle"]):
-                    filters["OR"].setdefault("techniques", []).extend(techniques)
-                    filters["min_should_count"] = max(len(techniques_by_category), 1)  # Minimo 1 tecnica
-                else:
-                    filters["AND"].setdefault("techniques", []).extend(techniques)
-                    
-            print(f"[DEBUG] Filtri generati:\n{json.dumps(filters, indent=4, ensure_ascii=False)}")
+            filters = extract_json(content)
+            if not isinstance(filters, dict):
+                raise json.JSONDecodeError("La risposta non è un oggetto JSON", str(filters), 0)
+
+            filters = self.add_techniques(filters, user_query, techniques_by_category)
+            tracing.debug("Filtri generati", filters=filters)
             
             return filters
 
         except json.JSONDecodeError as e:
-            print(f"[ERRORE] Errore nel parsing dei filtri JSON: {e}")
+            self.logger.warning("Errore nel parsing dei filtri JSON: %s", e)
+            JSON_PARSE_FALLBACKS.inc(stage="generate_filters_sirius")
             return {}
 
 
-    def execute(self, user_query):
+    async def agenerate_filters(self, user_query, techniques_by_category):
+        """
+        Genera filtri dinamici basati sulla richiesta dell'utente con distinzione tra AND e OR,
+        senza bloccare l'event loop durante la chiamata a Groq.
+        Le chiamate concorrenti per la stessa richiesta (e quindi le stesse tecniche) condividono la stessa chiamata.
+        """
+        cached = await self.cache.aget(self.cache_key(user_query))
+        if cached is not None:
+            return cached
+        return await self.inflight.do(
+            normalize_query(user_query), self._agenerate_filters, user_query, techniques_by_category
+        )
+
+    async def _agenerate_filters(self, user_query, techniques_by_category):
+        if not isinstance(techniques_by_category, dict):
+            techniques_by_category = {"Generico": techniques_by_category}
+
+        messages = measure("generate_filters_sirius", self.build_messages(user_query, techniques_by_category))
+        answer = Answer()
+        content = await self.llm.achat("groq", messages, temperature=0.0, stage="generate_filters_sirius", answer=answer)
+
+        filters = self.parse_filters(content, user_query, techniques_by_category)
+        await self.cache.aset(self.cache_key(user_query, answer.model), filters or None)
+        return filters
+
+
+    @timed("execute")
+    @deadline.with_deadline("execute")
+    async def aexecute(self, user_query):
         """Recupera tecniche di Sirius Cosmo e genera i filtri di ricerca."""
-        print("[ToolGenerateFiltersSirius] → Recupero tecniche dal Manuale di Sirius Cosmo.")
+        tracing.debug("ToolGenerateFiltersSirius: recupero tecniche dal Manuale di Sirius Cosmo")
 
         techniques = self.extract_techniques(user_query)
 
         if not techniques:
             return "Errore: Nessuna tecnica trovata."
 
-        # Generiamo i filtri, includendo le tecniche trovate
-        filters = self.generate_filters(user_query, techniques)
-        return filters
+        return await self.agenerate_filters(user_query, techniques)
+
+    async def aclose(self):
+        """Chiude il gateway LLM se è stato creato dal tool."""
+        if self._owns_llm:
+            await self.llm.aclose()
@@ -0,0 +1,259 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+LEVELS = {"off": 100, "info": logging.INFO, "debug": logging.DEBUG}
+
+_current_trace = contextvars.ContextVar("vegamind_trace", default=None)
+_current_span = contextvars.ContextVar("vegamind_span", default=None)
+
+# Fuori da una traccia (script, avvio) gli eventi finiscono nel logging standard
+_logger = logging.getLogger("vegamind")
+
+
+class JsonLinesExporter:
+    """Scrive span ed eventi come una riga JSON ciascuno, su file o su stdout."""
+
+    def __init__(self, target="stdout"):
+        self._lock = threading.Lock()
+        if target == "stdout":
+            self.stream = sys.stdout
+        else:
+            if os.path.dirname(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            self.stream = open(target, "a", buffering=1, encoding="utf-8")
+
+    def export(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self.stream.write(line + "\n")
+
+    def close(self):
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+
+class Trace:
+    """Una richiesta tracciata: id, decisione di campionamento e livello di dettaglio degli eventi."""
+
+    __slots__ = ("trace_id", "name", "sampled", "level")
+
+    def __init__(self, trace_id, name, sampled, level):
+        self.trace_id = trace_id
+        self.name = name
+        self.sampled = sampled
+        self.level = level
+
+
+class Span:
+    """Fase di una traccia: alla chiusura viene esportata con durata, attributi ed eventuale errore."""
+
+    __slots__ = ("tracer", "trace", "name", "span_id", "parent_id", "attributes", "start", "_token")
+
+    def __init__(self, tracer, trace, name, attributes):
+        self.tracer = tracer
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration_ms = (time.time() - self.start) * 1000
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Generatori async ripresi in un altro contesto: lo span corrente non va ripristinato
+            pass
+        record = {
+            "type": "span",
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(duration_ms, 3),
+        }
+        if self.attributes:
+            record["attributes"] = self.attributes
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer.export(record)
+        return False
+
+
+class _NoopSpan:
+    """Span restituito quando la richiesta non è campionata: nessuna allocazione né I/O."""
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _TraceScope:
+    __slots__ = ("trace", "_token")
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self._token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            _current_trace.reset(self._token)
+        except ValueError:
+            pass
+        return False
+
+
+class Tracer:
+    """
+    Tracing strutturato e campionato del percorso di query.
+
+    Ogni richiesta apre una traccia con un trace id; le fasi sono span annidati.
+    Solo le tracce campionate producono output: per le altre span ed eventi sono no-op
+    e i messaggi non vengono mai formattati.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.level = LEVELS["info"]
+        self.level_header = False
+        self.exporter = None
+
+    def configure(self, config):
+        """Legge la sezione `tracing` della configurazione."""
+        tracing_config = config.get("tracing", {})
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+
+        self.enabled = tracing_config.get("enabled", False)
+        self.sample_rate = float(tracing_config.get("sample_rate", 0.0))
+        self.level = LEVELS.get(str(tracing_config.get("level", "info")).lower(), LEVELS["info"])
+        self.level_header = bool(tracing_config.get("level_header", False))
+        if self.enabled:
+            exporter = tracing_config.get("exporter", "stdout")
+            self.exporter = JsonLinesExporter("stdout" if exporter == "stdout" else tracing_config.get("path", "logs/traces.jsonl"))
+
+    def start_trace(self, name, trace_id=None, level=None, trusted=True):
+        """
+        Apre una traccia per la richiesta corrente (`with tracer.start_trace("process_query"): ...`).
+
+        :param trace_id: Id ricevuto dal chiamante (es. header X-Trace-Id); altrimenti ne viene generato uno.
+        :param level: "debug", "info" o "off" per la singola richiesta; forza (o esclude) il campionamento.
+        :param trusted: False se `level` arriva da un client non autenticato (header X-Trace-Level): in quel caso
+            viene usato solo con `tracing.level_header` attivo, altrimenti valgono campionamento e livello configurati.
+        """
+        if level is not None and not (trusted or self.level_header):
+            level = None
+        if level is not None and str(level).lower() in LEVELS:
+            level = LEVELS[str(level).lower()]
+            sampled = self.enabled and level < LEVELS["off"]
+        else:
+            level = self.level
+            sampled = self.enabled and random.random() < self.sample_rate
+        return _TraceScope(Trace(trace_id or uuid.uuid4().hex, name, sampled, level))
+
+    def span(self, name, **attributes):
+        """Apre uno span nella traccia corrente; no-op se la traccia non è campionata."""
+        trace = _current_trace.get()
+        if trace is None or not trace.sampled:
+            return NOOP_SPAN
+        return Span(self, trace, name, attributes)
+
+    def is_enabled_for(self, level):
+        trace = _current_trace.get()
+        if trace is None:
+            return _logger.isEnabledFor(level)
+        return trace.sampled and level >= trace.level
+
+    def log(self, level, message, *args, **fields):
+        """
+        Registra un evento. Il messaggio viene formattato (`message % args`) solo se l'evento
+        viene effettivamente emesso; i campi passati come callable vengono valutati solo in quel caso.
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            if _logger.isEnabledFor(level):
+                _logger.log(level, message, *args)
+            return
+        if not trace.sampled or level < trace.level:
+            return
+
+        span = _current_span.get()
+        record = {
+            "type": "event",
+            "trace_id": trace.trace_id,
+            "span_id": span.span_id if span is not None else None,
+            "time": time.time(),
+            "level": logging.getLevelName(level).lower(),
+            "message": message % args if args else message,
+        }
+        for key, value in fields.items():
+            record[key] = value() if callable(value) else value
+        self.export(record)
+
+    def export(self, record):
+        if self.exporter is not None:
+            self.exporter.export(record)
+
+
+TRACER = Tracer()
+
+
+def configure(config):
+    TRACER.configure(config)
+
+
+def start_trace(name, trace_id=None, level=None, trusted=True):
+    return TRACER.start_trace(name, trace_id=trace_id, level=level, trusted=trusted)
+
+
+def span(name, **attributes):
+    return TRACER.span(name, **attributes)
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+def debug(message, *args, **fields):
+    TRACER.log(logging.DEBUG, message, *args, **fields)
+
+
+def info(message, *args, **fields):
+    TRACER.log(logging.INFO, message, *args, **fields)
+
+
+def is_debug_enabled():
+    return TRACER.is_enabled_for(logging.DEBUG)
@@ -0,0 +1,60 @@
+import os
+import sys
+
+# I test importano i moduli come `src.<modulo>`, come main.py, dalla radice del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from src.llm_stub import StubBehavior, StubLLMServer
+
+
+class ScriptedBehavior(StubBehavior):
+    """Comportamento dello stub con latenze in sequenza (una per richiesta) e registro delle richieste ricevute."""
+
+    def __init__(self, delays=(), **kwargs):
+        super().__init__(**kwargs)
+        self.delays = list(delays)
+        self.requests = 0
+
+    def admit(self):
+        with self._lock:
+            self.requests += 1
+        return super().admit()
+
+    def delay(self):
+        with self._lock:
+            if self.delays:
+                return self.delays.pop(0)
+        return super().delay()
+
+
+@pytest.fixture
+def stub_server():
+    """Avvia server stub con ScriptedBehavior (`server.behavior`), fermati a fine test."""
+    servers = []
+
+    def start(**behavior):
+        server = StubLLMServer(behavior=ScriptedBehavior(**behavior)).start()
+        server.behavior = server.server.RequestHandlerClass.behavior
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def gateway_config():
+    """Configurazione del gateway verso server stub (Groq e Gemini anche su server diversi), senza rate limit."""
+    def build(groq_server, gemini_server=None, policy=None, cassettes=None):
+        gemini_server = gemini_server or groq_server
+        return {
+            "groq": {"model": "llama-test", "api_key": "test", "base_url": groq_server.url},
+            "google": {"model": gemini_server.gemini_model_url("gemini-test"), "api_key": "test"},
+            "llm": {"max_retries": 0, "policy": policy or {}},
+            "rate_limits": {},
+            "cassettes": cassettes or {"mode": "off"},
+        }
+    return build
@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src.agent import VegaMindAgent
+from src.response_cache import ResponseCache
+
+
+class FailingLLM:
+    """Gateway finto: ogni chiamata al LLM fallisce."""
+
+    def model_name(self, provider):
+        return provider
+
+    async def achat(self, *args, **kwargs):
+        raise RuntimeError("LLM non raggiungibile")
+
+
+class FiltersTool:
+    """Tool finto: la chiamata a più domande fallisce, quelle singole solo per le domande in `failing`."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    async def aexecute_batch(self, queries):
+        raise RuntimeError("prompt a più domande fallito")
+
+    async def aexecute(self, query):
+        if query in self.failing:
+            raise RuntimeError(f"filtri falliti per {query}")
+        return {"AND": {"ingredients": [query]}}
+
+
+@pytest.fixture
+def agent():
+    catalog = SimpleNamespace(current=lambda: SimpleNamespace(version="test"))
+    agent = VegaMindAgent(
+        {"generate_filters": FiltersTool(failing={"seconda"})}, None, config={}, llm=FailingLLM(),
+        catalog=catalog, cache=ResponseCache(enabled=False)
+    )
+
+    async def adecide_tool(query):
+        if query == "terza":
+            raise RuntimeError("routing fallito")
+        return "generate_filters"
+
+    async def afinalize_query(row_id, query, tool_name, filters, chat=False):
+        return {"success": True, "result": row_id, "filters": filters}
+
+    agent.adecide_tool = adecide_tool
+    agent.afinalize_query = afinalize_query
+    return agent
+
+
+def test_batch_failures_only_affect_their_items(agent):
+    results = asyncio.run(agent.aprocess_queries([(1, "prima"), (2, "seconda"), (3, "terza")]))
+
+    assert results[0] == {"success": True, "result": 1, "filters": {"AND": {"ingredients": ["prima"]}}}
+    assert results[1]["success"] is False
+    assert results[1]["error"] == "filtri falliti per seconda"
+    assert results[2]["success"] is False
+    assert results[2]["error"] == "routing fallito"
+
+
+def test_single_query_routing_failure_is_returned(agent):
+    routed = asyncio.run(agent.adecide_tools_batch(["terza"]))
+    assert len(routed) == 1
+    assert isinstance(routed[0], RuntimeError)
+
+
+def test_process_query_runs_the_async_pipeline(agent):
+    async def aresolve_filters(query):
+        return "generate_filters", {"AND": {"ingredients": [query]}}
+
+    agent.aresolve_filters = aresolve_filters
+    # Due chiamate sincrone riusano lo stesso event loop dedicato
+    first = agent.process_query(1, "funghi")
+    second = agent.process_query(2, "latte")
+    assert first == {"success": True, "result": 1, "filters": {"AND": {"ingredients": ["funghi"]}}}
+    assert second["filters"] == {"AND": {"ingredients": ["latte"]}}
+
+
+def test_build_qdrant_filter_does_not_mutate_filters(agent):
+    filters = {"OR": {"techniques": ["Marinatura", "Affumicatura"]}, "min_should_count": 2}
+    qdrant_filter = agent.build_qdrant_filter(filters)
+
+    assert filters == {"OR": {"techniques": ["Marinatura", "Affumicatura"]}, "min_should_count": 2}
+    assert qdrant_filter.min_should.min_count == 2
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from src.cassette import Cassette, CassetteMiss
+from src.llm_gateway import Answer, LLMGateway
+
+MESSAGES = [{"role": "system", "content": "Rispondi in breve."},
+            {"role": "user", "content": "Quali piatti contengono funghi?"}]
+
+
+def cassettes(tmp_path, mode, on_miss="error"):
+    return {"mode": mode, "path": str(tmp_path / "llm.jsonl"), "on_miss": on_miss}
+
+
+def test_replay_serves_recorded_calls_without_provider(stub_server, gateway_config, tmp_path):
+    server = stub_server(default_response="Piatto ai funghi")
+    recorder = LLMGateway(gateway_config(server, cassettes=cassettes(tmp_path, "record")))
+
+    async def record():
+        text = await recorder.achat("groq", MESSAGES, temperature=0.2)
+        await recorder.aclose()
+        return text
+
+    assert asyncio.run(record()) == "Piatto ai funghi"
+    assert recorder.chat("gemini", MESSAGES) == "Piatto ai funghi"
+    assert server.behavior.requests == 2
+    assert len(Cassette("replay", str(tmp_path / "llm.jsonl"))) == 2
+
+    # In replay il provider non viene contattato: anche con ogni richiesta in errore le risposte arrivano dalla cassetta
+    server.behavior.error_rate, server.behavior.error_status = 1.0, 500
+    player = LLMGateway(gateway_config(server, cassettes=cassettes(tmp_path, "replay")))
+
+    async def replay():
+        answer = Answer()
+        text = await player.achat("groq", MESSAGES, temperature=0.2, answer=answer)
+        chunks = [chunk async for chunk in player.astream("groq", MESSAGES, temperature=0.2)]
+        await player.aclose()
+        return text, (answer.provider, answer.model), chunks
+
+    text, answered, chunks = asyncio.run(replay())
+    assert text == "Piatto ai funghi"
+    assert answered == ("groq", "llama-test")
+    assert chunks == ["Piatto ai funghi"]
+    # Spaziatura diversa nel prompt, stessa chiave
+    spaced = [{**message, "content": f"  {message['content']}\n"} for message in MESSAGES]
+    assert player.chat("gemini", spaced) == "Piatto ai funghi"
+    assert server.behavior.requests == 2
+
+
+def test_replay_miss_raises_or_goes_live(stub_server, gateway_config, tmp_path):
+    server = stub_server(default_response="dal provider")
+    strict = LLMGateway(gateway_config(server, cassettes=cassettes(tmp_path, "replay")))
+    with pytest.raises(CassetteMiss):
+        strict.chat("groq", MESSAGES)
+    assert server.behavior.requests == 0
+
+    live = LLMGateway(gateway_config(server, cassettes=cassettes(tmp_path, "replay", on_miss="live")))
+    assert live.chat("groq", MESSAGES) == "dal provider"
+    assert server.behavior.requests == 1
+
+
+def test_replay_uses_the_recorded_failover_candidate(stub_server, gateway_config, tmp_path):
+    # Registrata con Groq in errore: la risposta è di Gemini, e in replay la fase la ritrova tra i suoi candidati
+    groq_server = stub_server(error_rate=1.0, error_status=500)
+    gemini_server = stub_server(default_response="da gemini")
+    policy = {"failover": {"decide_tool": [{"provider": "groq"}, {"provider": "gemini"}]}}
+    recorder = LLMGateway(gateway_config(groq_server, gemini_server, policy=policy, cassettes=cassettes(tmp_path, "record")))
+    assert recorder.chat("groq", MESSAGES, stage="decide_tool") == "da gemini"
+
+    player = LLMGateway(gateway_config(groq_server, gemini_server, policy=policy, cassettes=cassettes(tmp_path, "replay")))
+    answer = Answer()
+    assert player.chat("groq", MESSAGES, stage="decide_tool", answer=answer) == "da gemini"
+    assert (answer.provider, answer.model) == ("gemini", "gemini-test")
+    assert (groq_server.behavior.requests, gemini_server.behavior.requests) == (1, 1)
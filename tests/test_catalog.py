@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from src.catalog import CatalogStore, build_catalog
+
+
+@pytest.fixture
+def config(tmp_path):
+    (tmp_path / "dish_mapping.json").write_text(json.dumps({"Pizza Cosmica": 1, "Zuppa Nebulare": 2}))
+    (tmp_path / "distanze.csv").write_text("/,A,B,C\nA,0,5,9\nB,5,0,3\nC,9,3,0\n")
+    (tmp_path / "tecniche.csv").write_text("Categoria,Tecnica\nTaglio,Taglio X\nImpasto,Impasto Y\n")
+    return {"paths": {
+        "dish_mapping": str(tmp_path / "dish_mapping.json"),
+        "distances": str(tmp_path / "distanze.csv"),
+        "tecniche_di_cottura": str(tmp_path / "tecniche.csv"),
+    }}
+
+
+def publish(tmp_path, config, metadata=None):
+    store = CatalogStore(str(tmp_path / "catalog"))
+    store.publish(build_catalog(config, metadata))
+    return store.current()
+
+
+def test_distances_from_csv(tmp_path, config):
+    catalog = publish(tmp_path, config)
+    assert catalog.distance("A", "B") == 5.0
+    assert catalog.distance("C", "A") == 9.0
+    assert sorted(catalog.planets_within("B", 5)) == ["A", "B", "C"]
+    assert sorted(catalog.planets_within("A", 5)) == ["A", "B"]
+
+
+def test_metadata_planets_outside_distances_do_not_shift_matrix(tmp_path, config):
+    # Pianeti estratti dal LLM che non sono colonne di Distanze.csv
+    metadata = [
+        {"dish": "Pizza Cosmica", "restaurant_name": "Da Zeta", "planet": "Zeta", "ingredients": ["funghi"]},
+        {"dish": "Zuppa Nebulare", "restaurant_name": "Da Bi", "planet": "b ", "techniques": ["taglio x"]},
+    ]
+    catalog = publish(tmp_path, config, metadata)
+
+    assert catalog.distance("A", "B") == 5.0
+    assert catalog.distance("B", "C") == 3.0
+    assert sorted(catalog.planets_within("A", 5)) == ["A", "B"]
+    assert catalog.planets.names() == ["A", "B", "C"]
+    assert catalog.distance("A", "Zeta") is None
+    assert catalog.planets_within("Zeta", 100) == []
+    # Il pianeta estratto viene ricondotto al nome del CSV; quello sconosciuto resta vuoto
+    assert catalog.dish("Zuppa Nebulare")["planet"] == "B"
+    assert catalog.dish("Pizza Cosmica")["planet"] is None
+    assert catalog.dish("Pizza Cosmica")["ingredients"] == ["funghi"]
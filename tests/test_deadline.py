@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from src import deadline
+
+
+@pytest.fixture(autouse=True)
+def stage_timeouts():
+    deadline.configure({"deadlines": {"stages": {"decide_tool": 0.05}}})
+    yield
+    deadline.configure({})
+
+
+def test_stage_past_the_deadline_is_cancelled():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        with deadline.budget(0.05):
+            await deadline.run_stage("search_with_filters", slow())
+
+    with pytest.raises(deadline.DeadlineExceeded) as exceeded:
+        asyncio.run(run())
+    assert exceeded.value.stage == "search_with_filters"
+    assert cancelled == [True]
+
+
+def test_stage_timeout_applies_without_a_request_budget():
+    @deadline.with_deadline("decide_tool")
+    async def decide_tool():
+        await asyncio.sleep(1)
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        asyncio.run(decide_tool())
+
+
+def test_nested_budget_cannot_extend_the_outer_one():
+    async def run():
+        with deadline.budget(0.05):
+            with deadline.budget(10):
+                assert deadline.remaining() <= 0.05
+            await asyncio.sleep(0.06)
+            # Budget esaurito: la fase non parte nemmeno
+            await deadline.run_stage("execute", asyncio.sleep(0))
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        asyncio.run(run())
+
+
+def test_iterate_stops_a_stream_at_the_deadline():
+    async def tokens():
+        for token in ("Piatto", " ai", " funghi"):
+            yield token
+            await asyncio.sleep(0.1)
+
+    async def run():
+        received = []
+        with deadline.budget(0.15):
+            with pytest.raises(deadline.DeadlineExceeded):
+                async for token in deadline.iterate("get_dish_response", tokens()):
+                    received.append(token)
+        return received
+
+    assert asyncio.run(run()) == ["Piatto", " ai"]
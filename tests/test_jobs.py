@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.jobs import Job, JobConflict, JobManager
+
+
+def wait_finished(job, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job.finished
+
+
+def test_exclusive_job_conflicts_until_the_running_one_finishes():
+    jobs = JobManager(max_workers=2)
+    release = threading.Event()
+
+    def ingest(job):
+        release.wait(2)
+        return {"files": 1}
+
+    first = jobs.submit("setup_db", ingest, exclusive=True)
+    with pytest.raises(JobConflict) as conflict:
+        jobs.submit("setup_db", ingest, exclusive=True)
+    assert conflict.value.job is first
+    # Tipi diversi non si escludono
+    other = jobs.submit("process_csv", lambda job: None, exclusive=True)
+
+    release.set()
+    assert wait_finished(first) and wait_finished(other)
+    second = jobs.submit("setup_db", ingest, exclusive=True)
+    assert wait_finished(second)
+    assert (first.status, second.status) == (Job.COMPLETED, Job.COMPLETED)
+    jobs.shutdown()
+
+
+def test_sync_job_cancellation_is_cooperative():
+    jobs = JobManager()
+    started = threading.Event()
+
+    def rows(job):
+        started.set()
+        for done in range(1000):
+            job.raise_if_cancelled()
+            job.update(done=done, total=1000)
+            time.sleep(0.005)
+
+    job = jobs.submit("process_csv", rows, exclusive=True)
+    assert started.wait(2)
+    assert jobs.cancel(job.id)
+    assert wait_finished(job)
+    assert job.status == Job.CANCELLED
+    assert jobs.active("process_csv") is None
+    jobs.shutdown()
+
+
+def test_async_job_cancellation():
+    jobs = JobManager()
+
+    async def run():
+        async def work(job):
+            await asyncio.sleep(5)
+
+        job = jobs.submit("process_csv", work)
+        await asyncio.sleep(0.01)
+        jobs.cancel(job.id)
+        await asyncio.sleep(0.01)
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == Job.CANCELLED
+    jobs.shutdown()
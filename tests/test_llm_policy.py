@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+import groq
+import pytest
+
+from src.llm_gateway import Answer, CircuitOpenError, LLMError, LLMGateway
+from src.llm_policy import LLM_HEDGES, CircuitBreaker
+
+
+def test_throttling_does_not_open_breaker():
+    breaker = CircuitBreaker("groq", failure_threshold=2, reset_timeout=30)
+    for _ in range(5):
+        assert breaker.allow()
+        breaker.error(LLMError("groq", 429, "quota"))
+    assert breaker.closed
+    assert breaker.failures == 0
+
+    for _ in range(2):
+        breaker.error(LLMError("groq", 503, "non disponibile"))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+MESSAGES = [{"role": "user", "content": "Quali piatti contengono funghi?"}]
+
+
+def hedges(winner):
+    return LLM_HEDGES.labels(provider="groq", winner=winner).value
+
+
+def test_hedge_fires_after_p95_delay(stub_server, gateway_config):
+    # Cinque risposte da 0.2s stimano il p95; poi il primario resta fermo 2s e il duplicato risponde subito
+    server = stub_server(delays=[0.2] * 5 + [2.0, 0.0], default_response="risposta")
+    policy = {"hedging": {"enabled": True, "min_samples": 5, "min_delay": 0.01, "max_delay": 5}}
+    gateway = LLMGateway(gateway_config(server, policy=policy))
+
+    async def run():
+        for _ in range(5):
+            await gateway.achat("groq", MESSAGES)
+        delay = gateway.policy.hedge_delay("groq", "llama-test")
+        before = hedges("hedge")
+        started = time.monotonic()
+        text = await gateway.achat("groq", MESSAGES)
+        elapsed = time.monotonic() - started
+        await gateway.aclose()
+        return delay, text, elapsed, hedges("hedge") - before
+
+    delay, text, elapsed, hedge_wins = asyncio.run(run())
+    assert delay >= 0.2
+    assert text == "risposta"
+    assert delay <= elapsed < delay + 1.0
+    assert hedge_wins == 1
+    assert server.behavior.requests == 7
+
+
+def test_hedged_pair_failing_counts_one_breaker_failure(stub_server, gateway_config):
+    server = stub_server(delays=[0.05] * 3 + [0.3, 0.3])
+    policy = {"hedging": {"enabled": True, "min_samples": 3, "min_delay": 0.1, "max_delay": 5},
+              "circuit_breaker": {"failure_threshold": 5}}
+    gateway = LLMGateway(gateway_config(server, policy=policy))
+
+    async def run():
+        for _ in range(3):
+            await gateway.achat("groq", MESSAGES)
+        server.behavior.error_rate, server.behavior.error_status = 1.0, 500
+        try:
+            with pytest.raises(Exception):
+                await gateway.achat("groq", MESSAGES)
+        finally:
+            await gateway.aclose()
+
+    asyncio.run(run())
+    assert server.behavior.requests == 5
+    assert gateway.policy.breaker("groq").failures == 1
+
+
+def test_failover_follows_stage_order(stub_server, gateway_config):
+    groq_server = stub_server(error_rate=1.0, error_status=500)
+    gemini_server = stub_server(default_response="da gemini")
+    policy = {"failover": {
+        "decide_tool": [{"provider": "groq"}, {"provider": "gemini"}],
+        "generate_filters": [{"provider": "gemini"}, {"provider": "groq"}],
+    }}
+    gateway = LLMGateway(gateway_config(groq_server, gemini_server, policy=policy))
+
+    async def run():
+        answers = []
+        for stage in ("decide_tool", "generate_filters"):
+            answer = Answer()
+            text = await gateway.achat("groq", MESSAGES, stage=stage, answer=answer)
+            answers.append((text, answer.provider, answer.model))
+        await gateway.aclose()
+        return answers
+
+    answers = asyncio.run(run())
+    # decide_tool prova prima Groq (che fallisce), generate_filters va direttamente a Gemini
+    assert answers == [("da gemini", "gemini", "gemini-test")] * 2
+    assert groq_server.behavior.requests == 1
+    assert gemini_server.behavior.requests == 2
+
+
+def test_breaker_opens_then_half_opens(stub_server, gateway_config):
+    server = stub_server(error_rate=1.0, error_status=500, default_response="di nuovo su")
+    policy = {"circuit_breaker": {"failure_threshold": 2, "reset_timeout": 0.2}}
+    gateway = LLMGateway(gateway_config(server, policy=policy))
+    breaker = gateway.policy.breaker("groq")
+
+    async def call():
+        return await gateway.achat("groq", MESSAGES)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(groq.InternalServerError):
+                await call()
+        assert breaker.state == CircuitBreaker.OPEN
+        # Circuito aperto: la richiesta non arriva al provider
+        with pytest.raises(CircuitOpenError):
+            await call()
+        assert server.behavior.requests == 2
+
+        # Dopo reset_timeout passa una richiesta di prova: se fallisce il circuito si riapre
+        await asyncio.sleep(0.25)
+        with pytest.raises(groq.InternalServerError):
+            await call()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert server.behavior.requests == 3
+
+        # In half_open passa una sola prova alla volta; quando riesce il circuito si chiude
+        await asyncio.sleep(0.25)
+        server.behavior.error_rate = 0.0
+        server.behavior.delays = [0.2]
+        probe = asyncio.ensure_future(call())
+        await asyncio.sleep(0.05)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            await call()
+        assert await probe == "di nuovo su"
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert server.behavior.requests == 4
+        await gateway.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from src.cassette import Cassette
+from src.llm_gateway import Answer, CircuitOpenError, LLMGateway
+
+MESSAGES = [{"role": "user", "content": "Quali piatti contengono funghi?"}]
+POLICY = {"failover": {"get_dish_response": [{"provider": "groq"}, {"provider": "gemini"}]},
+          "circuit_breaker": {"failure_threshold": 2, "reset_timeout": 60}}
+
+
+def test_sync_failover_to_gemini_then_skips_open_circuit(stub_server, gateway_config):
+    groq_server = stub_server(error_rate=1.0, error_status=503)
+    gemini_server = stub_server(default_response="da gemini")
+    gateway = LLMGateway(gateway_config(groq_server, gemini_server, policy=POLICY))
+
+    for _ in range(3):
+        answer = Answer()
+        assert gateway.chat("groq", MESSAGES, stage="get_dish_response", answer=answer) == "da gemini"
+        assert answer.provider == "gemini"
+    # Dopo due errori il circuito di Groq è aperto: la terza chiamata va direttamente a Gemini
+    assert groq_server.behavior.requests == 2
+    assert gemini_server.behavior.requests == 3
+    gateway.close()
+
+
+def test_throttled_provider_fails_over_without_waiting(stub_server, gateway_config):
+    groq_server = stub_server(error_rate=1.0, error_status=429, retry_after=30)
+    gemini_server = stub_server(default_response="da gemini")
+    gateway = LLMGateway(gateway_config(groq_server, gemini_server, policy=POLICY))
+
+    async def run():
+        text = await asyncio.wait_for(gateway.achat("groq", MESSAGES, stage="get_dish_response"), timeout=5)
+        await gateway.aclose()
+        return text
+
+    assert asyncio.run(run()) == "da gemini"
+    assert gateway.policy.breaker("groq").closed
+
+
+def test_stream_fails_over_before_opening(stub_server, gateway_config):
+    groq_server = stub_server(error_rate=1.0, error_status=500)
+    gemini_server = stub_server(default_response="piatto ai funghi")
+    gateway = LLMGateway(gateway_config(groq_server, gemini_server, policy=POLICY))
+
+    async def run():
+        answer = Answer()
+        chunks = [chunk async for chunk in gateway.astream("groq", MESSAGES, stage="get_dish_response", answer=answer)]
+        await gateway.aclose()
+        return chunks, answer.provider
+
+    assert asyncio.run(run()) == (["piatto ai funghi"], "gemini")
+
+
+def test_all_candidates_down_raises(stub_server, gateway_config):
+    server = stub_server(error_rate=1.0, error_status=500)
+    gateway = LLMGateway(gateway_config(server, policy=POLICY))
+    for _ in range(2):
+        with pytest.raises(Exception):
+            gateway.chat("groq", MESSAGES, stage="get_dish_response")
+    with pytest.raises(CircuitOpenError):
+        gateway.chat("groq", MESSAGES, stage="get_dish_response")
+    gateway.close()
+
+
+def test_stub_serves_cassette_responses(stub_server, gateway_config, tmp_path):
+    path = str(tmp_path / "llm.jsonl")
+    recorder = Cassette("record", path)
+    recorder.record("groq", "llama-test", MESSAGES, None, "registrata per groq")
+    recorder.record("gemini", "gemini-test", MESSAGES, None, "registrata per gemini")
+
+    server = stub_server(cassette=Cassette("replay", path, on_miss="live"), default_response="non registrata")
+    gateway = LLMGateway(gateway_config(server))
+    assert gateway.chat("groq", MESSAGES) == "registrata per groq"
+    assert gateway.chat("gemini", MESSAGES) == "registrata per gemini"
+    assert gateway.chat("groq", [{"role": "user", "content": "Altro"}]) == "non registrata"
+    gateway.close()
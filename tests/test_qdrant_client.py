@@ -0,0 +1,40 @@
+import asyncio
+import logging
+from unittest import mock
+
+from src import tracing
+from src.qdrant_client import QdrantHandler
+
+
+def handler(collection_exists):
+    qdrant = QdrantHandler(config={"qdrant": {"host": "localhost", "port": 6333, "collection_name": "piatti"}})
+    qdrant.client = mock.Mock()
+    qdrant.client.collection_exists.return_value = collection_exists
+    return qdrant
+
+
+def test_warmup_on_missing_collection_is_ready_but_empty():
+    qdrant = handler(collection_exists=False)
+    qdrant.warmup()
+    qdrant.client.get_collection.assert_not_called()
+    qdrant.client.scroll.assert_not_called()
+
+
+def test_warmup_scrolls_existing_collection():
+    qdrant = handler(collection_exists=True)
+    qdrant.warmup()
+    qdrant.client.scroll.assert_called_once()
+
+
+def test_search_errors_are_logged_with_the_trace_id(caplog):
+    qdrant = handler(collection_exists=True)
+    qdrant.async_client = mock.AsyncMock()
+    qdrant.async_client.scroll.side_effect = RuntimeError("timeout")
+
+    async def run():
+        with tracing.start_trace("/process_query/", trace_id="abc123"):
+            return await qdrant.asearch_with_filters(None)
+
+    with caplog.at_level(logging.ERROR, logger="src.qdrant_client"):
+        assert asyncio.run(run()) == []
+    assert "abc123" in caplog.text and "timeout" in caplog.text
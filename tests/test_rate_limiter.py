@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from src.rate_limiter import RateLimiterRegistry, TokenBucket, retry_after
+
+
+def test_token_bucket_paces_requests_after_the_burst():
+    bucket = TokenBucket(capacity=2, refill_rate=20)
+
+    async def run():
+        started = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # Due token subito, poi uno ogni 50 ms
+    assert 0.09 <= asyncio.run(run()) < 0.5
+
+
+def test_registry_reserves_only_for_configured_providers():
+    registry = RateLimiterRegistry({"rate_limits": {"groq": {"requests_per_minute": 60}}})
+    messages = [{"role": "user", "content": "Quali piatti contengono funghi?"}]
+
+    async def run():
+        return await registry.acquire("gemini", messages), await registry.acquire("groq", messages)
+
+    unlimited, estimated = asyncio.run(run())
+    assert unlimited == 0
+    assert estimated > 0
+
+
+def test_retry_after_from_headers_and_body():
+    assert retry_after({"retry-after": "3"}) == 3
+    assert retry_after({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "1m2s"}) == 62
+    assert retry_after({}, '{"error": {"details": [{"retryDelay": "1.5s"}]}}') == 1.5
+    assert retry_after({}) is None
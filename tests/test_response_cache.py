@@ -0,0 +1,28 @@
+import asyncio
+
+from src.response_cache import ResponseCache
+
+
+def make_cache(tmp_path):
+    return ResponseCache(path=str(tmp_path / "responses.sqlite3"), stages={"decide_tool": None})
+
+
+def test_async_roundtrip_is_shared_through_disk(tmp_path):
+    first, second = make_cache(tmp_path), make_cache(tmp_path)
+    key = first.key("decide_tool", "catalogo-1", "modello", "domanda")
+
+    asyncio.run(first.aset(key, "generate_filters"))
+    assert asyncio.run(first.aget(key)) == "generate_filters"
+    assert asyncio.run(second.aget(key)) == "generate_filters"
+
+
+def test_new_catalog_version_hides_entries_in_other_workers(tmp_path):
+    # Due worker con la stessa voce nella LRU; la nuova ingestion viene vista solo tramite la versione del catalogo
+    first, second = make_cache(tmp_path), make_cache(tmp_path)
+    old_key = first.key("decide_tool", "catalogo-1", "modello", "domanda")
+    first.set(old_key, "generate_filters")
+    assert second.get(old_key) == "generate_filters"
+
+    new_key = second.key("decide_tool", "catalogo-2", "modello", "domanda")
+    assert second.get(new_key) is None
+    assert first.get(first.key("decide_tool", "catalogo-2", "modello", "domanda")) is None
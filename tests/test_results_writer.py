@@ -0,0 +1,47 @@
+import json
+
+import pandas as pd
+
+from src.results_writer import ResultsWriter
+
+
+def make_writer(tmp_path, flush_every=2):
+    return ResultsWriter(str(tmp_path / "output.csv"), flush_every=flush_every)
+
+
+def test_resume_skips_completed_rows(tmp_path):
+    writer = make_writer(tmp_path)
+    writer.add(2, {"result": "piatto b"})
+    writer.add(1, {"result": "piatto a"})
+    writer.add(3, {"success": False, "error": "LLM non raggiungibile"})
+    # Interruzione prima del flush successivo: la riga 4 non arriva su disco
+    writer.add(4, {"result": "piatto d"})
+
+    resumed = make_writer(tmp_path)
+    assert [row_id for row_id in range(1, 5) if not resumed.is_completed(row_id)] == [3, 4]
+
+    resumed.add(3, {"result": "piatto c"})
+    resumed.add(4, {"result": "piatto d"})
+    resumed.close()
+    output = pd.read_csv(tmp_path / "output.csv")
+    assert output["row_id"].tolist() == [1, 2, 3, 4]
+    assert output["result"].tolist() == ["piatto a", "piatto b", "piatto c", "piatto d"]
+    assert json.loads((tmp_path / "output.checkpoint.json").read_text()) == {"completed": [1, 2, 3, 4]}
+
+
+def test_rows_in_output_count_as_completed_without_checkpoint(tmp_path):
+    # Crash tra il commit dell'output e quello del checkpoint
+    writer = make_writer(tmp_path, flush_every=1)
+    writer.add(1, {"result": "piatto a"})
+    (tmp_path / "output.checkpoint.json").unlink()
+
+    assert make_writer(tmp_path).is_completed(1)
+
+
+def test_reset_starts_from_scratch(tmp_path):
+    writer = make_writer(tmp_path, flush_every=1)
+    writer.add(1, {"result": "piatto a"})
+    writer.reset()
+
+    assert not make_writer(tmp_path).is_completed(1)
+    assert not (tmp_path / "output.csv").exists()
@@ -0,0 +1,26 @@
+import json
+
+from src.router import ToolRouter
+
+
+def test_decisions_are_logged_and_trained_in_background(tmp_path):
+    log_path = tmp_path / "decisions.jsonl"
+    router = ToolRouter(enabled=True, min_samples=4, threshold=0.6, log_path=str(log_path), retrain_every=4)
+    decisions = [
+        ("piatti con funghi", "generate_filters"),
+        ("piatti con latte", "generate_filters"),
+        ("come stai", "none"),
+        ("ciao come va", "none"),
+    ]
+    for query, tool in decisions:
+        router.record(query, tool)
+    router.flush()
+
+    lines = [json.loads(line) for line in log_path.read_text(encoding="utf-8").splitlines()]
+    assert [(line["query"], line["tool"]) for line in lines] == decisions
+    assert router.model.samples == 4
+    assert router.route("piatti con funghi e latte").tool == "generate_filters"
+
+    router.close()
+    # Un nuovo router riparte dal log
+    assert ToolRouter(enabled=True, log_path=str(log_path)).model.samples == 4
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from src.scheduler import PriorityScheduler, QueueFull
+
+
+def test_full_queue_rejects_with_retry_after():
+    scheduler = PriorityScheduler(max_concurrency=1, max_queue=1, default_retry_after=7)
+
+    async def run():
+        running = await scheduler.acquire()
+        waiting = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        # Senza tempi di servizio misurati vale il Retry-After configurato
+        with pytest.raises(QueueFull) as rejected:
+            await scheduler.acquire()
+        assert rejected.value.retry_after == 7
+
+        running.release()
+        (await waiting).release()
+        # Dopo aver misurato il tempo di servizio il Retry-After è una stima (almeno 1 secondo)
+        running = await scheduler.acquire()
+        waiting = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull) as rejected:
+            await scheduler.acquire()
+        running.release()
+        (await waiting).release()
+        return rejected.value.retry_after
+
+    assert asyncio.run(run()) == 1
+
+
+def test_interactive_requests_overtake_queued_batch():
+    scheduler = PriorityScheduler(max_concurrency=1, batch_max_concurrency=1)
+    order = []
+
+    async def work(name, priority):
+        with await scheduler.acquire(priority, bounded=False):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        first = asyncio.ensure_future(work("batch-1", PriorityScheduler.BATCH))
+        await asyncio.sleep(0)
+        batch = asyncio.ensure_future(work("batch-2", PriorityScheduler.BATCH))
+        await asyncio.sleep(0)
+        chat = asyncio.ensure_future(work("chat", PriorityScheduler.INTERACTIVE))
+        await asyncio.gather(first, batch, chat)
+
+    asyncio.run(run())
+    assert order == ["batch-1", "chat", "batch-2"]
+
+
+def test_batch_keeps_slots_free_for_chat():
+    scheduler = PriorityScheduler(max_concurrency=2, batch_max_concurrency=1)
+
+    async def run():
+        batch = await scheduler.acquire(PriorityScheduler.BATCH, bounded=False)
+        queued = asyncio.ensure_future(scheduler.acquire(PriorityScheduler.BATCH, bounded=False))
+        await asyncio.sleep(0)
+        # Il secondo gruppo batch resta in coda, la chat ottiene subito lo slot libero
+        chat = await asyncio.wait_for(scheduler.acquire(), timeout=1)
+        assert not queued.done()
+        batch.release()
+        (await queued).release()
+        chat.release()
+
+    asyncio.run(run())
+    assert scheduler.running == {PriorityScheduler.INTERACTIVE: 0, PriorityScheduler.BATCH: 0}
+
+
+def test_cancelled_waiter_does_not_hold_a_slot():
+    scheduler = PriorityScheduler(max_concurrency=1)
+
+    async def run():
+        running = await scheduler.acquire()
+        waiting = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        running.release()
+        # Lo slot liberato non è stato assegnato all'attesa cancellata
+        slot = await asyncio.wait_for(scheduler.acquire(), timeout=1)
+        slot.release()
+
+    asyncio.run(run())
+    assert scheduler.running[PriorityScheduler.INTERACTIVE] == 0
+    assert scheduler.waiting[PriorityScheduler.INTERACTIVE] == 0
@@ -0,0 +1,29 @@
+import numpy as np
+
+from src.semantic_cache import SemanticCache
+
+
+class Catalog:
+    """Catalogo finto senza entità: tutte le domande hanno la firma vuota o solo numeri e operatori."""
+
+    def current(self):
+        return self
+
+    def mentions(self, text):
+        return {}
+
+
+def embedder():
+    # Tutte le domande hanno lo stesso embedding: decide solo la firma
+    return lambda query: np.ones(4, dtype=np.float32) / 2
+
+
+def test_empty_signature_reuses_only_identical_questions():
+    cache = SemanticCache(enabled=True, threshold=0.9, embedder_factory=embedder, catalog=Catalog())
+    filters = {"AND": {"ingredients": ["funghi"]}}
+    cache.add(cache.probe("quali piatti ci sono?", "t"), "quali piatti ci sono?", "generate_filters", filters)
+
+    assert cache.probe("quali piatti ci sono?", "t").signature == []
+    assert cache.probe("Quali piatti  ci sono", "t").hit == ("generate_filters", filters)
+    assert cache.probe("quali piatti non ci sono?", "t").hit is None
+    assert cache.probe("quali piatti servono oggi?", "t").hit is None
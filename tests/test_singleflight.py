@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from src.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def work(query):
+        calls.append(query)
+        await asyncio.sleep(0.05)
+        return {"query": query}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("funghi", work, "funghi") for _ in range(3)))
+
+    assert asyncio.run(run()) == [{"query": "funghi"}] * 3
+    assert calls == ["funghi"]
+
+
+def test_leader_mutation_is_not_seen_by_coalesced_callers():
+    flight = SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return {"OR": {"techniques": ["marinatura"]}, "min_should_count": 2}
+
+    async def leader():
+        filters = await flight.do("marinatura", work)
+        # Come un consumatore che rimuove una chiave dal risultato appena ricevuto
+        filters.pop("min_should_count")
+        filters["OR"]["techniques"].append("affumicatura")
+        return filters
+
+    async def follower():
+        await asyncio.sleep(0.01)
+        return await flight.do("marinatura", work)
+
+    async def run():
+        return await asyncio.gather(leader(), follower())
+
+    mutated, shared = asyncio.run(run())
+    assert mutated == {"OR": {"techniques": ["marinatura", "affumicatura"]}}
+    assert shared == {"OR": {"techniques": ["marinatura"]}, "min_should_count": 2}
+
+
+def test_cancelling_one_caller_keeps_the_shared_work():
+    flight = SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("k", work))
+        second = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "ok"
+
+
+def test_work_is_cancelled_when_every_caller_gives_up():
+    flight = SingleFlight("test")
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        callers = [asyncio.ensure_future(flight.do("k", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert cancelled == [True]
@@ -0,0 +1,32 @@
+from src.profiler import Profiler
+from src.tracing import LEVELS, Tracer
+
+
+def make_tracer(level_header=False):
+    tracer = Tracer()
+    tracer.configure({"tracing": {"enabled": True, "sample_rate": 0.0, "exporter": "stdout",
+                                  "level_header": level_header}})
+    return tracer
+
+
+def test_trace_level_header_needs_admin_token():
+    tracer = make_tracer()
+    profiler = Profiler(token="segreto")
+
+    # Senza token il livello richiesto dal client viene ignorato e vale il campionamento configurato
+    with tracer.start_trace("/process_query/", level="debug", trusted=profiler.is_admin(None)) as trace:
+        assert not trace.sampled
+    with tracer.start_trace("/process_query/", level="debug", trusted=profiler.is_admin("sbagliato")) as trace:
+        assert not trace.sampled
+    with tracer.start_trace("/process_query/", level="debug", trusted=profiler.is_admin("segreto")) as trace:
+        assert trace.sampled and trace.level == LEVELS["debug"]
+
+
+def test_no_profiling_token_means_no_admin():
+    assert not Profiler(token=None).is_admin(None)
+    assert not Profiler(token=None).is_admin("qualsiasi")
+
+
+def test_level_header_flag_trusts_every_client():
+    with make_tracer(level_header=True).start_trace("/process_query/", level="debug", trusted=False) as trace:
+        assert trace.sampled and trace.level == LEVELS["debug"]